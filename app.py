@@ -13,6 +13,7 @@ import datetime
 import shutil
 import database
 from document_processor import processor as doc_processor
+from ingestion import IngestionQueue
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-me')
@@ -32,6 +33,7 @@ if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+ingestion_queue = IngestionQueue(doc_processor, UPLOAD_FOLDER)
 RATE_LIMIT_WINDOW_SECONDS = 60
 RATE_LIMIT_MAX_REQUESTS = 30
 _rate_limit_store = {}
@@ -88,15 +90,9 @@ def initialize_runtime(reset_state=False):
         try:
             database.reset_non_user_data()
             uploads_dir = os.path.join(os.getcwd(), 'uploads', 'reports')
-            vs_dir = os.path.join(os.getcwd(), 'vector_store')
             if os.path.exists(uploads_dir):
                 shutil.rmtree(uploads_dir, ignore_errors=True)
-            if os.path.exists(vs_dir):
-                for fname in os.listdir(vs_dir):
-                    try:
-                        os.remove(os.path.join(vs_dir, fname))
-                    except OSError:
-                        pass
+            doc_processor.clear()
             os.makedirs(uploads_dir, exist_ok=True)
         except Exception as e:
             app.logger.info(f"Startup reset failed: {e}")
@@ -107,6 +103,8 @@ def initialize_runtime(reset_state=False):
         app.logger.info(f"Seed knowledge failed: {e}")
     database.seed_default_users()
     bot = CitizenAssistantBot()
+    ingestion_queue.recover()
+    ingestion_queue.start()
 
 
 register_error_handlers(app)
@@ -296,6 +294,10 @@ def api_support_tickets_read(idx):
     success = bot.mark_ticket_as_read(idx, user_id)
     return jsonify({'success': success})
 
+@app.route('/api/cache_stats')
+def api_cache_stats():
+    return jsonify(doc_processor.cache_stats())
+
 @app.route('/api/users')
 def api_users():
     return jsonify(database.get_users())
@@ -332,11 +334,16 @@ def upload_report():
 
             report_id = database.add_report(user_id, original_filename, stored_filename_with_time, uploader_name)
 
-            # Process the document for RAG. In a real-world app, this should be
-            # offloaded to a background worker (e.g., Celery, RQ).
-            doc_processor.process_and_embed_document(file_path, report_id)
+            # Extraction and embedding run on the ingestion workers; poll status_url for progress.
+            ingestion_queue.submit(report_id, file_path)
 
-            return jsonify({'success': True, 'message': 'Report uploaded and processed successfully.'})
+            return jsonify({
+                'success': True,
+                'message': 'Report uploaded. Processing has started.',
+                'report_id': report_id,
+                'status': 'queued',
+                'status_url': f'/reports/{report_id}/status',
+            }), 202
         except Exception as e:
             # Log the exception e
             return jsonify({'success': False, 'message': f'An error occurred while uploading the report: {str(e)}'}), 500
@@ -350,6 +357,25 @@ def get_reports():
     all_reports = database.get_reports()
     return jsonify(all_reports)
 
+@app.route('/reports/<int:report_id>/status', methods=['GET'])
+def report_status(report_id):
+    report = database.get_report_by_id(report_id)
+    if not report:
+        return jsonify({'success': False, 'message': 'Report not found.'}), 404
+    job = database.get_latest_ingestion_job(report_id)
+    if job:
+        status = job['status']
+    else:
+        status = 'done' if report.get('processed') == 1 else 'unknown'
+    return jsonify({
+        'success': True,
+        'report_id': report_id,
+        'status': status,
+        'processed': report.get('processed') == 1,
+        'attempts': job['attempts'] if job else 0,
+        'error': job['error'] if job else None,
+    })
+
 @app.route('/download_report/<filename>', methods=['GET'])
 def download_report(filename):
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
@@ -375,7 +401,7 @@ def delete_report_route(report_id):
         if os.path.exists(file_path):
             os.remove(file_path)
 
-        # Delete the document's vectors from the FAISS index
+        # Delete the document's vectors from the vector store
         doc_processor.delete_document(report_id)
 
         return jsonify({'success': True, 'message': 'Report deleted successfully.'})
@@ -393,7 +419,7 @@ def delete_all_reports():
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], report['stored_filename'])
             if os.path.exists(file_path):
                 os.remove(file_path)
-            doc_processor.delete_document(report['id'])
+        doc_processor.delete_documents([report['id'] for report in all_reports])
         database.delete_all_reports()
         return jsonify({'success': True, 'message': 'All reports and related data were deleted.'})
     except Exception as e:
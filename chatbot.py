@@ -1,5 +1,6 @@
 import datetime
 import json
+import logging
 import os
 import re
 import uuid
@@ -15,6 +16,8 @@ from document_processor import processor as doc_processor
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "lmstudio").strip().lower()
 
 LM_STUDIO_BASE_URL = os.getenv("LM_STUDIO_BASE_URL", "http://localhost:1234/v1")
@@ -89,6 +92,35 @@ def get_default_model():
         return OLLAMA_MODEL
     return LM_STUDIO_MODEL
 
+
+# Past turns loaded for LLM context; the tool-selection prompt uses the newest few of them.
+HISTORY_CONTEXT_ROWS = 32
+
+
+class MessageContext:
+    """Reads shared by the handlers of one message, each loaded once on first use.
+
+    The history and reports are as they were at that first use; the handlers
+    that write history return the reply right after, so nothing reads them stale.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self._history = None
+        self._reports = None
+
+    def history(self, limit: int = HISTORY_CONTEXT_ROWS) -> list:
+        """The newest `limit` (at most HISTORY_CONTEXT_ROWS) chat history rows, newest first."""
+        if self._history is None:
+            self._history = database.get_chat_history(self.user_id, limit=HISTORY_CONTEXT_ROWS)
+        return self._history[:limit]
+
+    def reports(self) -> list:
+        if self._reports is None:
+            self._reports = CitizenAssistantBot._reports_for_document_actions(self.user_id)
+        return self._reports
+
+
 class CitizenAssistantBot:
 
     def __init__(self):
@@ -134,10 +166,10 @@ class CitizenAssistantBot:
         example = f"Example: {example_verb} document {first_id}"
         return options_text, example
 
-    def _messages_for_general_chat(self, user_prompt: str, user_id: str) -> list:
+    def _messages_for_general_chat(self, user_prompt: str, user_id: str, context: MessageContext | None = None) -> list:
         """OpenAI-style messages: system + chronological history + latest user message."""
         messages: list = [{"role": "system", "content": GENERAL_ASSISTANT_SYSTEM}]
-        hist = database.get_chat_history(user_id, limit=32)
+        hist = (context or MessageContext(user_id)).history()
         pairs: list[tuple[str, str]] = []
         for h in reversed(hist):
             um = (h.get("user_message") or "").strip()
@@ -157,9 +189,9 @@ class CitizenAssistantBot:
         messages.append({"role": "user", "content": user_prompt})
         return messages
 
-    def _ollama_prompt_with_conversation(self, user_prompt: str, user_id: str) -> str:
+    def _ollama_prompt_with_conversation(self, user_prompt: str, user_id: str, context: MessageContext | None = None) -> str:
         """Prefix recent turns for /api/generate (no native multi-turn)."""
-        hist = database.get_chat_history(user_id, limit=32)
+        hist = (context or MessageContext(user_id)).history()
         blocks: list[str] = []
         for h in reversed(hist):
             um = (h.get("user_message") or "").strip()
@@ -181,7 +213,10 @@ class CitizenAssistantBot:
             f"User: {user_prompt}\nAssistant:"
         )
 
-    def ollama_chat(self, prompt: str, model: str | None = None, conversation_user_id: str | None = None) -> str:
+    def ollama_chat(
+        self, prompt: str, model: str | None = None, conversation_user_id: str | None = None,
+        context: MessageContext | None = None,
+    ) -> str:
         """Send a chat completion request via the configured LLM provider.
 
         Name kept for backward compatibility (tests mock this method).
@@ -191,7 +226,7 @@ class CitizenAssistantBot:
 
             if LLM_PROVIDER == "ollama":
                 full_prompt = (
-                    self._ollama_prompt_with_conversation(prompt, conversation_user_id)
+                    self._ollama_prompt_with_conversation(prompt, conversation_user_id, context)
                     if conversation_user_id
                     else prompt
                 )
@@ -218,7 +253,7 @@ class CitizenAssistantBot:
                 headers["Authorization"] = f"Bearer {LM_STUDIO_API_KEY}"
 
             if conversation_user_id:
-                msg_list = self._messages_for_general_chat(prompt, conversation_user_id)
+                msg_list = self._messages_for_general_chat(prompt, conversation_user_id, context)
             else:
                 msg_list = [{"role": "user", "content": prompt}]
             payload = {
@@ -248,13 +283,16 @@ class CitizenAssistantBot:
         except Exception as e:
             return f"LLM error: {e}"
 
-    def ollama_chat_stream(self, prompt: str, model: str | None = None, conversation_user_id: str | None = None) -> Iterator[str]:
+    def ollama_chat_stream(
+        self, prompt: str, model: str | None = None, conversation_user_id: str | None = None,
+        context: MessageContext | None = None,
+    ) -> Iterator[str]:
         selected_model = model or get_default_model()
 
         try:
             if LLM_PROVIDER == "ollama":
                 full_prompt = (
-                    self._ollama_prompt_with_conversation(prompt, conversation_user_id)
+                    self._ollama_prompt_with_conversation(prompt, conversation_user_id, context)
                     if conversation_user_id
                     else prompt
                 )
@@ -294,7 +332,7 @@ class CitizenAssistantBot:
                 headers["Authorization"] = f"Bearer {LM_STUDIO_API_KEY}"
 
             if conversation_user_id:
-                stream_messages = self._messages_for_general_chat(prompt, conversation_user_id)
+                stream_messages = self._messages_for_general_chat(prompt, conversation_user_id, context)
             else:
                 stream_messages = [{"role": "user", "content": prompt}]
 
@@ -380,10 +418,7 @@ class CitizenAssistantBot:
                 return direct or "No information was found on this topic."
             entries = database.search_kb_entries(question)
             if not entries:
-                single = database.search_kb_answer(question)
-                if not single:
-                    return "No information was found on this topic."
-                entries = [{"keywords": "", "answer": single}]
+                return "No information was found on this topic."
 
             bullets = "\n".join([f"- {e['answer']}" for e in entries])
             prompt = f"""
@@ -399,8 +434,7 @@ Answer:
             llm_response = self.ollama_chat(prompt)
 
             if not llm_response or llm_response.startswith("LLM error:") or "no response" in llm_response.lower():
-                fallback = database.search_kb_answer(question)
-                return fallback or "No information was found on this topic."
+                return entries[0]["answer"]
 
             return llm_response
         except Exception:
@@ -454,11 +488,12 @@ Answer:
 
         return None
 
-    def _handle_quick_queries(self, message: str, user_id: str):
+    def _handle_quick_queries(self, message: str, user_id: str, context: MessageContext | None = None):
         """Tries to answer common queries without a full LLM tool-use prompt."""
+        context = context or MessageContext(user_id)
         explicit_tool = self._extract_json((message or "").strip())
         if isinstance(explicit_tool, dict) and explicit_tool.get('tool'):
-            return self._handle_tool_call(explicit_tool, message, user_id)
+            return self._handle_tool_call(explicit_tool, message, user_id, context)
 
         kb_answer = self.get_knowledge_base_info(message)
         if kb_answer and kb_answer != "No information was found on this topic.":
@@ -479,7 +514,7 @@ Answer:
             "ne var", "neler var", "neler yazıyor", "neler yaziyor",
         ]
         if any(kw in lower_msg for kw in summary_keywords):
-            user_reports = self._reports_for_document_actions(user_id)
+            user_reports = context.reports()
             if not user_reports:
                 bot_response = "You have not uploaded any documents. Please upload a document first."
                 database.add_chat_history(user_id, "doc_summary_error", message, bot_response)
@@ -493,7 +528,7 @@ Answer:
                 database.add_chat_history(user_id, "doc_summary_selection", message, bot_response)
                 return bot_response
         if any(kw in lower_msg for kw in read_keywords):
-            user_reports = self._reports_for_document_actions(user_id)
+            user_reports = context.reports()
             if len(user_reports) == 1:
                 report_id = user_reports[0]['id']
                 return self._explain_report(report_id, message, message, user_id)
@@ -504,11 +539,12 @@ Answer:
                 return bot_response
         return None
 
-    def _decide_and_execute_tool(self, message: str, user_id: str):
+    def _decide_and_execute_tool(self, message: str, user_id: str, context: MessageContext | None = None):
         """Uses LLM to detect a tool call, then executes it."""
-        db_history = database.get_chat_history(user_id, limit=3)
+        context = context or MessageContext(user_id)
+        db_history = context.history(3)
         context_msgs = [f"User: {h['user_message']}\nBot: {h['bot_response']}" for h in reversed(db_history)]
-        context = "\n".join(context_msgs)
+        recent_turns = "\n".join(context_msgs)
 
         llm_prompt = f'''
 Below is the recent conversation history and a new user message. If one or more tool calls are needed, return JSON in the following format:
@@ -522,7 +558,7 @@ If the user asks to read, explain, summarize, or describe an uploaded file in an
 If no tool call is needed, just provide a normal answer.
 
 Recent conversation history:
-{context}
+{recent_turns}
 
 User message: {message}
 '''
@@ -531,13 +567,12 @@ User message: {message}
 
         try:
             if isinstance(data, list):
-                results = [self._handle_tool_call(item, message, user_id) for item in data]
+                results = [self._handle_tool_call(item, message, user_id, context) for item in data]
                 return "\n\n".join(results)
             if isinstance(data, dict) and data.get('tool'):
-                return self._handle_tool_call(data, message, user_id)
+                return self._handle_tool_call(data, message, user_id, context)
         except Exception as e:
-            import logging
-            logging.getLogger(__name__).exception("Tool execution error")
+            logger.exception("Tool execution error")
         return None
 
     def _handle_date_queries(self, message: str, user_id: str):
@@ -578,18 +613,25 @@ User message: {message}
 
     def process_message(self, message: str, user_id: str) -> str:
         """Processes a user message by routing it through different handlers."""
+        context = MessageContext(user_id)
+        with database.count_round_trips() as trips:
+            response = self._process_message(message, user_id, context)
+        logger.debug("Message from %s took %d database round trips", user_id, trips.count)
+        return response
+
+    def _process_message(self, message: str, user_id: str, context: MessageContext) -> str:
         # Step 1: Handle multi-turn conversation states (e.g., support ticket)
         state_response = self._handle_support_ticket_interaction(message, user_id)
         if state_response:
             return state_response
 
         # Step 2: Try quick handlers for KB and summarization before complex LLM calls
-        quick_response = self._handle_quick_queries(message, user_id)
+        quick_response = self._handle_quick_queries(message, user_id, context)
         if quick_response:
             return quick_response
 
         # Step 3: Use LLM to decide and execute a tool
-        tool_response = self._decide_and_execute_tool(message, user_id)
+        tool_response = self._decide_and_execute_tool(message, user_id, context)
         if tool_response:
             return tool_response
 
@@ -600,23 +642,29 @@ User message: {message}
 
         # Step 5: If no other handler caught the message, use LLM for a general chat response
         bot_response = self.ollama_chat(
-            message, model=self.user_models.get(user_id), conversation_user_id=user_id
+            message, model=self.user_models.get(user_id), conversation_user_id=user_id, context=context
         )
         database.add_chat_history(user_id, "llm_response", message, bot_response)
         return bot_response
 
     def process_message_stream(self, message: str, user_id: str) -> Iterator[str]:
+        context = MessageContext(user_id)
+        with database.count_round_trips() as trips:
+            yield from self._process_message_stream(message, user_id, context)
+        logger.debug("Message from %s took %d database round trips", user_id, trips.count)
+
+    def _process_message_stream(self, message: str, user_id: str, context: MessageContext) -> Iterator[str]:
         state_response = self._handle_support_ticket_interaction(message, user_id)
         if state_response:
             yield state_response
             return
 
-        quick_response = self._handle_quick_queries(message, user_id)
+        quick_response = self._handle_quick_queries(message, user_id, context)
         if quick_response:
             yield quick_response
             return
 
-        tool_response = self._decide_and_execute_tool(message, user_id)
+        tool_response = self._decide_and_execute_tool(message, user_id, context)
         if tool_response:
             yield tool_response
             return
@@ -628,7 +676,7 @@ User message: {message}
 
         chunks = []
         for chunk in self.ollama_chat_stream(
-            message, model=self.user_models.get(user_id), conversation_user_id=user_id
+            message, model=self.user_models.get(user_id), conversation_user_id=user_id, context=context
         ):
             chunks.append(chunk)
             yield chunk
@@ -687,27 +735,24 @@ User message: {message}
             processed_reports = sum(1 for r in reports if r.get('processed') == 1)
             unprocessed_reports = total_reports - processed_reports
 
-            conn = database.get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT status, COUNT(*) as cnt FROM support_tickets GROUP BY status")
-            status_rows = cur.fetchall()
-            conn.close()
-            ticket_status_counts = {row[0]: row[1] for row in status_rows} if status_rows else {}
-
-            conn = database.get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT user_id, type, user_message, bot_response, timestamp FROM chat_history ORDER BY timestamp DESC LIMIT 10")
-            last_interactions = [
-                {
-                    'user_id': row[0],
-                    'type': row[1],
-                    'user_message': row[2],
-                    'bot_response': row[3],
-                    'timestamp': row[4]
-                }
-                for row in cur.fetchall()
-            ]
-            conn.close()
+            database.flush_writes()
+            with database.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT status, COUNT(*) as cnt FROM support_tickets GROUP BY status")
+                status_rows = cur.fetchall()
+                ticket_status_counts = {row[0]: row[1] for row in status_rows} if status_rows else {}
+
+                cur.execute("SELECT user_id, type, user_message, bot_response, timestamp FROM chat_history ORDER BY timestamp DESC LIMIT 10")
+                last_interactions = [
+                    {
+                        'user_id': row[0],
+                        'type': row[1],
+                        'user_message': row[2],
+                        'bot_response': row[3],
+                        'timestamp': row[4]
+                    }
+                    for row in cur.fetchall()
+                ]
 
             return {
                 'reports': {
@@ -725,7 +770,8 @@ User message: {message}
                 'error': f'Error retrieving dashboard data: {e}'
             }
 
-    def _handle_tool_call(self, data, original_user_message: str, user_id: str):
+    def _handle_tool_call(self, data, original_user_message: str, user_id: str, context: MessageContext | None = None):
+        context = context or MessageContext(user_id)
         user_state = self.user_states.setdefault(user_id, {})
         tool = data.get('tool')
         bot_response = ""
@@ -747,7 +793,7 @@ User message: {message}
             if not query:
                 return "Please specify what you would like to search for in the document."
 
-            user_reports = self._reports_for_document_actions(user_id)
+            user_reports = context.reports()
             if not user_reports:
                 kb_fallback = self.get_knowledge_base_info(query)
                 if kb_fallback and kb_fallback != "No information was found on this topic.":
@@ -762,7 +808,7 @@ User message: {message}
                 return f"Multiple documents found. Choose one by ID:\n{options_text}\n{example}"
 
         if tool == 'document_summarize':
-            user_reports = self._reports_for_document_actions(user_id)
+            user_reports = context.reports()
             if not user_reports:
                 bot_response = "You have not uploaded any documents. Please upload a document first."
                 database.add_chat_history(user_id, "doc_summary_error", original_user_message, bot_response)
@@ -841,8 +887,7 @@ User message: {message}
         return bot_response
 
     def _explain_report(self, report_id, query, original_user_message, user_id):
-        search_results = doc_processor.search_in_documents(query, top_k=6)
-        filtered_results = [r for r in search_results if str(r['report_id']) == str(report_id)]
+        filtered_results = doc_processor.search_in_documents(query, top_k=6, report_ids=[report_id])
         if not filtered_results:
             return "No relevant information was found in the selected document."
         context_for_llm = "\n\n---\n\n".join([result['text'] for result in filtered_results])
@@ -865,11 +910,10 @@ Your answer:
         return bot_response
 
     def _summarize_report(self, report_id, original_user_message, user_id: str):
-        top_chunks = doc_processor.search_in_documents("", top_k=8)
-        filtered = [r for r in top_chunks if str(r['report_id']) == str(report_id)]
+        filtered = doc_processor.search_in_documents("", top_k=8, report_ids=[report_id])
         if not filtered:
             guess_query = "general summary introduction purpose conclusion findings abstract overview methods results"
-            filtered = [r for r in doc_processor.search_in_documents(guess_query, top_k=10) if str(r['report_id']) == str(report_id)]
+            filtered = doc_processor.search_in_documents(guess_query, top_k=10, report_ids=[report_id])
         if not filtered:
             bot_response = "Not enough content was found in the selected document to generate a summary."
             database.add_chat_history(user_id, "doc_summary", original_user_message, bot_response, json.dumps({"report_id": report_id}))
@@ -1,23 +1,258 @@
+import atexit
 import datetime
+import itertools
+import logging
 import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from typing import Dict, List, Optional
 
+from keyword_matcher import KeywordMatcher
+
+logger = logging.getLogger(__name__)
+
+try:
+    SQLITE_CACHE_MB = max(1, int(os.getenv('SQLITE_CACHE_MB', '64')))
+except ValueError:
+    SQLITE_CACHE_MB = 64
+
+try:
+    SQLITE_MMAP_MB = max(0, int(os.getenv('SQLITE_MMAP_MB', '256')))
+except ValueError:
+    SQLITE_MMAP_MB = 256
+
+try:
+    SQLITE_BUSY_TIMEOUT_SECONDS = max(1, int(os.getenv('SQLITE_BUSY_TIMEOUT_SECONDS', '30')))
+except ValueError:
+    SQLITE_BUSY_TIMEOUT_SECONDS = 30
+
+try:
+    DB_WRITE_BEHIND_MS = max(0, int(os.getenv('DB_WRITE_BEHIND_MS', '50')))
+except ValueError:
+    DB_WRITE_BEHIND_MS = 50
+
+try:
+    DB_WRITE_BEHIND_MAX_ROWS = max(1, int(os.getenv('DB_WRITE_BEHIND_MAX_ROWS', '200')))
+except ValueError:
+    DB_WRITE_BEHIND_MAX_ROWS = 200
+
 
 def get_db_name():
     return os.environ.get('TEST_DATABASE_URL', 'chatbot_data.db')
 
 
-def get_db_connection():
-    conn = sqlite3.connect(get_db_name())
+def _connect(db_name, **kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_name, timeout=SQLITE_BUSY_TIMEOUT_SECONDS, **kwargs)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers run alongside a writer; NORMAL only syncs at checkpoints, which WAL keeps safe.
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_MB * 1024}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_MB * 1024 * 1024}')
+    conn.execute('PRAGMA foreign_keys = ON')
     return conn
 
 
+def get_db_connection():
+    """A new connection of the caller's own, which the caller closes."""
+    return _connect(get_db_name())
+
+
+class _ThreadConnection(threading.local):
+    conn = None
+    key = None
+    depth = 0
+    counters = ()
+
+
+_local = _ThreadConnection()
+
+
+def _thread_connection(db_name=None) -> sqlite3.Connection:
+    for counter in _local.counters:
+        counter.count += 1
+    # Keyed on the process too: a connection must not be used on both sides of a fork.
+    key = (db_name or get_db_name(), os.getpid())
+    if _local.key != key:
+        if _local.conn is not None and _local.key[1] == key[1]:
+            _local.conn.close()
+        _local.conn = _connect(key[0], isolation_level=None)
+        _local.key = key
+        _local.depth = 0
+    return _local.conn
+
+
+@contextmanager
+def connection():
+    """This thread's reusable connection, in autocommit mode; for reads."""
+    yield _thread_connection()
+
+
+@contextmanager
+def transaction(immediate: bool = False, db_name=None):
+    """This thread's connection inside a transaction that commits on success and rolls back on error.
+
+    A transaction opened inside another one joins it. `immediate` takes the
+    write lock up front, for read-then-write sequences that must not interleave.
+    """
+    conn = _thread_connection(db_name)
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    _local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+    finally:
+        _local.depth = 0
+
+
+class RoundTripCounter:
+    """How many times this thread used the database while `count_round_trips` was active."""
+
+    def __init__(self):
+        self.count = 0
+
+
+@contextmanager
+def count_round_trips():
+    """Count `connection()` and `transaction()` uses on this thread; counters may nest.
+
+    Rows queued by `WriteBehindQueue` are not counted until a flush on this thread writes them.
+    """
+    counter = RoundTripCounter()
+    _local.counters += (counter,)
+    try:
+        yield counter
+    finally:
+        _local.counters = tuple(active for active in _local.counters if active is not counter)
+
+
+def close_connections():
+    """Close this thread's reusable connection, e.g. before removing the database file."""
+    if _local.conn is not None:
+        _local.conn.close()
+    _local.conn = _local.key = None
+    _local.depth = 0
+
+
+class WriteBehindQueue:
+    """Buffers inserts nobody reads back at once and writes them in batches.
+
+    A batch is one transaction, written when `max_rows` rows are waiting or
+    `interval` seconds after its first row arrived, and at exit. Readers of the
+    affected tables call `flush()` first, so a process always sees its own writes.
+    """
+
+    def __init__(self, interval: float, max_rows: int):
+        self.interval = interval
+        self.max_rows = max_rows
+        self._reset()
+
+    def _reset(self):
+        self._pending = []  # (db_name, sql, params) in arrival order
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._arrived = threading.Event()
+        self._full = threading.Event()
+        self._thread = None
+
+    def put(self, sql: str, params):
+        with self._lock:
+            self._pending.append((get_db_name(), sql, params))
+            if len(self._pending) >= self.max_rows:
+                self._full.set()
+            self._arrived.set()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-write-behind', daemon=True)
+                self._thread.start()
+
+    def flush(self) -> int:
+        """Write every buffered row now; returns how many were written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            done = written = 0
+            try:
+                for db_name, rows in itertools.groupby(pending, key=lambda row: row[0]):
+                    rows = list(rows)
+                    try:
+                        with transaction(db_name=db_name) as conn:
+                            for _, sql, params in rows:
+                                conn.execute(sql, params)
+                        written += len(rows)
+                    except sqlite3.IntegrityError:
+                        written += self._write_each(db_name, rows)
+                    done += len(rows)
+            except Exception:
+                # Keep what was not written, in order, for the next attempt.
+                with self._lock:
+                    self._pending[:0] = pending[done:]
+                    self._arrived.set()
+                raise
+            return written
+
+    @staticmethod
+    def _write_each(db_name, rows) -> int:
+        written = 0
+        for _, sql, params in rows:
+            try:
+                with transaction(db_name=db_name) as conn:
+                    conn.execute(sql, params)
+                written += 1
+            except sqlite3.IntegrityError:
+                logger.exception('Dropping buffered row that the database rejected: %s %r', sql, params)
+        return written
+
+    def _run(self):
+        while True:
+            self._arrived.wait()
+            self._full.wait(self.interval)
+            self._arrived.clear()
+            self._full.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Buffered database writes failed; retrying')
+                time.sleep(1)
+
+
+_write_behind = WriteBehindQueue(DB_WRITE_BEHIND_MS / 1000.0, DB_WRITE_BEHIND_MAX_ROWS)
+atexit.register(_write_behind.flush)
+if hasattr(os, 'register_at_fork'):
+    # The parent still owns its buffered rows; a forked child must not write them again.
+    os.register_at_fork(after_in_child=_write_behind._reset)
+
+
+def flush_writes() -> int:
+    """Write buffered chat history rows now."""
+    return _write_behind.flush()
+
+
+def _insert_behind(sql: str, params):
+    # Inside a caller's transaction the row joins it, so it commits or rolls back with the rest.
+    if _local.depth or not _write_behind.interval:
+        with transaction() as conn:
+            conn.execute(sql, params)
+    else:
+        _write_behind.put(sql, params)
+
+
 def init_db(db_name_override=None):
     current_db_name = db_name_override or get_db_name()
-    conn = sqlite3.connect(current_db_name)
-    conn.row_factory = sqlite3.Row
+    conn = _connect(current_db_name)
     cursor = conn.cursor()
 
     cursor.execute(
@@ -76,6 +311,75 @@ def init_db(db_name_override=None):
         '''
     )
 
+    cursor.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS ingestion_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER NOT NULL,
+            file_path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    )
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_status ON ingestion_jobs (status, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ingestion_jobs_report ON ingestion_jobs (report_id, id)')
+
+    # Text of embedded document chunks; their vectors live in the vector store under the same id.
+    cursor.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS document_chunks (
+            id INTEGER PRIMARY KEY,
+            report_id INTEGER NOT NULL REFERENCES uploaded_reports (id) ON DELETE CASCADE,
+            user_id TEXT,
+            chunk_index INTEGER NOT NULL,
+            text TEXT NOT NULL
+        )
+        '''
+    )
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_document_chunks_report ON document_chunks (report_id, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_document_chunks_user ON document_chunks (user_id)')
+    # BM25 keyword index over the chunk text, kept in step by triggers.
+    cursor.execute(
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS document_chunks_fts USING fts5 (
+            text,
+            content = 'document_chunks',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        '''
+    )
+    cursor.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS document_chunks_fts_insert AFTER INSERT ON document_chunks BEGIN
+            INSERT INTO document_chunks_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        '''
+    )
+    cursor.execute(
+        '''
+        CREATE TRIGGER IF NOT EXISTS document_chunks_fts_delete AFTER DELETE ON document_chunks BEGIN
+            INSERT INTO document_chunks_fts (document_chunks_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+        '''
+    )
+
+    # Extracted page text of each report, so re-chunking or re-embedding need not parse the file again.
+    cursor.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS report_pages (
+            report_id INTEGER NOT NULL REFERENCES uploaded_reports (id) ON DELETE CASCADE,
+            page_number INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            PRIMARY KEY (report_id, page_number)
+        )
+        '''
+    )
+
     cursor.execute(
         '''
         CREATE TABLE IF NOT EXISTS institution_knowledge (
@@ -88,11 +392,84 @@ def init_db(db_name_override=None):
     )
 
     conn.commit()
+    migrate(conn)
     seed_default_knowledge(conn)
     seed_default_users(conn)
     conn.close()
 
 
+# Schema changes made after the tables above were first released, in order.
+# `PRAGMA user_version` holds how many have been applied to a database; append, never edit.
+MIGRATIONS = [
+    # Indexes for the per-user listings, the ingestion backlog and the dashboard.
+    (
+        'CREATE INDEX IF NOT EXISTS idx_chat_history_user_time ON chat_history (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_chat_history_time ON chat_history (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_support_tickets_user_created ON support_tickets (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_support_tickets_created ON support_tickets (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_support_tickets_status ON support_tickets (status)',
+        'CREATE INDEX IF NOT EXISTS idx_uploaded_reports_user_created ON uploaded_reports (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_uploaded_reports_created ON uploaded_reports (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_uploaded_reports_processed ON uploaded_reports (processed, created_at)',
+    ),
+    # A counter bumped on every knowledge base change, so cached keyword matchers know when to rebuild.
+    (
+        'CREATE TABLE IF NOT EXISTS knowledge_version (version INTEGER NOT NULL)',
+        'INSERT INTO knowledge_version (version) VALUES (0)',
+        '''
+        CREATE TRIGGER IF NOT EXISTS institution_knowledge_insert AFTER INSERT ON institution_knowledge BEGIN
+            UPDATE knowledge_version SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS institution_knowledge_update AFTER UPDATE ON institution_knowledge BEGIN
+            UPDATE knowledge_version SET version = version + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS institution_knowledge_delete AFTER DELETE ON institution_knowledge BEGIN
+            UPDATE knowledge_version SET version = version + 1;
+        END
+        ''',
+    ),
+    # Which process holds a 'processing' ingestion job, and until when (epoch seconds) unless renewed.
+    (
+        'ALTER TABLE ingestion_jobs ADD COLUMN owner TEXT',
+        'ALTER TABLE ingestion_jobs ADD COLUMN lease_expires_at REAL',
+    ),
+    # Page text is cached as it is extracted; only a finished extraction may be read back.
+    (
+        'ALTER TABLE uploaded_reports ADD COLUMN pages_cached INTEGER NOT NULL DEFAULT 0',
+        'UPDATE uploaded_reports SET pages_cached = 1 WHERE id IN (SELECT report_id FROM report_pages)',
+    ),
+    # When a failed ingestion job that is queued again may next be claimed (epoch seconds).
+    (
+        'ALTER TABLE ingestion_jobs ADD COLUMN retry_at REAL',
+    ),
+]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply the migrations a database has not had yet; returns how many ran.
+
+    Runs under the write lock, so processes starting together apply each one once.
+    """
+    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        (version,) = conn.execute('PRAGMA user_version').fetchone()
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    return max(0, len(MIGRATIONS) - version)
+
+
 def seed_default_users(conn: Optional[sqlite3.Connection] = None):
     close_conn = False
     if conn is None:
@@ -165,251 +542,582 @@ def seed_default_knowledge(conn: Optional[sqlite3.Connection] = None):
         conn.close()
 
 
-def _normalize_text(text: str) -> str:
-    if not isinstance(text, str):
-        return ""
-    return text.lower().strip()
+# (database name, knowledge_version, matcher over its keywords) of the last knowledge base read.
+_kb_matcher = (None, None, None)
 
 
-def search_kb_answer(query: str) -> Optional[str]:
-    if not query or not query.strip():
-        return None
-    q = _normalize_text(query)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT keywords, answer FROM institution_knowledge')
-    rows = cur.fetchall()
-    conn.close()
+def _knowledge_matcher() -> KeywordMatcher:
+    """A matcher over every institution_knowledge keyword, rebuilt only after the table changes."""
+    global _kb_matcher
+    db_name = get_db_name()
+    with connection() as conn:
+        (version,) = conn.execute('SELECT version FROM knowledge_version').fetchone()
+        cached_name, cached_version, matcher = _kb_matcher
+        if (cached_name, cached_version) == (db_name, version):
+            return matcher
+        rows = conn.execute('SELECT id, keywords, answer FROM institution_knowledge ORDER BY id').fetchall()
+    matcher = KeywordMatcher()
     for row in rows:
-        keywords = (row[0] or "").split(',')
-        for kw in keywords:
-            if not kw.strip():
-                continue
-            if _normalize_text(kw) in q:
-                return row[1]
-    return None
+        entry = (row['id'], row['keywords'], row['answer'])
+        for keyword in (row['keywords'] or '').split(','):
+            matcher.add(keyword, entry)
+    matcher.build()
+    _kb_matcher = (db_name, version, matcher)
+    return matcher
 
 
-def search_kb_entries(query: str) -> List[Dict]:
-    results: List[Dict] = []
+def match_kb_entries(query: str) -> List[Dict]:
+    """Knowledge base entries with a keyword in `query`, in table order.
+
+    Each entry lists its `matches` as `{keyword, start, end}` offsets into `query`.
+    Matching ignores case and Turkish diacritics.
+    """
     if not query or not query.strip():
-        return results
-    q = _normalize_text(query)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT keywords, answer FROM institution_knowledge')
-    rows = cur.fetchall()
-    conn.close()
-    for row in rows:
-        keywords = (row[0] or "").split(',')
-        for kw in keywords:
-            if not kw.strip():
-                continue
-            if _normalize_text(kw) in q:
-                results.append({"keywords": row[0], "answer": row[1]})
-                break
-    return results
+        return []
+    entries = {}
+    for start, end, keyword, (entry_id, keywords, answer) in _knowledge_matcher().find(query):
+        entry = entries.setdefault(entry_id, {"keywords": keywords, "answer": answer, "matches": []})
+        entry["matches"].append({"keyword": keyword, "start": start, "end": end})
+    return [entries[entry_id] for entry_id in sorted(entries)]
+
+
+def search_kb_answer(query: str) -> Optional[str]:
+    entries = match_kb_entries(query)
+    return entries[0]["answer"] if entries else None
+
+
+def search_kb_entries(query: str) -> List[Dict]:
+    return [{"keywords": entry["keywords"], "answer": entry["answer"]} for entry in match_kb_entries(query)]
 
 
 def get_users():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT id, name, title, department FROM users ORDER BY name ASC')
-    rows = [dict(row) for row in cur.fetchall()]
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT id, name, title, department FROM users ORDER BY name ASC')
+        rows = [dict(row) for row in cur.fetchall()]
     return rows
 
 
 def get_departments() -> List[str]:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT DISTINCT department FROM users ORDER BY department ASC')
-    departments = [row[0] for row in cur.fetchall()]
-    conn.close()
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT DISTINCT department FROM users ORDER BY department ASC')
+        departments = [row[0] for row in cur.fetchall()]
     return departments
 
 
 def add_chat_history(user_id: str, type: str, user_message: str, bot_response: str, details_json_str: str = None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO chat_history (user_id, type, user_message, bot_response, details) VALUES (?, ?, ?, ?, ?)",
-        (user_id, type, user_message, bot_response, details_json_str),
+    # Stamped now, in the format of the column default, rather than when the batch is written.
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    _insert_behind(
+        "INSERT INTO chat_history (user_id, timestamp, type, user_message, bot_response, details) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, timestamp, type, user_message, bot_response, details_json_str),
     )
-    conn.commit()
-    conn.close()
 
 
 def get_chat_history(user_id: str, limit: int = 20) -> list:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-        (user_id, limit),
-    )
-    history = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    flush_writes()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM chat_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
+            (user_id, limit),
+        )
+        history = [dict(row) for row in cursor.fetchall()]
     return history
 
 
 def add_support_ticket(user_id: str, ticket_id: str, department: str, description: str, priority: str, category: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    now = datetime.datetime.now()
-    cursor.execute(
-        "INSERT INTO support_tickets (user_id, ticket_id, department, description, priority, category, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (user_id, ticket_id, department, description, priority, category, now, now),
-    )
-    conn.commit()
-    conn.close()
+    # Written at once, not behind the request: the user is told the ticket exists, so a rejected insert must raise.
+    with transaction() as conn:
+        cursor = conn.cursor()
+        now = datetime.datetime.now()
+        cursor.execute(
+            "INSERT INTO support_tickets (user_id, ticket_id, department, description, priority, category, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, ticket_id, department, description, priority, category, now, now),
+        )
 
 
 def get_support_tickets(user_id: str, limit: int = 50) -> list:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM support_tickets WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-        (user_id, limit),
-    )
-    tickets = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM support_tickets WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+            (user_id, limit),
+        )
+        tickets = [dict(row) for row in cursor.fetchall()]
     return tickets
 
 
 def get_support_tickets_all(limit: int = 100) -> list:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT st.*, u.name as user_name, u.department as user_department
-        FROM support_tickets st
-        LEFT JOIN users u ON u.id = st.user_id
-        ORDER BY st.created_at DESC
-        LIMIT ?
-        """,
-        (limit,),
-    )
-    tickets = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT st.*, u.name as user_name, u.department as user_department
+            FROM support_tickets st
+            LEFT JOIN users u ON u.id = st.user_id
+            ORDER BY st.created_at DESC
+            LIMIT ?
+            """,
+            (limit,),
+        )
+        tickets = [dict(row) for row in cursor.fetchall()]
     return tickets
 
 
 def update_support_ticket_status(user_id: str, ticket_id: str, status: str) -> bool:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    now = datetime.datetime.now()
-    cursor.execute(
-        "UPDATE support_tickets SET status = ?, updated_at = ? WHERE user_id = ? AND ticket_id = ?",
-        (status, now, user_id, ticket_id),
-    )
-    updated_rows = cursor.rowcount
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        now = datetime.datetime.now()
+        cursor.execute(
+            "UPDATE support_tickets SET status = ?, updated_at = ? WHERE user_id = ? AND ticket_id = ?",
+            (status, now, user_id, ticket_id),
+        )
+        updated_rows = cursor.rowcount
     return updated_rows > 0
 
 
 def get_ticket_by_id(user_id: str, ticket_id: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM support_tickets WHERE user_id = ? AND ticket_id = ?",
-        (user_id, ticket_id),
-    )
-    ticket = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM support_tickets WHERE user_id = ? AND ticket_id = ?",
+            (user_id, ticket_id),
+        )
+        ticket = cursor.fetchone()
     return dict(ticket) if ticket else None
 
 
 def add_report(user_id: str, original_filename: str, stored_filename: str, uploader_name: str):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO uploaded_reports (user_id, original_filename, stored_filename, uploader_name) VALUES (?, ?, ?, ?)",
-        (user_id, original_filename, stored_filename, uploader_name),
-    )
-    report_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO uploaded_reports (user_id, original_filename, stored_filename, uploader_name) VALUES (?, ?, ?, ?)",
+            (user_id, original_filename, stored_filename, uploader_name),
+        )
+        report_id = cursor.lastrowid
     return report_id
 
 
 def get_reports(user_id: str = None, limit: int = 100) -> list:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    if user_id:
-        cursor.execute(
-            "SELECT * FROM uploaded_reports WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
-            (user_id, limit),
-        )
-    else:
-        cursor.execute(
-            "SELECT * FROM uploaded_reports ORDER BY created_at DESC LIMIT ?",
-            (limit,),
-        )
-    reports = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        if user_id:
+            cursor.execute(
+                "SELECT * FROM uploaded_reports WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                (user_id, limit),
+            )
+        else:
+            cursor.execute(
+                "SELECT * FROM uploaded_reports ORDER BY created_at DESC LIMIT ?",
+                (limit,),
+            )
+        reports = [dict(row) for row in cursor.fetchall()]
     return reports
 
 
+def get_report_ids_for_user(user_id: str) -> List[int]:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM uploaded_reports WHERE user_id = ?", (user_id,))
+        report_ids = [row[0] for row in cursor.fetchall()]
+    return report_ids
+
+
 def get_report_by_id(report_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM uploaded_reports WHERE id = ?", (report_id,))
-    report = cursor.fetchone()
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM uploaded_reports WHERE id = ?", (report_id,))
+        report = cursor.fetchone()
     return dict(report) if report else None
 
 
 def mark_report_as_processed(report_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE uploaded_reports SET processed = 1 WHERE id = ?", (report_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE uploaded_reports SET processed = 1 WHERE id = ?", (report_id,))
 
 
 def get_unprocessed_reports() -> list:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM uploaded_reports WHERE processed = 0 ORDER BY created_at ASC")
-    reports = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM uploaded_reports WHERE processed = 0 ORDER BY created_at ASC")
+        reports = [dict(row) for row in cursor.fetchall()]
     return reports
 
 
-def delete_report(report_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT stored_filename FROM uploaded_reports WHERE id = ?", (report_id,))
-    report = cursor.fetchone()
-    if not report:
-        conn.close()
-        return None
+def enqueue_ingestion_job(report_id: int, file_path: str) -> int:
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO ingestion_jobs (report_id, file_path) VALUES (?, ?)",
+            (report_id, file_path),
+        )
+        job_id = cursor.lastrowid
+    return job_id
+
+
+def claim_next_ingestion_job(owner: str = None, lease_seconds: float = 60.0):
+    """Atomically move the oldest queued job to 'processing' and return it (or None).
+
+    `owner` holds the job for `lease_seconds`; keep renewing the lease with
+    `renew_ingestion_lease` while working on it.
+    """
+    now = time.time()
+    lease_expires_at = now + lease_seconds
+    with transaction(immediate=True) as conn:
+        row = conn.execute(
+            "SELECT * FROM ingestion_jobs WHERE status = 'queued' AND (retry_at IS NULL OR retry_at <= ?) "
+            "ORDER BY id ASC LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE ingestion_jobs SET status = 'processing', attempts = attempts + 1, owner = ?, "
+            "lease_expires_at = ?, retry_at = NULL, updated_at = ? WHERE id = ?",
+            (owner, lease_expires_at, datetime.datetime.now(), row['id']),
+        )
+    job = dict(row)
+    job.update(
+        status='processing',
+        attempts=row['attempts'] + 1,
+        owner=owner,
+        lease_expires_at=lease_expires_at,
+        retry_at=None,
+    )
+    return job
 
-    stored_filename = report['stored_filename']
-    cursor.execute("DELETE FROM uploaded_reports WHERE id = ?", (report_id,))
-    conn.commit()
-    conn.close()
+
+def renew_ingestion_lease(job_id: int, owner: str, lease_seconds: float) -> bool:
+    """Extend `owner`'s lease on a job; False if the job is no longer held by it."""
+    with transaction() as conn:
+        cursor = conn.execute(
+            "UPDATE ingestion_jobs SET lease_expires_at = ?, updated_at = ? "
+            "WHERE id = ? AND owner IS ? AND status = 'processing'",
+            (time.time() + lease_seconds, datetime.datetime.now(), job_id, owner),
+        )
+        return cursor.rowcount == 1
+
+
+def release_expired_ingestion_jobs(max_attempts: int) -> int:
+    """Re-queue 'processing' jobs whose lease ran out; returns how many were re-queued.
+
+    A job whose holder died that often already used up its attempts (each
+    claim counts one) is failed instead, so a document that crashes the worker
+    is not retried forever. Jobs claimed before leases existed have none and
+    count as expired.
+    """
+    now = datetime.datetime.now()
+    expired = "status = 'processing' AND (lease_expires_at IS NULL OR lease_expires_at < ?)"
+    with transaction(immediate=True) as conn:
+        conn.execute(
+            f"UPDATE ingestion_jobs SET status = 'failed', owner = NULL, lease_expires_at = NULL, "
+            f"error = 'The worker processing this report stopped responding.', updated_at = ? "
+            f"WHERE {expired} AND attempts >= ?",
+            (now, time.time(), max_attempts),
+        )
+        cursor = conn.execute(
+            f"UPDATE ingestion_jobs SET status = 'queued', owner = NULL, lease_expires_at = NULL, updated_at = ? "
+            f"WHERE {expired}",
+            (now, time.time()),
+        )
+        return cursor.rowcount
+
+
+def finish_ingestion_job(job_id: int, status: str, error: str = None, owner: str = None):
+    """Record a job's outcome; with `owner`, only if that owner still holds the job."""
+    with transaction() as conn:
+        cursor = conn.cursor()
+        if owner is None:
+            cursor.execute(
+                "UPDATE ingestion_jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, datetime.datetime.now(), job_id),
+            )
+        else:
+            cursor.execute(
+                "UPDATE ingestion_jobs SET status = ?, error = ?, owner = NULL, lease_expires_at = NULL, "
+                "updated_at = ? WHERE id = ? AND owner = ? AND status = 'processing'",
+                (status, error, datetime.datetime.now(), job_id, owner),
+            )
+        return cursor.rowcount == 1
+
+
+def retry_ingestion_job(job_id: int, owner: str, error: str, delay_seconds: float) -> bool:
+    """Queue a failed job again, claimable after `delay_seconds`; False if `owner` no longer holds it."""
+    with transaction() as conn:
+        cursor = conn.execute(
+            "UPDATE ingestion_jobs SET status = 'queued', error = ?, owner = NULL, lease_expires_at = NULL, "
+            "retry_at = ?, updated_at = ? WHERE id = ? AND owner IS ? AND status = 'processing'",
+            (error, time.time() + delay_seconds, datetime.datetime.now(), job_id, owner),
+        )
+        return cursor.rowcount == 1
+
+
+def requeue_ingestion_job(job_id: int):
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE ingestion_jobs SET status = 'queued', retry_at = NULL, updated_at = ? WHERE id = ?",
+            (datetime.datetime.now(), job_id),
+        )
+
+
+def get_latest_ingestion_job(report_id: int):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM ingestion_jobs WHERE report_id = ? ORDER BY id DESC LIMIT 1",
+            (report_id,),
+        )
+        job = cursor.fetchone()
+    return dict(job) if job else None
+
+
+def _placeholders(values) -> str:
+    return ','.join('?' * len(values))
+
+
+def add_document_chunks(report_id: int, texts: List[str], min_id: int = 1) -> List[int]:
+    """Store the chunk texts of a report under consecutive new ids and return the ids.
+
+    Ids continue from the largest stored id (an index lookup), but never go
+    below `min_id`, so ids still present in the vector store are not reused.
+    """
+    with transaction(immediate=True) as conn:
+        report = conn.execute('SELECT user_id FROM uploaded_reports WHERE id = ?', (report_id,)).fetchone()
+        if report is None:
+            raise ValueError(f'Report {report_id} does not exist.')
+        (max_id,) = conn.execute('SELECT MAX(id) FROM document_chunks').fetchone()
+        (first_index,) = conn.execute(
+            'SELECT COUNT(*) FROM document_chunks WHERE report_id = ?', (report_id,)
+        ).fetchone()
+        start_id = max((max_id or 0) + 1, min_id)
+        chunk_ids = list(range(start_id, start_id + len(texts)))
+        conn.executemany(
+            'INSERT INTO document_chunks (id, report_id, user_id, chunk_index, text) VALUES (?, ?, ?, ?, ?)',
+            [(chunk_id, report_id, report['user_id'], first_index + position, text)
+             for position, (chunk_id, text) in enumerate(zip(chunk_ids, texts))],
+        )
+    return chunk_ids
+
+
+def import_document_chunks(rows) -> int:
+    """Insert `(chunk_id, report_id, text)` rows kept by older vector stores.
+
+    Rows whose report no longer exists, or whose id is already stored, are skipped.
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    with transaction() as conn:
+        cursor = conn.cursor()
+        report_ids = sorted({row[1] for row in rows})
+        users = {}
+        for start in range(0, len(report_ids), 500):
+            batch = report_ids[start:start + 500]
+            cursor.execute(f'SELECT id, user_id FROM uploaded_reports WHERE id IN ({_placeholders(batch)})', batch)
+            users.update((row['id'], row['user_id']) for row in cursor.fetchall())
+        positions = {}
+        values = []
+        for chunk_id, report_id, text in sorted(rows):
+            if report_id in users:
+                position = positions.get(report_id, 0)
+                positions[report_id] = position + 1
+                values.append((chunk_id, report_id, users[report_id], position, text))
+        cursor.executemany(
+            'INSERT OR IGNORE INTO document_chunks (id, report_id, user_id, chunk_index, text) VALUES (?, ?, ?, ?, ?)',
+            values,
+        )
+        imported = cursor.rowcount
+    return imported
+
+
+def get_document_chunk_texts(chunk_ids: List[int]) -> Dict[int, str]:
+    chunk_ids = list(chunk_ids)
+    if not chunk_ids:
+        return {}
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT id, text FROM document_chunks WHERE id IN ({_placeholders(chunk_ids)})', chunk_ids)
+        texts = {row['id']: row['text'] for row in cursor.fetchall()}
+    return texts
+
+
+def get_first_document_chunks(limit: int, report_ids: Optional[List[int]] = None) -> list:
+    """The `limit` oldest chunks, optionally only those of `report_ids`."""
+    with connection() as conn:
+        cursor = conn.cursor()
+        if report_ids is None:
+            cursor.execute('SELECT id, report_id, text FROM document_chunks ORDER BY id LIMIT ?', (limit,))
+        else:
+            report_ids = list(report_ids)
+            cursor.execute(
+                f'SELECT id, report_id, text FROM document_chunks WHERE report_id IN ({_placeholders(report_ids)}) '
+                'ORDER BY id LIMIT ?',
+                (*report_ids, limit),
+            )
+        chunks = [dict(row) for row in cursor.fetchall()]
+    return chunks
+
+
+def search_document_chunks(match: str, limit: int, report_ids: Optional[List[int]] = None) -> list:
+    """Best BM25 matches for an FTS5 `match` expression, as dicts with id, report_id, text and score.
+
+    Higher scores are better.
+    """
+    sql = (
+        'SELECT c.id, c.report_id, c.text, -bm25(document_chunks_fts) AS score '
+        'FROM document_chunks_fts JOIN document_chunks c ON c.id = document_chunks_fts.rowid '
+        'WHERE document_chunks_fts MATCH ?'
+    )
+    params = [match]
+    if report_ids is not None:
+        report_ids = list(report_ids)
+        sql += f' AND c.report_id IN ({_placeholders(report_ids)})'
+        params.extend(report_ids)
+    sql += ' ORDER BY rank LIMIT ?'
+    params.append(limit)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        chunks = [dict(row) for row in cursor.fetchall()]
+    return chunks
+
+
+def get_report_chunks(report_id: int) -> list:
+    """`{id, text}` of every chunk of a report, in order."""
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, text FROM document_chunks WHERE report_id = ? ORDER BY id', (report_id,))
+        chunks = [dict(row) for row in cursor.fetchall()]
+    return chunks
+
+
+def get_chunk_ids_by_report() -> Dict[int, List[int]]:
+    """Chunk ids of every report that has chunks, ascending, without loading any text."""
+    with connection() as conn:
+        rows = conn.execute('SELECT report_id, id FROM document_chunks ORDER BY report_id, id').fetchall()
+    return {
+        report_id: [row[1] for row in group]
+        for report_id, group in itertools.groupby(rows, key=lambda row: row[0])
+    }
+
+
+def get_document_chunk_ids(above: int = 0) -> List[int]:
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM document_chunks WHERE id > ? ORDER BY id', (above,))
+        chunk_ids = [row[0] for row in cursor.fetchall()]
+    return chunk_ids
+
+
+def start_report_pages(report_id: int) -> bool:
+    """Drop a report's cached page text before extracting it again; False if the report no longer exists.
+
+    Add the pages with `add_report_pages` as they are extracted, then call
+    `finish_report_pages`; until then the cache is not read back.
+    """
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE uploaded_reports SET pages_cached = 0 WHERE id = ?', (report_id,))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('DELETE FROM report_pages WHERE report_id = ?', (report_id,))
+    return True
+
+
+def add_report_pages(report_id: int, first_page_number: int, pages: List[str]):
+    if not pages:
+        return
+    with transaction() as conn:
+        conn.executemany(
+            'INSERT INTO report_pages (report_id, page_number, text) VALUES (?, ?, ?)',
+            [(report_id, number, text) for number, text in enumerate(pages, start=first_page_number)],
+        )
+
+
+def finish_report_pages(report_id: int):
+    with transaction() as conn:
+        conn.execute('UPDATE uploaded_reports SET pages_cached = 1 WHERE id = ?', (report_id,))
+
+
+def has_report_pages(report_id: int) -> bool:
+    """Whether the whole text of a report was extracted and cached."""
+    with connection() as conn:
+        row = conn.execute('SELECT pages_cached FROM uploaded_reports WHERE id = ?', (report_id,)).fetchone()
+    return bool(row and row['pages_cached'])
+
+
+def iter_report_pages(report_id: int, batch_size: int = 64):
+    """Yield the cached page text of a report in order, reading `batch_size` pages at a time."""
+    next_page = 0
+    while True:
+        with connection() as conn:
+            rows = conn.execute(
+                'SELECT page_number, text FROM report_pages WHERE report_id = ? AND page_number >= ? '
+                'ORDER BY page_number LIMIT ?',
+                (report_id, next_page, batch_size),
+            ).fetchall()
+        for row in rows:
+            yield row['text']
+        if len(rows) < batch_size:
+            return
+        next_page = rows[-1]['page_number'] + 1
+
+
+def delete_document_chunks(report_ids: List[int]):
+    report_ids = list(report_ids)
+    if not report_ids:
+        return
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'DELETE FROM document_chunks WHERE report_id IN ({_placeholders(report_ids)})', report_ids)
+
+
+def delete_document_chunks_by_id(chunk_ids: List[int]):
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('DELETE FROM document_chunks WHERE id = ?', [(chunk_id,) for chunk_id in chunk_ids])
+
+
+def delete_all_document_chunks():
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM document_chunks')
+
+
+def delete_report(report_id: int):
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT stored_filename FROM uploaded_reports WHERE id = ?", (report_id,))
+        report = cursor.fetchone()
+        if not report:
+            return None
+
+        stored_filename = report['stored_filename']
+        cursor.execute("DELETE FROM ingestion_jobs WHERE report_id = ?", (report_id,))
+        cursor.execute("DELETE FROM uploaded_reports WHERE id = ?", (report_id,))
     return stored_filename
 
 
 def delete_all_reports():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM uploaded_reports')
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM ingestion_jobs')
+        cursor.execute('DELETE FROM uploaded_reports')
 
 
 def reset_non_user_data():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM chat_history')
-    cur.execute('DELETE FROM support_tickets')
-    cur.execute('DELETE FROM uploaded_reports')
-    cur.execute('DELETE FROM institution_knowledge')
-    conn.commit()
-    conn.close()
+    flush_writes()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM chat_history')
+        cur.execute('DELETE FROM support_tickets')
+        cur.execute('DELETE FROM ingestion_jobs')
+        cur.execute('DELETE FROM uploaded_reports')
+        cur.execute('DELETE FROM institution_knowledge')
 
 
 if __name__ == '__main__':
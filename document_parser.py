@@ -0,0 +1,40 @@
+"""Text extraction run inside the parse worker processes.
+
+Every function takes a file path and returns plain data, so it can be sent to
+a `ProcessPoolExecutor`. Keep this module's imports light: each worker
+process imports it.
+"""
+import logging
+
+import docx
+import fitz
+import pypdf
+
+logger = logging.getLogger(__name__)
+
+
+def pdf_page_count(file_path) -> int:
+    with open(file_path, "rb") as f:
+        return len(pypdf.PdfReader(f).pages)
+
+
+def extract_pdf_pages(file_path, start, stop) -> list:
+    """pypdf text of pages `start` to `stop - 1`."""
+    with open(file_path, "rb") as f:
+        reader = pypdf.PdfReader(f)
+        return [reader.pages[number].extract_text() or "" for number in range(start, min(stop, len(reader.pages)))]
+
+
+def extract_pdf_pages_fitz(file_path, start, stop) -> list:
+    """PyMuPDF text of pages `start` to `stop - 1`; recovers text pypdf often misses."""
+    try:
+        with fitz.open(file_path) as doc:
+            return [doc[number].get_text() for number in range(start, min(stop, doc.page_count))]
+    except Exception as e:
+        logger.warning("PDF fallback extraction failed: %s", e)
+        return []
+
+
+def extract_docx_paragraphs(file_path) -> list:
+    doc = docx.Document(file_path)
+    return [para.text for para in doc.paragraphs]
@@ -1,19 +1,38 @@
-import json
+import copy
 import logging
-import math
+import multiprocessing
 import os
-import re
+import queue
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
-import docx
-import fitz
-import pypdf
-import requests
+import numpy as np
 
 import database
+import document_parser
+from embedding_client import EmbeddingClient
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache, normalize_query
+from lexical_index import match_expression, reciprocal_rank_fusion
+from retrieval_client import RetrievalClient
+from vector_index import QUANTIZATIONS, IVFIndex, VectorIndex, normalize_rows, recall_at_k
+from vector_store import VectorStore
 
 logger = logging.getLogger(__name__)
 
+
+def _int_env(name, default, minimum=1):
+    try:
+        return max(minimum, int(os.getenv(name, str(default))))
+    except ValueError:
+        return default
+
+
 # Same switch as chat: embeddings follow the active LLM provider.
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "lmstudio").strip().lower()
 
@@ -22,80 +41,747 @@ LM_STUDIO_API_KEY = os.getenv("LM_STUDIO_API_KEY", "")
 LM_STUDIO_EMBED_MODEL = os.getenv(
     "LM_STUDIO_EMBED_MODEL", "text-embedding-nomic-embed-text-v1.5"
 )
-try:
-    _LM_STUDIO_EMBED_BATCH_SIZE = max(1, int(os.getenv("LM_STUDIO_EMBED_BATCH_SIZE", "64")))
-except ValueError:
-    _LM_STUDIO_EMBED_BATCH_SIZE = 64
+# Upper bound on texts per embedding request; batches are otherwise sized by
+# EMBED_BATCH_MAX_CHARS, and up to EMBED_MAX_IN_FLIGHT requests run at once.
+_LM_STUDIO_EMBED_BATCH_SIZE = _int_env("LM_STUDIO_EMBED_BATCH_SIZE", 64)
+EMBED_BATCH_MAX_CHARS = _int_env("EMBED_BATCH_MAX_CHARS", 48000)
+EMBED_MAX_IN_FLIGHT = _int_env("EMBED_MAX_IN_FLIGHT", 4)
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434").rstrip("/")
 OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "qwen3-embedding:0.6b")
 VECTOR_STORE_PATH = os.path.join(os.getcwd(), "vector_store")
-METADATA_FILE = os.path.join(VECTOR_STORE_PATH, "metadata.json")
+EMBEDDING_CACHE_FILE = "embedding_cache.sqlite3"
+# "vector" ranks chunks by embedding similarity, "lexical" by BM25 keyword match
+# (no embedding call), and "hybrid" fuses both rankings.
+DOCUMENT_SEARCH_MODE = os.getenv("DOCUMENT_SEARCH_MODE", "vector").strip().lower()
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+# Candidates taken from each ranking before reciprocal-rank fusion.
+HYBRID_CANDIDATES = _int_env("HYBRID_CANDIDATES", 50)
+# Content-hash cache of chunk embeddings; 0 disables it.
+EMBEDDING_CACHE_MAX_ENTRIES = _int_env("EMBEDDING_CACHE_MAX_ENTRIES", 200000, minimum=0)
+# In-process LRU of query vectors; 0 disables it.
+QUERY_EMBED_CACHE_SIZE = _int_env("QUERY_EMBED_CACHE_SIZE", 1024, minimum=0)
+QUERY_EMBED_CACHE_TTL = _int_env("QUERY_EMBED_CACHE_TTL", 3600)
+# Fold the write-ahead log into a new snapshot once it grows past this size.
+VECTOR_WAL_COMPACT_BYTES = _int_env("VECTOR_WAL_COMPACT_BYTES", 64 * 1024 * 1024)
+# Searches check at most this often whether other processes sharing the store
+# wrote to it; 0 checks before every search.
+VECTOR_STORE_REFRESH_SECONDS = _int_env("VECTOR_STORE_REFRESH_SECONDS", 1, minimum=0)
+# "exact" scores every chunk; "ivf" builds an approximate IVF index once the store
+# holds IVF_MIN_ROWS chunks and then scores only the IVF_NPROBE nearest lists.
+VECTOR_INDEX_MODE = os.getenv("VECTOR_INDEX_MODE", "exact").strip().lower()
+IVF_NLIST = _int_env("IVF_NLIST", 0, minimum=0)  # 0 = about 4 * sqrt(chunks)
+IVF_NPROBE = _int_env("IVF_NPROBE", 8)
+IVF_MIN_ROWS = _int_env("IVF_MIN_ROWS", 20000)
+# "float16" or "int8" keeps compact codes for first-pass scoring (float32 rows stay
+# on disk for rescoring the best candidates); "none" scores the float32 rows.
+VECTOR_QUANTIZATION = os.getenv("VECTOR_QUANTIZATION", "none").strip().lower()
+# First-pass codes keep only this many leading dimensions (e.g. 128), for
+# embedding models trained for Matryoshka truncation; 0 keeps every dimension.
+VECTOR_PREFILTER_DIMS = _int_env("VECTOR_PREFILTER_DIMS", 0, minimum=0)
+VECTOR_RESCORE = os.getenv("VECTOR_RESCORE", "1").strip() != "0"
+# First-pass candidates rescored at full precision (at least 4 per requested result).
+VECTOR_RESCORE_CANDIDATES = _int_env("VECTOR_RESCORE_CANDIDATES", 200, minimum=0)
+# Concurrent whole-store vector searches arriving within this window are scored
+# together with one matrix-matrix product; 0 scores every search on its own.
+SEARCH_BATCH_WINDOW_MS = _int_env("SEARCH_BATCH_WINDOW_MS", 3, minimum=0)
+SEARCH_BATCH_MAX_QUERIES = _int_env("SEARCH_BATCH_MAX_QUERIES", 32)
+CHUNK_SIZE = 900
+CHUNK_OVERLAP = 120
+# Chunks embedded and stored per step while later pages are still being parsed.
+INGEST_BATCH_CHUNKS = _int_env("INGEST_BATCH_CHUNKS", 256)
+# PDF/DOCX parsing runs in a process pool so it cannot stall the web process;
+# PARSE_WORKERS=0 parses on the calling thread instead.
+PARSE_WORKERS = _int_env("PARSE_WORKERS", min(4, os.cpu_count() or 1), minimum=0)
+PARSE_TIMEOUT_SECONDS = _int_env("PARSE_TIMEOUT_SECONDS", 300)
+PARSE_MAX_PAGES = _int_env("PARSE_MAX_PAGES", 2000, minimum=0)  # 0 = no limit
+PARSE_PAGES_PER_TASK = _int_env("PARSE_PAGES_PER_TASK", 32)
+# Parse workers must not be forked from this process: its other threads
+# (ingestion, write-behind, embedding) may hold locks the child would inherit.
+if "forkserver" in multiprocessing.get_all_start_methods():
+    _PARSE_CONTEXT = multiprocessing.get_context("forkserver")
+    # The server imports the parsers only, not the web app that started it.
+    _PARSE_CONTEXT.set_forkserver_preload(["document_parser"])
+else:
+    _PARSE_CONTEXT = multiprocessing.get_context("spawn")
+# When set, a separate `retrieval_service` process owns the index and
+# `processor` forwards calls to it (see retrieval_client).
+RETRIEVAL_SERVICE_URL = os.getenv("RETRIEVAL_SERVICE_URL", "").strip()
+
+
+def _active_embed_model():
+    """Cache namespace for the embedding model currently in use."""
+    if LLM_PROVIDER == "ollama":
+        return f"ollama:{OLLAMA_EMBED_MODEL}"
+    return f"lmstudio:{LM_STUDIO_EMBED_MODEL}"
+
+
+def _batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _prefetch(items, depth=2):
+    """Iterate `items` on a background thread, keeping at most `depth` results ahead."""
+    buffer = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                while not stopped.is_set():
+                    try:
+                        buffer.put((item, None), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stopped.is_set():
+                    return
+            buffer.put((done, None))
+        except BaseException as e:
+            buffer.put((done, e))
+
+    thread = threading.Thread(target=produce, name="ingest-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+class _ParseTask:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.pool = None
+        self.future = None
+        self.deadline = None
+
+
+class _SearchBatch:
+    def __init__(self, index, filtered, rescore, candidates):
+        self.index = index
+        self.filtered = filtered
+        self.rescore = rescore
+        self.candidates = candidates
+        self.queries = []
+        self.top_ks = []
+        self.report_ids = []
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
 
-if not os.path.exists(VECTOR_STORE_PATH):
-    os.makedirs(VECTOR_STORE_PATH)
+
+class SearchBatcher:
+    """Scores concurrent searches of one index snapshot together.
+
+    The first search to arrive while others are running waits `window_seconds`
+    for more to join, then runs `VectorIndex.search_many` for the whole batch;
+    the others block until its results are ready. A search with nothing else
+    in flight runs at once, so an idle server adds no latency. Searches
+    limited to some reports batch with each other, each keeping its own
+    filter, and whole-store searches batch with each other.
+    """
+
+    def __init__(self, window_seconds, max_queries):
+        self.window_seconds = window_seconds
+        self.max_queries = max_queries
+        self._lock = threading.Lock()
+        self._open = None
+        self._in_flight = 0
+        self.batches = 0
+        self.queries = 0
+
+    def search(self, index, query_vector, top_k, report_ids=None, rescore=True, candidates=0):
+        filtered = report_ids is not None
+        with self._lock:
+            self._in_flight += 1
+            batch = self._open
+            leader = not (
+                batch is not None
+                and batch.index is index
+                and batch.filtered == filtered
+                and batch.rescore == rescore
+                and batch.candidates == candidates
+                and len(batch.queries) < self.max_queries
+            )
+            if leader:
+                batch = self._open = _SearchBatch(index, filtered, rescore, candidates)
+            slot = len(batch.queries)
+            batch.queries.append(query_vector)
+            batch.top_ks.append(top_k)
+            batch.report_ids.append(report_ids)
+            alone = self._in_flight == 1
+        try:
+            if leader:
+                if not alone:
+                    time.sleep(self.window_seconds)
+                self._run(batch)
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[slot][:top_k]
+
+    def stats(self):
+        return {"batches": self.batches, "queries": self.queries}
+
+    def _run(self, batch):
+        with self._lock:
+            if self._open is batch:
+                self._open = None
+            # No more queries can join once the batch is closed.
+            queries, top_k = list(batch.queries), max(batch.top_ks)
+            report_ids = list(batch.report_ids) if batch.filtered else None
+            self.batches += 1
+            self.queries += len(queries)
+        try:
+            batch.results = batch.index.search_many(
+                np.asarray(queries, dtype=np.float32),
+                top_k,
+                report_ids=report_ids,
+                rescore=batch.rescore,
+                candidates=batch.candidates,
+            )
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
 
 
 class DocumentProcessor:
-    def __init__(self):
-        self.metadata = {}
-        self._load()
+    def __init__(self, store_path=None):
+        self.store = VectorStore(store_path or VECTOR_STORE_PATH)
+        # Vectors live in `self.index`; chunk text in the `document_chunks` table.
+        # The index is copy-on-write: writers build a modified shallow copy under
+        # `_write_lock` and publish it by rebinding `self.index`, so a reader that
+        # takes `self.index` once per call searches a consistent snapshot without locking.
+        self.index = VectorIndex()
+        # Chunk text found in an older store, moved to the database by `_sync_catalog`.
+        self._legacy_catalog = {}
+        self._catalog_synced = False
+        self._catalog_lock = threading.Lock()
+        self._next_chunk_id = 1
+        # Why the store could not be read, if it couldn't; writes are refused until a reload succeeds.
+        self._load_error = None
+        # Serializes WAL appends and index updates within the process; writes are
+        # also made under `store.lock()` so other processes sharing the store can't interleave.
+        self._write_lock = threading.Lock()
+        self._refreshed_at = 0.0
+        self._compacting = False
+        self._ann_building = False
+        self._parse_pool = None
+        self._parse_lock = threading.Lock()
+        # Pools stopped because a task in them timed out; their other tasks are resubmitted.
+        self._timed_out_parse_pools = weakref.WeakSet()
+        self.embedding_client = EmbeddingClient(
+            max_in_flight=EMBED_MAX_IN_FLIGHT,
+            max_batch_chars=EMBED_BATCH_MAX_CHARS,
+            max_batch_items=_LM_STUDIO_EMBED_BATCH_SIZE,
+        )
+        self.embedding_cache = self._open_embedding_cache()
+        self.query_cache = (
+            QueryEmbeddingCache(QUERY_EMBED_CACHE_SIZE, QUERY_EMBED_CACHE_TTL)
+            if QUERY_EMBED_CACHE_SIZE
+            else None
+        )
+        self.search_batcher = (
+            SearchBatcher(SEARCH_BATCH_WINDOW_MS / 1000.0, SEARCH_BATCH_MAX_QUERIES)
+            if SEARCH_BATCH_WINDOW_MS
+            else None
+        )
+        with self.store.lock():
+            self._load()
+        self._maybe_build_ann_index()
+
+    def _open_embedding_cache(self):
+        if not EMBEDDING_CACHE_MAX_ENTRIES:
+            return None
+        return EmbeddingCache(
+            os.path.join(self.store.path, EMBEDDING_CACHE_FILE), max_entries=EMBEDDING_CACHE_MAX_ENTRIES
+        )
 
     def _load(self):
-        if not os.path.exists(METADATA_FILE):
-            self.metadata = {}
-            return
+        """Re-read the whole store; call with `_write_lock` (once published) and `store.lock()` held.
+
+        A store that can't be read is not treated as empty: the current index
+        stays in place, and writes and the orphan sweep are refused until a
+        later `_catch_up` loads it.
+        """
         try:
-            with open(METADATA_FILE, "r", encoding="utf-8") as f:
-                self.metadata = {int(k): v for k, v in json.load(f).items()}
+            index, catalog = self.store.load()
         except Exception as e:
-            logger.warning("Could not load metadata: %s", e)
-            self.metadata = {}
-
-    def _save(self):
-        with open(METADATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(self.metadata, f, ensure_ascii=False, indent=2)
-
-    def _extract_text_from_pdf(self, file_path):
-        text = ""
-        with open(file_path, "rb") as f:
-            reader = pypdf.PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-        if text.strip():
-            return text
+            logger.exception("Could not load vector store")
+            self._load_error = e
+            return
+        self._load_error = None
+        if catalog:
+            self._legacy_catalog = catalog
+        self._next_chunk_id = max(self._next_chunk_id, self.store.max_chunk_id + 1)
+        self.index = self._quantized(index)
+
+    def _require_loaded(self):
+        """Raise unless the store was read; call after `_catch_up`, with both write locks held."""
+        if self._load_error is not None:
+            raise RuntimeError(f"The vector store could not be loaded: {self._load_error}")
+
+    def refresh(self):
+        """Pick up chunks other processes added to or deleted from the shared store.
 
+        Only stats the store files unless something changed; returns True if it did.
+        """
+        if self._load_error is None and not self.store.has_changed():
+            return False
+        with self._write_lock, self.store.lock():
+            return self._catch_up()
+
+    def _catch_up(self):
+        """Bring `self.index` up to date with the store; call with both write locks held."""
+        if self._load_error is not None:
+            self._load()
+            return True
+        if not self.store.has_changed():
+            return False
+        index = copy.copy(self.index)
+        if self.store.catch_up(index, {}):
+            self.index = index
+            self._next_chunk_id = max(self._next_chunk_id, self.store.max_chunk_id + 1)
+        else:
+            # Another process compacted or cleared the store.
+            self._load()
+        return True
+
+    def _stale_model(self):
+        """The embedding model of the stored vectors, if it is not the configured one."""
+        model = self.store.model
+        return model if model is not None and model != _active_embed_model() else None
+
+    def replace_vectors(self, index, model, catch_up):
+        """Publish `index`, holding every chunk's vector from embedding `model`, as the new snapshot.
+
+        `catch_up(index)` runs first under the store lock, while no process can
+        write, and returns `index` updated for chunks stored or deleted
+        meanwhile. Chunk ids and text stay as they are. Used by `reembed.py`.
+        """
+        self._sync_catalog()
+        with self.store.compaction_lock() as acquired:
+            if not acquired:
+                raise RuntimeError("The vector store is being compacted; try again shortly.")
+            with self._write_lock, self.store.lock():
+                self._catch_up()
+                self._require_loaded()
+                index = catch_up(index)
+                wal_seq = self.store.rotate_wal()
+                self.store.model = model
+                self.store.finish_compaction(self.store.stage_snapshot(index, None, wal_seq=wal_seq))
+                self._load()
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        if now - self._refreshed_at < VECTOR_STORE_REFRESH_SECONDS:
+            return
+        self._refreshed_at = now
         try:
-            doc = fitz.open(file_path)
-            return "".join(page.get_text() for page in doc)
-        except Exception as e:
-            logger.warning("PDF fallback extraction failed: %s", e)
-            return ""
+            self.refresh()
+        except Exception:
+            logger.exception("Could not refresh the vector store")
 
-    def _extract_text_from_docx(self, file_path):
-        doc = docx.Document(file_path)
-        return "\n".join(para.text for para in doc.paragraphs)
+    def _sync_catalog(self):
+        """Bring the `document_chunks` table in step with the vector store, once per process.
 
-    def _split_text(self, text):
-        text = re.sub(r"\s+", " ", text).strip()
-        if not text:
-            return []
+        Runs on first use rather than at import, once the database exists. Text
+        from older stores is imported, and rows left by an upload that crashed
+        before its vectors were logged are removed. Only ids above the largest
+        one the store ever logged can be such orphans, so nothing else is
+        touched, and nothing at all while the store can't be read. Writers
+        insert rows and log their vectors under `store.lock()`, so rows another
+        process is still writing are never mistaken for orphans.
+        """
+        if self._catalog_synced:
+            return
+        with self._catalog_lock:
+            if self._catalog_synced:
+                return
+            with self._write_lock, self.store.lock():
+                self._catch_up()
+                if self._load_error is not None:
+                    return
+                if self._legacy_catalog:
+                    imported = database.import_document_chunks(
+                        (chunk_id, int(meta["report_id"]), meta.get("text", ""))
+                        for chunk_id, meta in self._legacy_catalog.items()
+                    )
+                    logger.info("Moved %s chunk texts from the vector store to the database", imported)
+                orphans = database.get_document_chunk_ids(above=self.store.max_chunk_id)
+                if orphans:
+                    logger.warning("Removing %s stored chunks that have no vectors", len(orphans))
+                    database.delete_document_chunks_by_id(orphans)
+            migrated = bool(self._legacy_catalog)
+            self._legacy_catalog = {}
+            self._catalog_synced = True
+        if migrated:
+            # Drop the text from the snapshot now that the database holds it.
+            self.compact()
+
+    @staticmethod
+    def _quantized(index):
+        """`index` with codes matching VECTOR_QUANTIZATION and VECTOR_PREFILTER_DIMS.
+
+        Call before publishing it.
+        """
+        if VECTOR_QUANTIZATION not in QUANTIZATIONS:
+            logger.warning("Ignoring unknown VECTOR_QUANTIZATION=%s", VECTOR_QUANTIZATION)
+            return index
+        codes = index.codes
+        index.set_quantization(VECTOR_QUANTIZATION, dims=VECTOR_PREFILTER_DIMS)
+        if index.codes is not codes and index.codes is not None:
+            logger.info(
+                "Encoded %s stored vectors as %s codes of %s dimensions",
+                index.total_rows, index.quantization, index.code_dims or index.dim,
+            )
+        return index
+
+    def compact(self):
+        """Fold the WAL into a new snapshot, then re-open it memory-mapped.
+
+        Uploads and deletes keep appending to a fresh log while the snapshot is
+        written; only publishing it takes the store lock. Returns False if this
+        or another process is already compacting.
+        """
+        with self._write_lock:
+            if self._compacting:
+                return False
+            self._compacting = True
+        try:
+            with self.store.compaction_lock() as acquired:
+                if not acquired:
+                    return False
+                with self._write_lock, self.store.lock():
+                    self._catch_up()
+                    self._require_loaded()
+                    wal_seq = self.store.rotate_wal()
+                    # Index arrays are replaced, never modified in place, so a shallow copy is a stable view.
+                    index = copy.copy(self.index)
+                    # Until the database holds it, legacy chunk text stays in the snapshot.
+                    catalog = dict(self._legacy_catalog) or None
+                manifest = self.store.stage_snapshot(index, catalog, wal_seq=wal_seq)
+                with self._write_lock, self.store.lock():
+                    self.store.finish_compaction(manifest)
+                    self._load()
+        finally:
+            self._compacting = False
+        return True
+
+    def _maybe_compact(self):
+        if self._compacting or self.store.wal_size() < VECTOR_WAL_COMPACT_BYTES:
+            return
+        threading.Thread(
+            target=self._compact_in_background, name="vector-store-compaction", daemon=True
+        ).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception:
+            logger.exception("Vector store compaction failed")
+
+    def _ann_enabled(self, index=None):
+        index = self.index if index is None else index
+        return VECTOR_INDEX_MODE == "ivf" and len(index) >= IVF_MIN_ROWS
+
+    def build_ann_index(self):
+        """Train the IVF index on the current chunks, attach it, and persist it via compaction.
+
+        Training runs on a copy without the write lock; chunks added meanwhile are
+        assigned to the new lists before it is attached.
+        """
+        with self._write_lock:
+            if self._ann_building:
+                return False
+            self._ann_building = True
+            view = copy.copy(self.index)
+        try:
+            ivf = IVFIndex.train(view, nlist=IVF_NLIST)
+            with self._write_lock:
+                index = copy.copy(self.index)
+                if index.base is not view.base:
+                    # A compaction renumbered the rows meanwhile; the next write retries.
+                    return False
+                if index.total_rows > view.total_rows:
+                    ivf = ivf.extended(index.tail[view.tail.shape[0] :], view.total_rows)
+                index.ivf = ivf
+                self.index = index
+        finally:
+            self._ann_building = False
+        logger.info("Built IVF index with %s lists over %s chunks", ivf.nlist, ivf.trained_rows)
+        self.compact()
+        return True
+
+    def _maybe_build_ann_index(self):
+        if self._ann_building or not self._ann_enabled():
+            return
+        ivf = self.index.ivf
+        # Retrain once the store has grown well past what the centroids were fitted on.
+        if ivf is not None and len(self.index) <= 4 * ivf.trained_rows:
+            return
+        threading.Thread(
+            target=self._build_ann_index_in_background, name="vector-ann-build", daemon=True
+        ).start()
+
+    def _build_ann_index_in_background(self):
+        try:
+            self.build_ann_index()
+        except Exception:
+            logger.exception("Building the IVF index failed")
+
+    def ann_recall(self, sample_size=100, top_k=10, nprobe=None):
+        """Recall@k of IVF search against exact search, using stored chunks as queries."""
+        index = self.index
+        if index.ivf is None or len(index) == 0:
+            return None
+        rng = np.random.default_rng(0)
+        live_rows = np.flatnonzero(index.alive)
+        rows = np.sort(rng.choice(live_rows, min(sample_size, live_rows.shape[0]), replace=False))
+        return recall_at_k(index, index.take(rows), top_k=top_k, nprobe=nprobe or IVF_NPROBE)
+
+    def quantization_recall(self, sample_size=100, top_k=10):
+        """Recall@k of quantized search against float32, with and without rescoring.
+
+        Uses stored chunks as queries; None when the vectors are not quantized.
+        """
+        index = self.index
+        if index.codes is None or len(index) == 0:
+            return None
+        rng = np.random.default_rng(0)
+        live_rows = np.flatnonzero(index.alive)
+        rows = np.sort(rng.choice(live_rows, min(sample_size, live_rows.shape[0]), replace=False))
+        queries = index.take(rows)
+        return {
+            "quantization": index.quantization,
+            "dims": index.code_dims or index.dim,
+            "first_pass": recall_at_k(index, queries, top_k=top_k, nprobe=None, rescore=False),
+            "rescored": recall_at_k(
+                index, queries, top_k=top_k, nprobe=None, rescore=True, candidates=VECTOR_RESCORE_CANDIDATES
+            ),
+        }
+
+    def _after_write(self):
+        self._maybe_compact()
+        self._maybe_build_ann_index()
+
+    def clear(self):
+        """Remove every stored chunk and vector, on disk and in memory."""
+        with self._write_lock, self.store.lock():
+            self.store.clear()
+            self.index, self._legacy_catalog = self._quantized(VectorIndex()), {}
+            self._load_error = None
+            self.embedding_cache = self._open_embedding_cache()
+            database.delete_all_document_chunks()
+
+    def _iter_pages(self, file_path):
+        """Yield the text of each page (PDF) or paragraph (DOCX) of `file_path`."""
+        suffix = Path(file_path).suffix.lower()
+        if suffix == ".pdf":
+            return self._iter_pdf_pages(file_path)
+        if suffix in [".doc", ".docx"]:
+            return self._iter_docx_pages(file_path)
+        raise ValueError(f"Unsupported document type: {suffix}")
+
+    def _iter_pdf_pages(self, file_path):
+        total = self._parse(document_parser.pdf_page_count, file_path)
+        if PARSE_MAX_PAGES and total > PARSE_MAX_PAGES:
+            raise ValueError(f"Document has {total} pages; the limit is {PARSE_MAX_PAGES}.")
+
+        found_text = False
+        for text in self._parse_pages(document_parser.extract_pdf_pages, file_path, total):
+            found_text = found_text or bool(text.strip())
+            yield text
+        if not found_text:
+            # Scanned or oddly encoded PDFs: PyMuPDF often recovers text pypdf misses.
+            yield from self._parse_pages(document_parser.extract_pdf_pages_fitz, file_path, total)
+
+    def _iter_docx_pages(self, file_path):
+        yield from self._parse(document_parser.extract_docx_paragraphs, file_path)
+
+    def _parse(self, function, *args):
+        return self._parse_result(self._submit_parse(function, *args))
+
+    def _parse_pages(self, extract, file_path, total):
+        """Extract pages in ranges of PARSE_PAGES_PER_TASK, a few ranges ahead of the reader.
+
+        Each range gets PARSE_TIMEOUT_SECONDS from its own submission, so time
+        the reader spends on the pages already yielded (embedding them) does
+        not count against the parse.
+        """
+        window = max(1, PARSE_WORKERS)
+        pending = deque()
+        try:
+            for start in range(0, total, PARSE_PAGES_PER_TASK):
+                pending.append(self._submit_parse(extract, file_path, start, start + PARSE_PAGES_PER_TASK))
+                if len(pending) >= window:
+                    yield from self._parse_result(pending.popleft())
+            while pending:
+                yield from self._parse_result(pending.popleft())
+        finally:
+            for task in pending:
+                task.future.cancel()
+
+    def _submit_parse(self, function, *args):
+        """Start `function(*args)` in a parse worker; returns the task to pass to `_parse_result`."""
+        task = _ParseTask(function, [str(arg) if isinstance(arg, Path) else arg for arg in args])
+        self._start_parse(task)
+        return task
+
+    def _start_parse(self, task):
+        """(Re)submit `task`, giving it PARSE_TIMEOUT_SECONDS from now."""
+        task.deadline = time.monotonic() + PARSE_TIMEOUT_SECONDS
+        if not PARSE_WORKERS:
+            task.future = Future()
+            try:
+                task.future.set_result(task.function(*task.args))
+            except Exception as e:
+                task.future.set_exception(e)
+            return
+        while True:
+            with self._parse_lock:
+                if self._parse_pool is None:
+                    self._parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=_PARSE_CONTEXT)
+                task.pool = self._parse_pool
+            try:
+                task.future = task.pool.submit(task.function, *task.args)
+                return
+            except RuntimeError:  # BrokenProcessPool, or the pool was shut down meanwhile
+                if task.pool not in self._timed_out_parse_pools:
+                    self._reset_parse_pool(task.pool)
+                    raise
+
+    def _parse_result(self, task):
+        while True:
+            try:
+                return task.future.result(timeout=max(0.0, task.deadline - time.monotonic()))
+            except FutureTimeoutError:
+                # The stuck worker keeps its core busy until it is killed, and
+                # a process pool can only be stopped as a whole.
+                with self._parse_lock:
+                    self._timed_out_parse_pools.add(task.pool)
+                self._reset_parse_pool(task.pool)
+                raise TimeoutError(f"Document parsing took longer than {PARSE_TIMEOUT_SECONDS} seconds.") from None
+            except (BrokenProcessPool, CancelledError):
+                if task.pool not in self._timed_out_parse_pools:
+                    # The next submit replaces the broken pool.
+                    raise RuntimeError("A document parser process crashed or was stopped.") from None
+            # Another document timed out and took this task's workers with it.
+            self._start_parse(task)
+
+    def _reset_parse_pool(self, pool=None):
+        """Kill the workers of `pool` (default: the current pool); the next task starts a fresh one."""
+        with self._parse_lock:
+            if pool is not None and pool is not self._parse_pool:
+                return
+            pool, self._parse_pool = self._parse_pool, None
+        if pool is None:
+            return
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _iter_chunks(self, pages):
+        """Split a stream of page texts into overlapping chunks.
+
+        Whitespace is collapsed per page and pages are joined with a single
+        space; only the unchunked tail of the text is held in memory.
+        """
+        buffer = ""
+        for page in pages:
+            text = " ".join(page.split())
+            if not text:
+                continue
+            buffer = f"{buffer} {text}" if buffer else text
+            cursor = 0
+            # Only cut chunks that cannot be the last one; the tail waits for more text.
+            while cursor + CHUNK_SIZE < len(buffer):
+                end = cursor + CHUNK_SIZE
+                piece = buffer[cursor:end].strip()
+                if piece:
+                    yield piece
+                cursor = max(end - CHUNK_OVERLAP, cursor + 1)
+            buffer = buffer[cursor:]
 
-        chunks = []
         cursor = 0
-        chunk_size = 900
-        overlap = 120
-        while cursor < len(text):
-            end = min(len(text), cursor + chunk_size)
-            piece = text[cursor:end].strip()
+        while cursor < len(buffer):
+            end = min(len(buffer), cursor + CHUNK_SIZE)
+            piece = buffer[cursor:end].strip()
             if piece:
-                chunks.append(piece)
-            if end >= len(text):
+                yield piece
+            if end >= len(buffer):
                 break
-            cursor = max(end - overlap, cursor + 1)
-        return chunks
+            cursor = max(end - CHUNK_OVERLAP, cursor + 1)
+
+    def _split_text(self, text):
+        return list(self._iter_chunks([text]))
+
+    def embed_texts(self, texts):
+        """Embed chunk texts with the configured model, one vector per text (not normalized).
+
+        Goes through the chunk embedding cache; for tools such as `reembed.py`.
+        """
+        return self._embed_many(list(texts))
 
     def _embed_many(self, texts):
+        """Embed `texts`, sending only embedding-cache misses to the provider."""
+        if not texts:
+            return []
+        if self.embedding_cache is None:
+            return self._embed_many_uncached(texts)
+        model = _active_embed_model()
+        vectors = self.embedding_cache.get_many(model, texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            fresh = dict(zip(missing, self._embed_many_uncached(missing)))
+            self.embedding_cache.put_many(model, missing, [fresh[text] for text in missing])
+            vectors = [fresh[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def _embed_query(self, query):
+        """Embed a search query, reusing recent vectors for repeated questions.
+
+        Queries stay out of the on-disk chunk cache: writing each one there
+        would cost a disk write per search and push out chunk vectors.
+        """
+        if self.query_cache is None:
+            return self._embed_many_uncached([query])[0]
+        key = (_active_embed_model(), normalize_query(query))
+        vector = self.query_cache.get(key)
+        if vector is None:
+            started = time.perf_counter()
+            vector = self._embed_many_uncached([query])[0]
+            self.query_cache.put(key, vector, (time.perf_counter() - started) * 1000)
+        return vector
+
+    def cache_stats(self):
+        """Hit/miss counters of the chunk embedding cache and the query cache."""
+        return {
+            "embedding_cache": self.embedding_cache.stats() if self.embedding_cache else None,
+            "query_cache": self.query_cache.stats() if self.query_cache else None,
+        }
+
+    def _embed_many_uncached(self, texts):
         """Route embeddings to Ollama or LM Studio based on `LLM_PROVIDER`."""
         if not texts:
             return []
@@ -110,29 +796,21 @@ class DocumentProcessor:
         if LM_STUDIO_API_KEY:
             headers["Authorization"] = f"Bearer {LM_STUDIO_API_KEY}"
 
-        all_vectors: list[list[float]] = []
-        for start in range(0, len(texts), _LM_STUDIO_EMBED_BATCH_SIZE):
-            batch = texts[start : start + _LM_STUDIO_EMBED_BATCH_SIZE]
-            response = requests.post(
-                url,
-                headers=headers,
-                json={"model": LM_STUDIO_EMBED_MODEL, "input": batch},
-                timeout=120,
+        def post_batch(batch):
+            data = self.embedding_client.post_json(
+                url, {"model": LM_STUDIO_EMBED_MODEL, "input": batch}, headers=headers
             )
-            response.raise_for_status()
-            data = response.json()
             items = data.get("data") or []
             items.sort(key=lambda x: int(x.get("index", 0)))
+            vectors = []
             for item in items:
                 vector = item.get("embedding")
                 if not vector:
                     raise RuntimeError("LM Studio returned an empty embedding vector.")
-                all_vectors.append(vector)
-            if len(items) != len(batch):
-                raise RuntimeError(
-                    f"Embedding batch size mismatch: sent {len(batch)}, got {len(items)} vectors."
-                )
+                vectors.append(vector)
+            return vectors
 
+        all_vectors = self.embedding_client.embed(texts, post_batch)
         if len(all_vectors) != len(texts):
             raise RuntimeError(
                 f"Embedding count mismatch: expected {len(texts)}, got {len(all_vectors)}."
@@ -140,120 +818,279 @@ class DocumentProcessor:
         return all_vectors
 
     def _embed_many_ollama(self, texts):
-        """Ollama `/api/embed` batch, then `/api/embeddings` per text if needed."""
-        try:
-            response = requests.post(
-                f"{OLLAMA_BASE_URL}/api/embed",
-                json={"model": OLLAMA_EMBED_MODEL, "input": texts},
-                timeout=120,
-            )
-            response.raise_for_status()
-            data = response.json()
-            embeddings = data.get("embeddings") or []
-            if embeddings and len(embeddings) == len(texts):
-                return embeddings
-        except Exception as e:
-            logger.debug("Ollama batch embed failed, falling back per text: %s", e)
-
-        out: list[list[float]] = []
-        for text in texts:
-            response = requests.post(
-                f"{OLLAMA_BASE_URL}/api/embeddings",
-                json={"model": OLLAMA_EMBED_MODEL, "prompt": text},
-                timeout=120,
-            )
-            response.raise_for_status()
-            data = response.json()
-            vector = data.get("embedding")
-            if not vector:
-                raise RuntimeError("Ollama returned an empty embedding vector.")
-            out.append(vector)
-        return out
-
-    def _cosine_similarity(self, left, right):
-        left_norm = math.sqrt(sum(x * x for x in left))
-        right_norm = math.sqrt(sum(x * x for x in right))
-        if left_norm == 0 or right_norm == 0:
-            return -1.0
-        dot = sum(x * y for x, y in zip(left, right))
-        return dot / (left_norm * right_norm)
+        """Ollama `/api/embed` batches, then `/api/embeddings` per text if needed."""
 
-    def process_and_embed_document(self, file_path, report_id):
-        try:
-            file_path = Path(file_path)
+        def post_batch(batch):
+            try:
+                data = self.embedding_client.post_json(
+                    f"{OLLAMA_BASE_URL}/api/embed", {"model": OLLAMA_EMBED_MODEL, "input": batch}
+                )
+                embeddings = data.get("embeddings") or []
+                if embeddings and len(embeddings) == len(batch):
+                    return embeddings
+            except Exception as e:
+                logger.debug("Ollama batch embed failed, falling back per text: %s", e)
+            return [self._embed_one_ollama(text) for text in batch]
+
+        return self.embedding_client.embed(texts, post_batch)
+
+    def _embed_one_ollama(self, text):
+        data = self.embedding_client.post_json(
+            f"{OLLAMA_BASE_URL}/api/embeddings", {"model": OLLAMA_EMBED_MODEL, "prompt": text}
+        )
+        vector = data.get("embedding")
+        if not vector:
+            raise RuntimeError("Ollama returned an empty embedding vector.")
+        return vector
+
+    def _add_chunks(self, report_id, chunks, embeddings):
+        """Store chunk text in the database, then log the vectors to the WAL and add them to the index.
+
+        The database allocates the chunk ids. If the process dies before the WAL
+        append, `_sync_catalog` removes the text rows on the next start.
+        """
+        self._sync_catalog()
+        vectors = normalize_rows(embeddings)
+        with self._write_lock, self.store.lock():
+            self._catch_up()
+            self._require_loaded()
+            if self.index.total_rows and vectors.shape[1] != self.index.dim:
+                raise ValueError(
+                    f"Embedding dimension mismatch: index has {self.index.dim}, got {vectors.shape[1]}."
+                )
+            stale_model = self._stale_model()
+            if stale_model and len(self.index):
+                raise ValueError(
+                    f"The vector store holds {stale_model} embeddings but {_active_embed_model()} is "
+                    "configured; run `python reembed.py` to re-embed the stored documents."
+                )
+            if self.store.model != _active_embed_model():
+                # Stores from before the model was recorded are assumed to match the configuration.
+                self.store.record_model(_active_embed_model())
+            chunk_ids = database.add_document_chunks(report_id, list(chunks), min_id=self._next_chunk_id)
+            try:
+                self.store.append_add(report_id, chunk_ids, vectors)
+            except Exception:
+                database.delete_document_chunks_by_id(chunk_ids)
+                raise
+            index = copy.copy(self.index)
+            index.add(chunk_ids, [report_id] * len(chunk_ids), vectors)
+            self.index = index
+            self._next_chunk_id = chunk_ids[-1] + 1
+        self._after_write()
+        return chunk_ids
+
+    def embed_document(self, file_path, report_id):
+        """Extract, chunk and embed a report, replacing any chunks it already has.
+
+        Pages are parsed on a background thread while earlier chunks are being
+        embedded, and chunks are stored in batches of `INGEST_BATCH_CHUNKS`.
+        Extracted text is kept in the `report_pages` table, so processing the
+        report again does not parse the file again.
+        Returns the number of chunks stored; raises on any failure.
+        """
+        file_path = Path(file_path)
+        if database.has_report_pages(report_id):
+            pages = database.iter_report_pages(report_id)
+        else:
             if not file_path.exists():
                 raise FileNotFoundError(f"File not found: {file_path}")
+            pages = self._cached_pages(report_id, self._iter_pages(file_path))
 
-            if file_path.suffix.lower() == ".pdf":
-                text = self._extract_text_from_pdf(file_path)
-            elif file_path.suffix.lower() in [".doc", ".docx"]:
-                text = self._extract_text_from_docx(file_path)
-            else:
-                return
+        self.refresh()
+        # A retried job may have stored chunks before it was interrupted.
+        if int(report_id) in self.index.report_ranges:
+            self.delete_document(report_id)
 
-            chunks = self._split_text(text)
-            if not chunks:
-                return
+        chunk_count = 0
+        try:
+            for chunks in _prefetch(_batched(self._iter_chunks(pages), INGEST_BATCH_CHUNKS)):
+                self._add_chunks(report_id, chunks, self._embed_many(chunks))
+                chunk_count += len(chunks)
+        except BaseException:
+            if chunk_count:
+                self.delete_document(report_id)
+            raise
+        if not chunk_count:
+            raise ValueError("No extractable text was found in the document.")
 
-            embeddings = self._embed_many(chunks)
-            start_id = max(self.metadata.keys()) + 1 if self.metadata else 1
+        if self.embedding_cache is not None:
+            logger.info("Embedded report %s; embedding cache: %s", report_id, self.embedding_cache.stats())
+        database.mark_report_as_processed(report_id)
+        return chunk_count
 
-            for index, chunk in enumerate(chunks):
-                chunk_id = start_id + index
-                self.metadata[chunk_id] = {
-                    "report_id": report_id,
-                    "text": chunk,
-                    "embedding": embeddings[index],
-                }
+    @staticmethod
+    def _cached_pages(report_id, pages):
+        """Yield `pages`, storing their text in batches as they go by.
+
+        The cache is only read back once the whole document went through, so
+        an interrupted extraction is parsed again next time.
+        """
+        if not database.start_report_pages(report_id):
+            yield from pages
+            return
+        batch, next_page = [], 0
+        for page in pages:
+            text = " ".join(page.split())
+            if text:
+                batch.append(text)
+                if len(batch) >= PARSE_PAGES_PER_TASK:
+                    database.add_report_pages(report_id, next_page, batch)
+                    next_page, batch = next_page + len(batch), []
+            yield page
+        database.add_report_pages(report_id, next_page, batch)
+        database.finish_report_pages(report_id)
 
-            self._save()
-            database.mark_report_as_processed(report_id)
+    def process_and_embed_document(self, file_path, report_id):
+        try:
+            return self.embed_document(file_path, report_id)
         except Exception as e:
             logger.exception("Error processing document %s", file_path)
+            return None
+
+    @staticmethod
+    def _resolve_report_filter(report_ids=None, user_id=None):
+        """Combine the `report_ids` / `user_id` filters into a set of report ids, or None."""
+        allowed = None
+        if report_ids is not None:
+            allowed = set()
+            for report_id in report_ids:
+                try:
+                    allowed.add(int(report_id))
+                except (TypeError, ValueError):
+                    continue
+        if user_id is not None:
+            owned = set(database.get_report_ids_for_user(user_id))
+            allowed = owned if allowed is None else allowed & owned
+        return allowed
+
+    def search_in_documents(self, query: str, top_k=5, report_ids=None, user_id=None, mode=None):
+        """Return the `top_k` chunks that best match `query`.
 
-    def search_in_documents(self, query: str, top_k=5):
-        if not self.metadata:
+        `mode` is "vector", "lexical" or "hybrid" (default `DOCUMENT_SEARCH_MODE`).
+        `report_ids` and/or `user_id` restrict the search to those reports; only
+        their rows are scored, so cost follows the size of the selection.
+        A blank query returns the first chunks in upload order.
+        """
+        mode = (mode or DOCUMENT_SEARCH_MODE).strip().lower()
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        self._maybe_refresh()
+        if len(self.index) == 0:
             return []
+        self._sync_catalog()
+        # One snapshot for the whole query; writers publish new ones instead of mutating it.
+        index = self.index
+        allowed = self._resolve_report_filter(report_ids, user_id)
+        if allowed is not None and not allowed:
+            return []
+        filter_ids = sorted(allowed) if allowed is not None else None
 
         if not (query or "").strip():
-            results = []
-            for chunk_id in sorted(self.metadata.keys())[:top_k]:
-                meta = self.metadata.get(chunk_id, {})
-                results.append(
-                    {
-                        "text": meta.get("text", ""),
-                        "report_id": meta.get("report_id"),
-                        "score": None,
-                    }
-                )
-            return results
+            return [
+                {"text": chunk["text"], "report_id": chunk["report_id"], "score": None}
+                for chunk in database.get_first_document_chunks(top_k, filter_ids)
+            ]
 
-        query_vector = self._embed_many([query])[0]
-        scored = []
-        for meta in self.metadata.values():
-            embedding = meta.get("embedding")
-            if not embedding:
-                continue
-            scored.append(
-                {
-                    "text": meta["text"],
-                    "report_id": meta["report_id"],
-                    "score": self._cosine_similarity(query_vector, embedding),
-                }
+        if mode == "lexical":
+            return self._keyword_results(query, top_k, filter_ids)
+        stale_model = self._stale_model()
+        if stale_model:
+            logger.warning(
+                "Stored vectors come from %s, not %s; answering with keyword search until `reembed.py` runs",
+                stale_model, _active_embed_model(),
             )
+            return self._keyword_results(query, top_k, filter_ids)
 
-        scored.sort(key=lambda item: item["score"], reverse=True)
-        return scored[:top_k]
+        try:
+            query_vector = self._embed_query(query)
+        except Exception as e:
+            if mode != "hybrid":
+                raise
+            logger.warning("Query embedding failed, answering with keyword search only: %s", e)
+            return self._keyword_results(query, top_k, filter_ids)
 
-    def delete_document(self, report_id_to_delete):
-        ids_to_remove = [
-            chunk_id
-            for chunk_id, meta in self.metadata.items()
-            if meta.get("report_id") == report_id_to_delete
+        if mode == "vector":
+            return self._with_text(self._vector_search(index, query_vector, top_k, filter_ids))
+
+        candidates = max(top_k, HYBRID_CANDIDATES)
+        vector_hits = self._vector_search(index, query_vector, candidates, filter_ids)
+        lexical_hits = self._lexical_search(query, candidates, filter_ids)
+        report_of = {chunk_id: report_id for chunk_id, report_id, _ in vector_hits}
+        text_of = {}
+        for hit in lexical_hits:
+            report_of[hit["id"]] = hit["report_id"]
+            text_of[hit["id"]] = hit["text"]
+        fused = reciprocal_rank_fusion(
+            [[chunk_id for chunk_id, _, _ in vector_hits], [hit["id"] for hit in lexical_hits]]
+        )[:top_k]
+        return self._with_text(
+            [(chunk_id, report_of[chunk_id], score) for chunk_id, score in fused], known=text_of
+        )
+
+    def _vector_search(self, index, query_vector, top_k, report_ids=None):
+        nprobe = IVF_NPROBE if self._ann_enabled(index) else None
+        # IVF probing only applies to whole-store searches; filtered ones score their reports exactly.
+        if self.search_batcher is not None and (report_ids is not None or nprobe is None):
+            return self.search_batcher.search(
+                index,
+                query_vector,
+                top_k,
+                report_ids=report_ids,
+                rescore=VECTOR_RESCORE,
+                candidates=VECTOR_RESCORE_CANDIDATES,
+            )
+        return index.search(
+            query_vector,
+            top_k,
+            report_ids=report_ids,
+            nprobe=nprobe,
+            rescore=VECTOR_RESCORE,
+            candidates=VECTOR_RESCORE_CANDIDATES,
+        )
+
+    @staticmethod
+    def _lexical_search(query, limit, report_ids=None):
+        match = match_expression(query)
+        if match is None:
+            return []
+        return database.search_document_chunks(match, limit, report_ids)
+
+    def _keyword_results(self, query, top_k, report_ids=None):
+        return [
+            {"text": hit["text"], "report_id": hit["report_id"], "score": hit["score"]}
+            for hit in self._lexical_search(query, top_k, report_ids)
+        ]
+
+    @staticmethod
+    def _with_text(hits, known=None):
+        """Results for `(chunk_id, report_id, score)` hits, loading only the missing chunk text."""
+        texts = dict(known or {})
+        missing = [chunk_id for chunk_id, _, _ in hits if chunk_id not in texts]
+        texts.update(database.get_document_chunk_texts(missing))
+        return [
+            {"text": texts.get(chunk_id, ""), "report_id": report_id, "score": score}
+            for chunk_id, report_id, score in hits
         ]
-        for chunk_id in ids_to_remove:
-            self.metadata.pop(chunk_id, None)
-        self._save()
+
+    def delete_document(self, report_id_to_delete):
+        self.delete_documents([report_id_to_delete])
+
+    def delete_documents(self, report_ids):
+        """Tombstone every chunk of `report_ids` with a single WAL record."""
+        report_ids = [int(r) for r in report_ids]
+        if not report_ids:
+            return
+        self._sync_catalog()
+        with self._write_lock, self.store.lock():
+            self._catch_up()
+            self._require_loaded()
+            self.store.append_tombstone(report_ids)
+            index = copy.copy(self.index)
+            index.remove_reports(report_ids)
+            self.index = index
+            database.delete_document_chunks(report_ids)
+        self._after_write()
 
 
-processor = DocumentProcessor()
+processor = RetrievalClient(RETRIEVAL_SERVICE_URL) if RETRIEVAL_SERVICE_URL else DocumentProcessor()
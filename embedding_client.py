@@ -0,0 +1,148 @@
+"""Pooled HTTP client that keeps the embedding server busy.
+
+Texts are packed into batches by total characters, so a batch of short chunks
+is as large as the server accepts and a batch of long ones stays small. Up to
+`max_in_flight` batches are posted concurrently over one keep-alive
+connection pool.
+"""
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# A 400 only means "batch too large" when its body says so (servers differ in wording);
+# anything else, such as a bad model name, is not helped by splitting.
+_OVERSIZED_MESSAGE = re.compile(
+    r"context|too (large|long|many)|exceed|maximum|max_?(tokens|length|size)|payload", re.IGNORECASE
+)
+
+
+def _is_oversized(error: requests.HTTPError) -> bool:
+    response = error.response
+    if response is None:
+        return False
+    if response.status_code == 413:
+        return True
+    if response.status_code != 400:
+        return False
+    try:
+        body = response.text
+    except Exception:
+        return False
+    return isinstance(body, str) and bool(_OVERSIZED_MESSAGE.search(body))
+
+
+def plan_batches(texts, max_chars, max_items):
+    """Split `texts` into consecutive (start, stop) ranges under both budgets.
+
+    A single text longer than `max_chars` still gets a batch of its own.
+    """
+    batches = []
+    start, chars = 0, 0
+    for position, text in enumerate(texts):
+        size = len(text)
+        if position > start and (chars + size > max_chars or position - start >= max_items):
+            batches.append((start, position))
+            start, chars = position, 0
+        chars += size
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+class EmbeddingClient:
+    """Posts embedding batches concurrently through a shared `requests.Session`.
+
+    When the server rejects a batch as too large, the batch is split in half
+    and the character budget for later batches shrinks to match. After
+    `recover_after` batches in a row succeed, the budget doubles again, up to
+    the configured `max_batch_chars`.
+    """
+
+    def __init__(self, max_in_flight=4, max_batch_chars=48000, max_batch_items=64, timeout=120, recover_after=20):
+        self.max_in_flight = max_in_flight
+        self.max_batch_chars = max_batch_chars
+        self.configured_batch_chars = max_batch_chars
+        self.max_batch_items = max_batch_items
+        self.recover_after = recover_after
+        self._successes = 0
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def post_json(self, url, payload, headers=None):
+        response = self.session.post(url, json=payload, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def embed(self, texts, post_batch):
+        """Embed `texts` in order; `post_batch(batch)` returns one vector per text."""
+        texts = list(texts)
+        batches = plan_batches(texts, self.max_batch_chars, self.max_batch_items)
+        if len(batches) <= 1:
+            return self._run_batch(texts, post_batch)
+        futures = [
+            self._pool().submit(self._run_batch, texts[start:stop], post_batch) for start, stop in batches
+        ]
+        vectors = []
+        for future in futures:
+            vectors.extend(future.result())
+        return vectors
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        self.session.close()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_in_flight, thread_name_prefix="embed"
+                )
+            return self._executor
+
+    def _run_batch(self, batch, post_batch):
+        try:
+            vectors = post_batch(batch)
+        except requests.HTTPError as e:
+            # A single text can't be split further; let the caller see the server's error.
+            if len(batch) < 2 or not _is_oversized(e):
+                raise
+            middle = len(batch) // 2
+            budget = max(1, sum(len(text) for text in batch) // 2)
+            with self._lock:
+                self.max_batch_chars = min(self.max_batch_chars, budget)
+                self._successes = 0
+            logger.info(
+                "Embedding batch of %s texts rejected (HTTP %s); splitting and lowering the batch budget to %s chars",
+                len(batch), e.response.status_code, self.max_batch_chars,
+            )
+            # Split on this thread: waiting on the pool from inside it could deadlock.
+            return self._run_batch(batch[:middle], post_batch) + self._run_batch(batch[middle:], post_batch)
+        if len(vectors) != len(batch):
+            raise RuntimeError(f"Embedding batch size mismatch: sent {len(batch)}, got {len(vectors)} vectors.")
+        self._record_success()
+        return vectors
+
+    def _record_success(self):
+        with self._lock:
+            if self.max_batch_chars >= self.configured_batch_chars:
+                return
+            self._successes += 1
+            if self._successes < self.recover_after:
+                return
+            self._successes = 0
+            self.max_batch_chars = min(self.configured_batch_chars, self.max_batch_chars * 2)
+        logger.info("Raised the embedding batch budget back to %s chars", self.max_batch_chars)
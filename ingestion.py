@@ -0,0 +1,186 @@
+"""Background ingestion of uploaded reports.
+
+Uploads are recorded as rows in the `ingestion_jobs` table and picked up by a
+small pool of worker threads, so the upload request returns immediately and a
+restart resumes whatever was still queued or in progress.
+
+Every process that serves the app runs its own queue against the same table.
+A worker holds the job it claimed through a lease it keeps renewing; only jobs
+whose lease ran out (their process died) are handed to another worker. A job
+that fails is queued again after a growing delay until it has used up its
+attempts, unless the document itself was rejected (a `ValueError`).
+"""
+import logging
+import os
+import socket
+import threading
+
+import database
+
+logger = logging.getLogger(__name__)
+
+try:
+    INGESTION_WORKERS = max(1, int(os.getenv("INGESTION_WORKERS", "2")))
+except ValueError:
+    INGESTION_WORKERS = 2
+try:
+    INGESTION_MAX_ATTEMPTS = max(1, int(os.getenv("INGESTION_MAX_ATTEMPTS", "3")))
+except ValueError:
+    INGESTION_MAX_ATTEMPTS = 3
+try:
+    INGESTION_LEASE_SECONDS = max(3, int(os.getenv("INGESTION_LEASE_SECONDS", "60")))
+except ValueError:
+    INGESTION_LEASE_SECONDS = 60
+try:
+    INGESTION_RETRY_SECONDS = max(0, int(os.getenv("INGESTION_RETRY_SECONDS", "30")))
+except ValueError:
+    INGESTION_RETRY_SECONDS = 30
+
+# How often idle workers look for jobs queued by other processes.
+POLL_INTERVAL_SECONDS = 5.0
+
+
+class IngestionQueue:
+    """SQLite-backed job queue drained by in-process worker threads."""
+
+    def __init__(self, processor, upload_folder, workers=INGESTION_WORKERS):
+        self.processor = processor
+        self.upload_folder = upload_folder
+        self.workers = workers
+        self._threads: list[threading.Thread] = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for number in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"ingestion-worker-{number}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+    def submit(self, report_id, file_path):
+        """Queue a report for extraction and embedding; returns the job id."""
+        job_id = database.enqueue_ingestion_job(report_id, file_path)
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    @staticmethod
+    def owner():
+        """Identifies this process as the holder of the jobs it claims."""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def recover(self):
+        """Re-queue reports left unprocessed by a previous run; returns how many were queued.
+
+        Jobs other live processes are working on are left alone: only expired
+        leases are released.
+        """
+        requeued = database.release_expired_ingestion_jobs(INGESTION_MAX_ATTEMPTS)
+        for report in database.get_unprocessed_reports():
+            job = database.get_latest_ingestion_job(report['id'])
+            if job is not None and job['status'] in ('queued', 'processing'):
+                continue
+            if job is not None and job['status'] == 'failed' and job['attempts'] >= INGESTION_MAX_ATTEMPTS:
+                continue
+            if job is not None and job['status'] == 'failed':
+                database.requeue_ingestion_job(job['id'])
+            else:
+                database.enqueue_ingestion_job(
+                    report['id'], os.path.join(self.upload_folder, report['stored_filename'])
+                )
+            requeued += 1
+        if requeued:
+            logger.info("Re-queued %s interrupted ingestion jobs", requeued)
+            self._wakeup.set()
+        return requeued
+
+    def run_pending(self):
+        """Process queued jobs on the calling thread until none are left."""
+        processed = 0
+        while True:
+            job = database.claim_next_ingestion_job(self.owner(), INGESTION_LEASE_SECONDS)
+            if job is None:
+                return processed
+            self._process(job)
+            processed += 1
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = database.claim_next_ingestion_job(self.owner(), INGESTION_LEASE_SECONDS)
+                if job is None and database.release_expired_ingestion_jobs(INGESTION_MAX_ATTEMPTS):
+                    continue
+            except Exception:
+                logger.exception("Could not claim an ingestion job")
+                job = None
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL_SECONDS)
+                self._wakeup.clear()
+                continue
+            self._process(job)
+
+    def _process(self, job):
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._renew_lease, args=(job, stop), name=f"ingestion-lease-{job['id']}", daemon=True
+        )
+        heartbeat.start()
+        try:
+            chunk_count = self.processor.embed_document(job['file_path'], job['report_id'])
+        except ValueError as e:
+            # The document itself was rejected (unsupported, too long, no text): retrying won't help.
+            logger.warning("Ingestion of report %s failed: %s", job['report_id'], e)
+            self._finish(job, 'failed', str(e))
+            return
+        except Exception as e:
+            if job['attempts'] < INGESTION_MAX_ATTEMPTS:
+                self._retry(job, e)
+            else:
+                logger.exception("Ingestion of report %s failed", job['report_id'])
+                self._finish(job, 'failed', str(e))
+            return
+        finally:
+            stop.set()
+            heartbeat.join()
+        logger.info("Ingested report %s (%s chunks)", job['report_id'], chunk_count)
+        self._finish(job, 'done')
+
+    @staticmethod
+    def _retry(job, error):
+        delay = INGESTION_RETRY_SECONDS * 2 ** (job['attempts'] - 1)
+        logger.warning(
+            "Ingestion of report %s failed (attempt %s of %s), retrying in %ss: %s",
+            job['report_id'], job['attempts'], INGESTION_MAX_ATTEMPTS, delay, error,
+        )
+        if not database.retry_ingestion_job(job['id'], job.get('owner'), str(error), delay):
+            logger.warning("Lost the lease on ingestion job %s before it finished", job['id'])
+
+    @staticmethod
+    def _finish(job, status, error=None):
+        if not database.finish_ingestion_job(job['id'], status, error, owner=job.get('owner')):
+            logger.warning("Lost the lease on ingestion job %s before it finished", job['id'])
+
+    @staticmethod
+    def _renew_lease(job, stop):
+        while not stop.wait(INGESTION_LEASE_SECONDS / 3):
+            try:
+                if not database.renew_ingestion_lease(job['id'], job['owner'], INGESTION_LEASE_SECONDS):
+                    logger.warning("Lost the lease on ingestion job %s", job['id'])
+                    return
+            except Exception:
+                logger.exception("Could not renew the lease on ingestion job %s", job['id'])
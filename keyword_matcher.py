@@ -0,0 +1,95 @@
+"""Find every occurrence of many keywords in one pass over a text (Aho-Corasick).
+
+Keywords and text are compared after `fold_turkish`, so "İzin", "izin" and
+"IZIN" all match each other, as do "ücret" and "ucret".
+"""
+from typing import Dict, Hashable, List, Tuple
+
+# Turkish letters whose case mapping differs from the default (I/ı, İ/i) or that
+# users often type without their diacritics.
+_TURKISH_FOLD = str.maketrans({
+    "I": "i", "İ": "i", "ı": "i",
+    "Ç": "c", "ç": "c",
+    "Ş": "s", "ş": "s",
+    "Ö": "o", "ö": "o",
+    "Ü": "u", "ü": "u",
+    "Ğ": "g", "ğ": "g",
+    "Â": "a", "â": "a",
+    "Î": "i", "î": "i",
+    "Û": "u", "û": "u",
+})
+
+
+def fold_turkish(text: str) -> str:
+    """Lower-case `text` and drop Turkish diacritics, keeping one character per character."""
+    folded = text.translate(_TURKISH_FOLD)
+    lowered = folded.lower()
+    if len(lowered) != len(folded):
+        # A few characters lower-case to two; leave those alone so match offsets stay valid.
+        lowered = "".join(char.lower() if len(char.lower()) == 1 else char for char in folded)
+    return lowered
+
+
+class KeywordMatcher:
+    """An Aho-Corasick automaton over folded keywords, each carrying a value.
+
+    Add every keyword, then call `find`; adding after `build` (or the first `find`) rebuilds the links.
+    """
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        # Keywords spelled out by the path to each state: (length, keyword, value).
+        self._own: List[List[Tuple[int, str, Hashable]]] = [[]]
+        # Filled by `_build`: failure links, and every keyword ending at each state.
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[int, str, Hashable]]] = [[]]
+        self._built = True
+
+    def __len__(self):
+        return sum(len(own) for own in self._own)
+
+    def add(self, keyword: str, value: Hashable):
+        folded = fold_turkish(keyword.strip())
+        if not folded:
+            return
+        state = 0
+        for char in folded:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._own.append([])
+            state = next_state
+        self._own[state].append((len(folded), keyword.strip(), value))
+        self._built = False
+
+    def build(self):
+        # Breadth-first, so a state's failure target is finished before the state itself.
+        self._fail = [0] * len(self._goto)
+        self._out = [list(own) for own in self._own]
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] += self._out[self._fail[next_state]]
+                queue.append(next_state)
+        self._built = True
+
+    def find(self, text: str) -> List[Tuple[int, int, str, Hashable]]:
+        """`(start, end, keyword, value)` for every keyword occurrence in `text`, by end offset."""
+        if not self._built:
+            self.build()
+        matches = []
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for position, char in enumerate(fold_turkish(text)):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, keyword, value in out[state]:
+                matches.append((position + 1 - length, position + 1, keyword, value))
+        return matches
@@ -0,0 +1,30 @@
+"""Query helpers for the BM25 keyword index over document chunks.
+
+Exact terms such as policy numbers, form codes and names rank poorly by
+embedding similarity; the `document_chunks_fts` FTS5 table finds them
+without an embedding round-trip.
+"""
+import re
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def match_expression(query: str):
+    """FTS5 query matching any word of `query`, or None if it has no words."""
+    tokens = list(dict.fromkeys(_TOKEN_RE.findall(query or "")))
+    if not tokens:
+        return None
+    return " OR ".join(f'"{token}"' for token in tokens)
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merge ranked lists of keys into one list of `(key, score)`, best first.
+
+    Each list contributes `1 / (k + rank)` for every key it contains, so a key
+    ranked well by several lists beats one ranked first by a single list.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
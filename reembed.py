@@ -0,0 +1,150 @@
+"""Re-embed every stored chunk with the configured embedding model.
+
+    python reembed.py [--workers 2] [--restart]
+
+Run it after changing `LLM_PROVIDER`, `LM_STUDIO_EMBED_MODEL` or
+`OLLAMA_EMBED_MODEL`; until then searches fall back to keyword matching and
+uploads are refused, since vectors from two models cannot be compared.
+
+New vectors go to a staging store next to the live one
+(`vector_store.reembed/`), a WAL record per batch of a report's chunks, so an
+interrupted run resumes with the reports it had not finished. Chunk text is
+read one report at a time, so memory use does not grow with the store. When
+every report is done, reports uploaded or deleted meanwhile are caught up
+under the store lock and the staging index becomes the live store's next
+snapshot with a single manifest replace; running workers pick it up on their
+next search. Chunk ids and text are kept; only the vectors change.
+"""
+import argparse
+import logging
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import database
+import document_processor
+from document_processor import INGEST_BATCH_CHUNKS, DocumentProcessor, _active_embed_model, _batched
+from vector_index import VectorIndex, normalize_rows
+from vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+STAGING_SUFFIX = ".reembed"
+
+
+class Reembedder:
+    """Builds vectors for every stored chunk in a staging store, then swaps them in."""
+
+    def __init__(self, processor, workers=2):
+        self.processor = processor
+        self.workers = workers
+        self.model = _active_embed_model()
+        self.staging = VectorStore(processor.store.path.rstrip("/\\") + STAGING_SUFFIX)
+        self.index = VectorIndex()
+        self._lock = threading.Lock()
+        self._done = 0
+        self._chunks = 0
+
+    def run(self, restart=False):
+        """Re-embed what the staging store is missing and publish it; returns the chunk count."""
+        with self.staging.lock():
+            self._open_staging(restart)
+            self._embed_pending()
+            self.processor.replace_vectors(self.index, self.model, self._catch_up)
+            chunks = len(self.index)
+            self.staging.clear()
+        shutil.rmtree(self.staging.path, ignore_errors=True)
+        logger.info("Re-embedded %s chunks with %s", chunks, self.model)
+        return chunks
+
+    def _open_staging(self, restart):
+        if restart:
+            self.staging.clear()
+        self.index, _ = self.staging.load()
+        if self.staging.model not in (None, self.model):
+            logger.info("Staging store holds %s vectors; starting over for %s", self.staging.model, self.model)
+            self.staging.clear()
+            self.index = VectorIndex()
+        if self.staging.model is None:
+            self.staging.record_model(self.model)
+        if len(self.index):
+            logger.info("Resuming: %s chunks already re-embedded", len(self.index))
+
+    def _catch_up(self, index):
+        self._embed_pending()
+        return self.index
+
+    def _embed_pending(self):
+        """Embed reports whose chunks differ from the staging store and drop deleted ones."""
+        stored = database.get_chunk_ids_by_report()
+        staged = self._staged_chunk_ids()
+        gone = [report_id for report_id in staged if report_id not in stored]
+        if gone:
+            with self._lock:
+                self.staging.append_tombstone(gone)
+                self.index.remove_reports(gone)
+        pending = [report_id for report_id, chunk_ids in stored.items() if staged.get(report_id) != chunk_ids]
+        if pending:
+            logger.info(
+                "Re-embedding %s reports (%s chunks)", len(pending), sum(len(stored[r]) for r in pending)
+            )
+            self._done, self._chunks, started = 0, 0, time.monotonic()
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="reembed") as executor:
+                for _ in executor.map(lambda report_id: self._embed_report(report_id, len(pending), started), pending):
+                    pass
+
+    def _staged_chunk_ids(self):
+        """Ascending chunk ids of each report in the staging index, in one pass over its rows."""
+        alive = self.index.alive
+        report_ids, chunk_ids = self.index.report_ids[alive], self.index.chunk_ids[alive]
+        order = np.lexsort((chunk_ids, report_ids))
+        report_ids, chunk_ids = report_ids[order], chunk_ids[order]
+        starts = np.flatnonzero(np.diff(report_ids)) + 1
+        return {
+            int(ids_of_report[0]): chunks.tolist()
+            for ids_of_report, chunks in zip(np.split(report_ids, starts), np.split(chunk_ids, starts))
+            if len(chunks)
+        }
+
+    def _embed_report(self, report_id, total, started):
+        """Replace a report's staged vectors, reading its text now and logging a record per batch."""
+        chunks = database.get_report_chunks(report_id)
+        with self._lock:
+            if report_id in self.index.report_ranges:
+                self.staging.append_tombstone([report_id])
+                self.index.remove_reports([report_id])
+        for batch in _batched(chunks, INGEST_BATCH_CHUNKS):
+            vectors = normalize_rows(self.processor.embed_texts(chunk["text"] for chunk in batch))
+            chunk_ids = [chunk["id"] for chunk in batch]
+            with self._lock:
+                self.staging.append_add(report_id, chunk_ids, vectors)
+                self.index.add(chunk_ids, [report_id] * len(chunk_ids), vectors)
+        with self._lock:
+            self._done += 1
+            self._chunks += len(chunks)
+            elapsed = time.monotonic() - started
+            logger.info(
+                "[%s/%s] report %s: %s chunks (%.1f chunks/s, about %.0fs left)",
+                self._done, total, report_id, len(chunks), self._chunks / max(elapsed, 1e-6),
+                elapsed / self._done * (total - self._done),
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-embed every stored chunk with the configured model.")
+    parser.add_argument("--workers", type=int, default=2, help="reports embedded at once")
+    parser.add_argument("--restart", action="store_true", help="discard a previous, unfinished run")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    database.init_db()
+    processor = document_processor.processor
+    if not isinstance(processor, DocumentProcessor):
+        processor = DocumentProcessor()
+    Reembedder(processor, workers=max(1, args.workers)).run(restart=args.restart)
+
+
+if __name__ == "__main__":
+    main()
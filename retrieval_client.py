@@ -0,0 +1,132 @@
+"""Client for a `retrieval_service` process that owns the document index.
+
+`RetrievalClient` has the same public methods as `DocumentProcessor`, so
+`document_processor.processor` can be either one. Set `RETRIEVAL_SERVICE_URL`
+to `http://127.0.0.1:<port>` or `unix:///path/to/socket` to use the service;
+each web worker then keeps only a connection instead of its own copy of the index.
+"""
+import http.client
+import json
+import logging
+import os
+import socket
+import threading
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+try:
+    RETRIEVAL_SERVICE_TIMEOUT = max(1, int(os.getenv("RETRIEVAL_SERVICE_TIMEOUT", "600")))
+except ValueError:
+    RETRIEVAL_SERVICE_TIMEOUT = 600
+
+# Errors the service reports by name and the client raises again as the same type.
+_ERRORS = {"ValueError": ValueError, "FileNotFoundError": FileNotFoundError, "TypeError": TypeError}
+
+
+class RetrievalServiceError(RuntimeError):
+    """The retrieval service failed a call for a reason other than bad input."""
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def parse_service_url(url):
+    """`("unix", path)` or `("http", (host, port))` for a `RETRIEVAL_SERVICE_URL`."""
+    parts = urlsplit(url)
+    if parts.scheme == "unix":
+        return "unix", parts.path
+    if parts.scheme == "http" and parts.hostname:
+        return "http", (parts.hostname, parts.port or 80)
+    raise ValueError(f"Unsupported retrieval service URL: {url}")
+
+
+class RetrievalClient:
+    """Forwards `DocumentProcessor` calls to the retrieval service as JSON over HTTP.
+
+    Each thread keeps one keep-alive connection.
+    """
+
+    def __init__(self, url, timeout=RETRIEVAL_SERVICE_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._kind, self._address = parse_service_url(url)
+        self._local = threading.local()
+
+    def search_in_documents(self, query: str, top_k=5, report_ids=None, user_id=None, mode=None):
+        if report_ids is not None:
+            report_ids = list(report_ids)
+        return self._call(
+            "search_in_documents", query=query, top_k=top_k, report_ids=report_ids, user_id=user_id, mode=mode
+        )
+
+    def embed_document(self, file_path, report_id):
+        # The service opens the upload itself, so it needs a path independent of our cwd.
+        return self._call("embed_document", file_path=os.path.abspath(file_path), report_id=report_id)
+
+    def process_and_embed_document(self, file_path, report_id):
+        try:
+            return self.embed_document(file_path, report_id)
+        except Exception:
+            logger.exception("Error processing document %s", file_path)
+            return None
+
+    def delete_document(self, report_id_to_delete):
+        self.delete_documents([report_id_to_delete])
+
+    def delete_documents(self, report_ids):
+        self._call("delete_documents", report_ids=[int(r) for r in report_ids])
+
+    def clear(self):
+        self._call("clear")
+
+    def cache_stats(self):
+        return self._call("cache_stats")
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._kind == "unix":
+                connection = _UnixHTTPConnection(self._address, self.timeout)
+            else:
+                host, port = self._address
+                connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _call(self, method, **params):
+        body = json.dumps(params).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request("POST", f"/{method}", body, headers)
+                response = connection.getresponse()
+                payload = json.loads(response.read() or b"{}")
+                break
+            except TimeoutError:
+                self.close()
+                raise
+            except (OSError, http.client.HTTPException):
+                # The service closed an idle keep-alive connection, or restarted.
+                self.close()
+                if attempt:
+                    raise
+        if response.status == 200:
+            return payload.get("result")
+        error = _ERRORS.get(payload.get("type"), RetrievalServiceError)
+        raise error(payload.get("error") or f"Retrieval service returned HTTP {response.status}")
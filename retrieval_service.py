@@ -0,0 +1,120 @@
+"""Retrieval daemon: one process owns the document index and serves it to web workers.
+
+    python retrieval_service.py [URL]
+
+listens on `URL` (default `RETRIEVAL_SERVICE_URL`, else http://127.0.0.1:8765;
+`unix:///path/to/socket` for a Unix socket). Each call is a JSON POST to
+`/<method>` with the method's keyword arguments, answered with
+`{"result": ...}` or `{"error": ..., "type": ...}`; see `retrieval_client`.
+The daemon reads uploads from the paths it is given and shares the SQLite
+database with the web app, so run it on the same host and working directory.
+"""
+import json
+import logging
+import os
+import socketserver
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import database
+import document_processor
+from document_processor import DocumentProcessor
+from retrieval_client import parse_service_url
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+# `DocumentProcessor` methods callable through the service.
+SERVICE_METHODS = frozenset(
+    {"search_in_documents", "embed_document", "delete_documents", "clear", "cache_stats"}
+)
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class RetrievalRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "RetrievalService/1"
+
+    def do_POST(self):
+        method = self.path.strip("/")
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError:
+            self._reply(400, {"error": "Request body is not valid JSON.", "type": "ValueError"})
+            return
+        if method not in SERVICE_METHODS:
+            self._reply(404, {"error": f"Unknown method: {method}", "type": "ValueError"})
+            return
+        try:
+            result = getattr(self.server.processor, method)(**params)
+        except (ValueError, FileNotFoundError, TypeError) as e:
+            self._reply(400, {"error": str(e), "type": type(e).__name__})
+        except Exception as e:
+            logger.exception("Retrieval service call %s failed", method)
+            self._reply(500, {"error": str(e), "type": type(e).__name__})
+        else:
+            self._reply(200, {"result": result})
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no host address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(processor, url=DEFAULT_URL):
+    """An HTTP server answering calls on `processor`; call `serve_forever()` on it."""
+    kind, address = parse_service_url(url)
+    if kind == "unix":
+        if os.path.exists(address):
+            os.remove(address)  # left behind by a previous run
+        server = _ThreadingUnixHTTPServer(address, RetrievalRequestHandler)
+    else:
+        server = ThreadingHTTPServer(address, RetrievalRequestHandler)
+        server.daemon_threads = True
+    server.processor = processor
+    return server
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    url = argv[0] if argv else os.getenv("RETRIEVAL_SERVICE_URL", "").strip() or DEFAULT_URL
+    database.init_db()
+    # With RETRIEVAL_SERVICE_URL set, the module-level processor is a client of this very service.
+    processor = document_processor.processor
+    if not isinstance(processor, DocumentProcessor):
+        processor = DocumentProcessor()
+    server = make_server(processor, url)
+    logger.info("Retrieval service listening on %s", url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
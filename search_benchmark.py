@@ -0,0 +1,96 @@
+"""Latency and recall of first-pass search settings against exact float32 search.
+
+    python search_benchmark.py [--store vector_store] [--queries 200] [--top-k 10]
+                               [--dims 64,128,256] [--candidates 50,200,500]
+
+Queries are stored chunk vectors with a little noise added. Without a store
+(or an empty one), synthetic vectors whose energy decays across dimensions,
+like Matryoshka-trained embeddings, are used instead.
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+
+from vector_index import VectorIndex, recall_at_k
+from vector_store import VectorStore
+
+
+def synthetic_index(rows=50000, dim=768, seed=0) -> VectorIndex:
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(rows, dim)).astype(np.float32) / np.sqrt(1.0 + np.arange(dim, dtype=np.float32) / 16)
+    index = VectorIndex()
+    index.add(np.arange(rows), np.arange(rows) // 100, vectors)
+    return index
+
+
+def sample_queries(index: VectorIndex, count, noise=0.05, seed=0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(np.flatnonzero(index.alive), min(count, len(index)), replace=False))
+    queries = index.take(rows)
+    return queries + noise * rng.normal(size=queries.shape).astype(np.float32) / np.sqrt(index.dim)
+
+
+def benchmark(index: VectorIndex, queries, top_k=10, settings=(("none", None, 0),)):
+    """One result dict per `(quantization, dims, candidates)` setting, plus exact search first."""
+    exact = copy.copy(index)
+    exact.ivf = exact.codes = None
+    results = [_measure(exact, queries, top_k, "exact", None, 0)]
+    for quantization, dims, candidates in settings:
+        view = copy.copy(exact)
+        view.set_quantization(quantization, dims=dims)
+        results.append(_measure(view, queries, top_k, view.quantization, dims, candidates))
+    return results
+
+
+def _measure(index, queries, top_k, quantization, dims, candidates):
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query, top_k, candidates=candidates)
+    elapsed = time.perf_counter() - started
+    return {
+        "quantization": quantization,
+        "dims": dims or index.dim,
+        "candidates": candidates,
+        "ms_per_query": 1000.0 * elapsed / max(1, len(queries)),
+        "recall": recall_at_k(index, queries, top_k=top_k, nprobe=None, candidates=candidates),
+        "first_pass_mb": (index.codes.nbytes if index.codes is not None else index.total_rows * index.dim * 4) / 2**20,
+    }
+
+
+def _int_list(value):
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--store", help="vector store directory (default: synthetic vectors)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dims", type=_int_list, default=[64, 128, 256])
+    parser.add_argument("--candidates", type=_int_list, default=[50, 200, 500])
+    parser.add_argument("--quantization", default="none", choices=["none", "float16", "int8"])
+    args = parser.parse_args(argv)
+
+    index = None
+    if args.store:
+        store = VectorStore(args.store)
+        with store.lock():
+            index, _ = store.load()
+    if index is None or len(index) == 0:
+        index = synthetic_index()
+    queries = sample_queries(index, args.queries)
+    settings = [(args.quantization, dims, candidates) for dims in args.dims for candidates in args.candidates]
+
+    print(f"{len(index)} rows x {index.dim} dims, {len(queries)} queries, top-{args.top_k}")
+    print(f"{'codes':>8} {'dims':>5} {'rescored':>8} {'ms/query':>9} {'recall':>7} {'first-pass MB':>14}")
+    for row in benchmark(index, queries, args.top_k, settings):
+        print(
+            f"{row['quantization']:>8} {row['dims']:>5} {row['candidates']:>8} "
+            f"{row['ms_per_query']:>9.2f} {row['recall']:>7.3f} {row['first_pass_mb']:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -19,8 +19,9 @@ def app():
     os.environ['TEST_DATABASE_URL'] = TEST_DB_NAME
 
     # Clean up old test database if it exists from a previous failed run
-    if os.path.exists(TEST_DB_NAME):
-        os.remove(TEST_DB_NAME)
+    for path in (TEST_DB_NAME, TEST_DB_NAME + "-wal", TEST_DB_NAME + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
     # Initialize the test database.
     database.init_db(db_name_override=TEST_DB_NAME)
@@ -38,9 +39,12 @@ def app():
 
     yield flask_app
 
-    # Teardown: Clean up the test database file after the session
-    if os.path.exists(TEST_DB_NAME):
-        os.remove(TEST_DB_NAME)
+    # Teardown: Clean up the test database files after the session
+    database.flush_writes()
+    database.close_connections()
+    for path in (TEST_DB_NAME, TEST_DB_NAME + "-wal", TEST_DB_NAME + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
     # Unset the environment variable
     if 'TEST_DATABASE_URL' in os.environ:
@@ -63,3 +67,19 @@ def runner(app):
 def test_db(app):
     """Provides the database module after the test DB has been initialised."""
     yield database
+
+
+@pytest.fixture()
+def chunk_db(tmp_path_factory, monkeypatch):
+    """A fresh database with reports 1-100, since chunks must belong to an uploaded report."""
+    db_path = str(tmp_path_factory.mktemp("db") / "chatbot_data.db")
+    monkeypatch.setenv("TEST_DATABASE_URL", db_path)
+    database.init_db()
+    conn = database.get_db_connection()
+    conn.executemany(
+        "INSERT INTO uploaded_reports (id, user_id, original_filename, stored_filename) VALUES (?, ?, ?, ?)",
+        [(report_id, f"u-{report_id % 3}", f"r{report_id}.pdf", f"r{report_id}.pdf") for report_id in range(1, 101)],
+    )
+    conn.commit()
+    conn.close()
+    return database
@@ -68,3 +68,114 @@ def test_upload_report_empty_filename(client):
     json_data = response.get_json()
     assert json_data['success'] == False
     assert json_data['message'] == 'No file selected.'
+
+
+def test_cache_stats_route(client, mocker):
+    stats = {"embedding_cache": None, "query_cache": {"hits": 3, "misses": 1, "hit_ratio": 0.75}}
+    mocker.patch('app.doc_processor.cache_stats', return_value=stats)
+
+    response = client.get('/api/cache_stats')
+
+    assert response.status_code == 200
+    assert response.get_json() == stats
+
+
+def test_upload_report_queues_ingestion(client, mocker, tmp_path):
+    from io import BytesIO
+    mocker.patch.dict('app.app.config', {'UPLOAD_FOLDER': str(tmp_path)})
+    submit = mocker.patch('app.ingestion_queue.submit', return_value=1)
+    data = {'file': (BytesIO(b"%PDF-1.4"), 'report.pdf', 'application/pdf'), 'uploader': 'Ayse'}
+
+    response = client.post('/upload_report', data=data, content_type='multipart/form-data')
+
+    assert response.status_code == 202
+    json_data = response.get_json()
+    assert json_data['status'] == 'queued'
+    assert json_data['status_url'] == f"/reports/{json_data['report_id']}/status"
+    submit.assert_called_once()
+    assert submit.call_args[0][0] == json_data['report_id']
+
+
+def test_report_status_route(client, test_db):
+    report_id = test_db.add_report('status-user', 'a.pdf', 'x_a.pdf', 'Ayse')
+    job_id = test_db.enqueue_ingestion_job(report_id, '/tmp/x_a.pdf')
+
+    assert client.get(f'/reports/{report_id}/status').get_json()['status'] == 'queued'
+
+    test_db.finish_ingestion_job(job_id, 'failed', 'boom')
+    json_data = client.get(f'/reports/{report_id}/status').get_json()
+    assert json_data['status'] == 'failed'
+    assert json_data['error'] == 'boom'
+    assert client.get('/reports/999999/status').status_code == 404
+
+
+def test_ingestion_queue_recovers_interrupted_jobs(test_db, mocker, tmp_path):
+    from ingestion import IngestionQueue
+    processor = mocker.Mock()
+    processor.embed_document.return_value = 3
+    queue = IngestionQueue(processor, str(tmp_path))
+    while test_db.claim_next_ingestion_job():  # drain jobs left by other tests
+        pass
+    report_id = test_db.add_report('recover-user', 'b.pdf', 'x_b.pdf', 'Ayse')
+    test_db.enqueue_ingestion_job(report_id, str(tmp_path / 'x_b.pdf'))
+    test_db.claim_next_ingestion_job('dead-worker', lease_seconds=-1)  # a worker that died mid-job
+
+    assert queue.recover() >= 1
+    queue.run_pending()
+
+    processor.embed_document.assert_any_call(str(tmp_path / 'x_b.pdf'), report_id)
+    job = test_db.get_latest_ingestion_job(report_id)
+    assert (job['status'], job['owner']) == ('done', None)
+
+
+def test_ingestion_queue_retries_failed_jobs_with_backoff(test_db, mocker, tmp_path):
+    import ingestion
+    processor = mocker.Mock()
+    processor.embed_document.side_effect = [ConnectionError('embedding server down'), 4, ValueError('no text')]
+    queue = ingestion.IngestionQueue(processor, str(tmp_path))
+    while test_db.claim_next_ingestion_job():  # drain jobs left by other tests
+        pass
+    flaky_report = test_db.add_report('retry-user', 'e.pdf', 'x_e.pdf', 'Ayse')
+    empty_report = test_db.add_report('retry-user', 'f.pdf', 'x_f.pdf', 'Ayse')
+    test_db.enqueue_ingestion_job(flaky_report, str(tmp_path / 'x_e.pdf'))
+
+    mocker.patch.object(ingestion, 'INGESTION_RETRY_SECONDS', 60)
+    assert queue.run_pending() == 1
+    job = test_db.get_latest_ingestion_job(flaky_report)
+    assert (job['status'], job['attempts'], job['error']) == ('queued', 1, 'embedding server down')
+    assert test_db.claim_next_ingestion_job() is None  # still backing off
+
+    test_db.requeue_ingestion_job(job['id'])
+    test_db.enqueue_ingestion_job(empty_report, str(tmp_path / 'x_f.pdf'))
+    assert queue.run_pending() == 2
+    job = test_db.get_latest_ingestion_job(flaky_report)
+    assert (job['status'], job['attempts']) == ('done', 2)
+    job = test_db.get_latest_ingestion_job(empty_report)
+    assert (job['status'], job['attempts'], job['error']) == ('failed', 1, 'no text')
+
+
+def test_ingestion_recovery_leaves_live_leases_and_gives_up_on_crashing_jobs(test_db, mocker, tmp_path):
+    from ingestion import INGESTION_MAX_ATTEMPTS, IngestionQueue
+    queue = IngestionQueue(mocker.Mock(), str(tmp_path))
+    queue.recover()
+    queue.run_pending()  # finish jobs left by other tests
+    live_report = test_db.add_report('lease-user', 'c.pdf', 'x_c.pdf', 'Ayse')
+    poison_report = test_db.add_report('lease-user', 'd.pdf', 'x_d.pdf', 'Ayse')
+    mocker.patch.object(test_db, 'get_unprocessed_reports', side_effect=lambda: [
+        test_db.get_report_by_id(live_report), test_db.get_report_by_id(poison_report)
+    ])
+    live_job = test_db.enqueue_ingestion_job(live_report, str(tmp_path / 'x_c.pdf'))
+    test_db.claim_next_ingestion_job('live-worker', lease_seconds=60)  # e.g. another gunicorn worker
+    test_db.enqueue_ingestion_job(poison_report, str(tmp_path / 'x_d.pdf'))
+
+    assert queue.recover() == 0
+    assert test_db.get_latest_ingestion_job(live_report)['status'] == 'processing'
+    assert test_db.renew_ingestion_lease(live_job, 'live-worker', 60)
+    assert not test_db.renew_ingestion_lease(live_job, 'someone-else', 60)
+
+    for _ in range(INGESTION_MAX_ATTEMPTS):
+        test_db.claim_next_ingestion_job('crashing-worker', lease_seconds=-1)
+        queue.recover()
+    job = test_db.get_latest_ingestion_job(poison_report)
+    assert (job['status'], job['attempts']) == ('failed', INGESTION_MAX_ATTEMPTS)
+    assert test_db.finish_ingestion_job(live_job, 'done', owner='live-worker')
@@ -6,6 +6,7 @@ import importlib
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import database
 from chatbot import CitizenAssistantBot
 
 
@@ -182,3 +183,52 @@ def test_explicit_document_tool_request_bypasses_general_llm(mocker):
 
     assert response == "Document explanation"
     explain_mock.assert_called_once()
+
+
+def test_explain_report_searches_only_the_selected_report(mocker):
+    bot = CitizenAssistantBot()
+    search = mocker.patch(
+        'chatbot.doc_processor.search_in_documents',
+        return_value=[{"text": "Madde 4: izin", "report_id": 7, "score": 0.9}],
+    )
+    mocker.patch.object(bot, 'ollama_chat', return_value="Answer")
+    mocker.patch('database.add_chat_history')
+
+    assert bot._explain_report(7, "izin kurali", "izin kurali", "test_user_doc") == "Answer"
+    search.assert_called_once_with("izin kurali", top_k=6, report_ids=[7])
+
+
+@pytest.mark.usefixtures("chunk_db")
+def test_general_chat_message_reads_history_once(mocker):
+    mocker.patch('chatbot.LLM_PROVIDER', "lmstudio")
+    bot = CitizenAssistantBot()
+    database.add_chat_history("test_user_trips", "llm_response", "onceki soru", "onceki cevap")
+    database.flush_writes()
+    replies = iter(["No tool is needed.", "Merhaba!"])
+    llm = mocker.patch('requests.post')
+    llm.return_value.json.side_effect = lambda: {"choices": [{"message": {"content": next(replies)}}]}
+    history = mocker.spy(database, 'get_chat_history')
+
+    with database.count_round_trips() as trips:
+        assert bot.process_message("merhaba nasilsin", "test_user_trips") == "Merhaba!"
+
+    history.assert_called_once_with("test_user_trips", limit=32)
+    sent = llm.call_args.kwargs["json"]["messages"]
+    assert [m["content"] for m in sent[1:]] == ["onceki soru", "onceki cevap", "merhaba nasilsin"]
+    assert trips.count == 2  # knowledge base version check and chat history; the reply is written behind
+
+
+@pytest.mark.usefixtures("chunk_db")
+def test_document_tools_share_one_report_lookup(mocker):
+    bot = CitizenAssistantBot()
+    reports = mocker.patch('database.get_reports', return_value=[
+        {'id': 7, 'original_filename': 'a.pdf'}, {'id': 8, 'original_filename': 'b.pdf'},
+    ])
+    mocker.patch.object(bot, 'ollama_chat', return_value=json.dumps(
+        [{"tool": "document_summarize"}, {"tool": "document_query", "query": "izin"}]
+    ))
+
+    response = bot.process_message("iki isi birden yap", "test_user_docs")
+
+    assert response.count("Multiple documents found") == 2
+    reports.assert_called_once_with("test_user_docs")
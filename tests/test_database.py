@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import database
+from keyword_matcher import KeywordMatcher, fold_turkish
+
+pytestmark = pytest.mark.usefixtures("chunk_db")
+
+
+def test_each_thread_reuses_one_wal_connection():
+    with database.connection() as first, database.connection() as second:
+        assert first is second
+        assert first.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert first.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+    other = []
+
+    def use_connection():
+        with database.connection() as conn:
+            other.append(conn)
+
+    thread = threading.Thread(target=use_connection)
+    thread.start()
+    thread.join()
+    assert other[0] is not first
+
+
+def test_transaction_rolls_back_on_error_and_nested_transactions_join():
+    with pytest.raises(RuntimeError):
+        with database.transaction():
+            database.add_chat_history("u-1", "chat", "soru", "cevap")
+            raise RuntimeError("boom")
+    assert database.get_chat_history("u-1") == []
+
+    with database.transaction():
+        database.add_chat_history("u-1", "chat", "soru", "cevap")
+        with database.connection() as conn:
+            assert conn.in_transaction
+    assert [row["user_message"] for row in database.get_chat_history("u-1")] == ["soru"]
+
+
+def test_connection_follows_the_configured_database(tmp_path, monkeypatch):
+    with database.connection() as before:
+        pass
+    monkeypatch.setenv("TEST_DATABASE_URL", str(tmp_path / "other.db"))
+    database.init_db()
+    with database.connection() as after:
+        assert after is not before
+    assert database.get_reports() == []
+
+
+def test_migrations_run_once_and_record_the_schema_version():
+    with database.connection() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+        assert database.migrate(conn) == 0
+
+
+def _query_plans(call):
+    """`(sql, plan)` for every SELECT that `call` runs on this thread's connection."""
+    statements = []
+    with database.connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        return [
+            (sql, " / ".join(row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")))
+            for sql in statements if sql.lstrip().upper().startswith("SELECT")
+        ]
+
+
+@pytest.mark.parametrize(
+    "call, index",
+    [
+        (lambda: database.get_chat_history("u-1"), "idx_chat_history_user_time"),
+        (lambda: database.get_support_tickets("u-1"), "idx_support_tickets_user_created"),
+        (lambda: database.get_support_tickets_all(), "idx_support_tickets_created"),
+        (lambda: database.get_reports("u-1"), "idx_uploaded_reports_user_created"),
+        (lambda: database.get_reports(), "idx_uploaded_reports_created"),
+        (lambda: database.get_report_ids_for_user("u-1"), "idx_uploaded_reports_user_created"),
+        (lambda: database.get_unprocessed_reports(), "idx_uploaded_reports_processed"),
+    ],
+)
+def test_listing_queries_use_their_index(call, index):
+    plans = _query_plans(call)
+    assert plans
+    for sql, plan in plans:
+        assert index in plan, sql
+        assert "TEMP B-TREE" not in plan, sql
+
+
+def test_dashboard_queries_use_indexes():
+    from chatbot import CitizenAssistantBot
+
+    plans = _query_plans(CitizenAssistantBot().get_citizen_dashboard)
+    assert len(plans) == 3
+    for sql, plan in plans:
+        assert "INDEX" in plan and "TEMP B-TREE" not in plan, sql
+
+
+def _stored_chat_rows():
+    """Rows another connection can see, i.e. ones already committed."""
+    conn = database.get_db_connection()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_chat_history_is_written_behind_in_one_batch_but_tickets_at_once(mocker):
+    mocker.patch.object(database, "_write_behind", database.WriteBehindQueue(interval=60, max_rows=100))
+    database.add_chat_history("u-1", "chat", "ilk", "cevap")
+    database.add_chat_history("u-1", "chat", "ikinci", "cevap")
+    database.add_support_ticket("u-1", "t-1", "IT", "yazici", "normal", "general")
+    assert _stored_chat_rows() == 0
+    assert [ticket["description"] for ticket in database.get_support_tickets("u-1")] == ["yazici"]
+
+    commits = []
+    with database.connection() as conn:
+        conn.set_trace_callback(lambda sql: sql == "COMMIT" and commits.append(sql))
+        try:
+            # Reads flush first, so the caller sees its own rows.
+            assert {row["user_message"] for row in database.get_chat_history("u-1")} == {"ilk", "ikinci"}
+        finally:
+            conn.set_trace_callback(None)
+    assert len(commits) == 1
+
+    # The user is only told about a ticket the database accepted.
+    with pytest.raises(sqlite3.IntegrityError):
+        database.add_support_ticket("u-1", "t-1", "IT", "ayni numara", "normal", "general")
+
+    # A buffered row the database rejects is dropped without losing the rest of its batch.
+    database._write_behind.put("INSERT INTO chat_history (id, user_id) VALUES (1, 'u-1')", ())
+    database.add_chat_history("u-1", "chat", "ucuncu", "cevap")
+    assert database.flush_writes() == 1
+    assert _stored_chat_rows() == 3
+
+
+def test_write_behind_flushes_after_the_interval(mocker):
+    mocker.patch.object(database, "_write_behind", database.WriteBehindQueue(interval=0.01, max_rows=100))
+    database.add_chat_history("u-2", "chat", "soru", "cevap")
+    for _ in range(200):
+        if _stored_chat_rows():
+            break
+        time.sleep(0.01)
+    else:
+        pytest.fail("buffered row was never written")
+
+
+def test_keyword_matcher_folds_turkish_and_reports_offsets():
+    matcher = KeywordMatcher()
+    for keyword, value in [("izin", 1), ("yıllık izin", 2), ("he", 3), ("she", 4), ("hers", 5)]:
+        matcher.add(keyword, value)
+    text = "YILLIK İZİN ve ushers"
+    matches = matcher.find(text)
+    assert [(keyword, value) for _, _, keyword, value in matches] == [
+        ("yıllık izin", 2), ("izin", 1), ("she", 4), ("he", 3), ("hers", 5)
+    ]
+    assert [text[start:end] for start, end, _, _ in matches[:2]] == ["YILLIK İZİN", "İZİN"]
+    assert fold_turkish("Işık ÇĞŞÖÜ") == "isik cgsou"
+
+
+def test_knowledge_base_matches_are_cached_until_the_table_changes(mocker):
+    with database.transaction() as conn:
+        conn.execute(
+            "INSERT INTO institution_knowledge (keywords, answer) VALUES (?, ?)",
+            ("yemekhane, öğle yemeği", "Yemekhane 12:00-14:00 arasi aciktir."),
+        )
+    entries = database.match_kb_entries("Ogle yemegi ne zaman? Lunch?")
+    assert [(entry["answer"][:9], [m["keyword"] for m in entry["matches"]]) for entry in entries] == [
+        ("The cafet", ["lunch"]), ("Yemekhane", ["öğle yemeği"])
+    ]
+    assert entries[1]["matches"][0]["start"] == 0 and entries[1]["matches"][0]["end"] == 11
+
+    build = mocker.spy(database, "KeywordMatcher")
+    assert database.search_kb_answer("lunch") == entries[0]["answer"]
+    assert build.call_count == 0
+    with database.transaction() as conn:
+        conn.execute("UPDATE institution_knowledge SET answer = 'Kapali.' WHERE keywords LIKE 'yemekhane%'")
+    assert database.search_kb_entries("yemekhane") == [{"keywords": "yemekhane, öğle yemeği", "answer": "Kapali."}]
+    assert build.call_count == 1
+    assert database.search_kb_entries("   ") == [] and database.search_kb_answer("") is None
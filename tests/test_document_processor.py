@@ -1,18 +1,31 @@
+import json
+import math
 import os
+import random
 import sys
+import threading
+import time
+
+import numpy as np
+import pytest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import database
+import document_parser
 import document_processor
 from document_processor import DocumentProcessor, LM_STUDIO_EMBED_MODEL, OLLAMA_EMBED_MODEL
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache
+from embedding_client import EmbeddingClient, plan_batches
 
 
-def test_search_in_documents_returns_metadata_for_blank_query():
-    processor = DocumentProcessor()
-    processor.metadata = {
-        2: {"report_id": 20, "text": "ikinci parca", "embedding": [0.0, 1.0]},
-        1: {"report_id": 10, "text": "ilk parca", "embedding": [1.0, 0.0]},
-    }
+pytestmark = pytest.mark.usefixtures("chunk_db")
+
+
+def test_search_in_documents_returns_metadata_for_blank_query(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
 
     results = processor.search_in_documents("", top_k=2)
 
@@ -22,13 +35,11 @@ def test_search_in_documents_returns_metadata_for_blank_query():
     ]
 
 
-def test_search_in_documents_uses_embedding_similarity():
-    processor = DocumentProcessor()
-    processor.metadata = {
-        1: {"report_id": 10, "text": "ilk parca", "embedding": [1.0, 0.0]},
-        2: {"report_id": 20, "text": "ikinci parca", "embedding": [0.0, 1.0]},
-    }
-    processor._embed_many = lambda texts: [[1.0, 0.0]]
+def test_search_in_documents_uses_embedding_similarity(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+    processor._embed_many_uncached = lambda texts: [[1.0, 0.0]]
 
     results = processor.search_in_documents("bir sey ara", top_k=1)
 
@@ -37,7 +48,280 @@ def test_search_in_documents_uses_embedding_similarity():
     assert results[0]["text"] == "ilk parca"
 
 
-def test_embed_many_uses_lm_studio_openai_embeddings_api(mocker):
+def test_search_in_documents_matches_python_cosine_ranking(tmp_path):
+    rng = random.Random(7)
+    processor = DocumentProcessor(store_path=tmp_path)
+    embeddings = [[rng.uniform(-1, 1) for _ in range(16)] for _ in range(40)]
+    for report_id, embedding in enumerate(embeddings, start=1):
+        processor._add_chunks(report_id, [f"chunk {report_id}"], [embedding])
+    query = [rng.uniform(-1, 1) for _ in range(16)]
+    processor._embed_many_uncached = lambda texts: [query]
+
+    def cosine(left, right):
+        dot = sum(x * y for x, y in zip(left, right))
+        return dot / (math.sqrt(sum(x * x for x in left)) * math.sqrt(sum(x * x for x in right)))
+
+    expected = sorted(
+        range(1, len(embeddings) + 1),
+        key=lambda rid: cosine(query, embeddings[rid - 1]),
+        reverse=True,
+    )[:5]
+    results = processor.search_in_documents("anything", top_k=5)
+
+    assert [r["report_id"] for r in results] == expected
+    for result in results:
+        assert result["score"] == pytest.approx(cosine(query, embeddings[result["report_id"] - 1]), abs=1e-5)
+
+
+def test_search_in_documents_scores_only_selected_reports(tmp_path, mocker):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, [f"genel {i}" for i in range(8)], [[1.0, 0.0]] * 8)
+    processor._add_chunks(20, ["hedef 1", "hedef 2"], [[0.0, 1.0], [1.0, 1.0]])
+    processor._add_chunks(30, ["baska"], [[0.5, 0.5]])
+    processor._embed_many_uncached = lambda texts: [[1.0, 0.0]]
+    mocker.patch("database.get_report_ids_for_user", return_value=[20, 30])
+    score_rows = mocker.spy(processor.index, "_score_rows")
+
+    by_report = processor.search_in_documents("soru", top_k=6, report_ids=["20"])
+    by_user = processor.search_in_documents("soru", top_k=6, user_id="u-1")
+    both = processor.search_in_documents("soru", top_k=6, report_ids=[10, 20], user_id="u-1")
+    first_chunks = processor.search_in_documents("", top_k=5, report_ids=[20])
+
+    assert [r["text"] for r in by_report] == ["hedef 2", "hedef 1"]
+    assert [r["report_id"] for r in by_user] == [20, 30, 20]
+    assert {r["report_id"] for r in both} == {20}
+    assert [r["text"] for r in first_chunks] == ["hedef 1", "hedef 2"]
+    assert processor.search_in_documents("soru", report_ids=["yok"]) == []
+    scored_rows = score_rows.call_args.args[1]
+    assert sorted(scored_rows.tolist()) == [8, 9]
+
+
+def test_saved_store_is_memory_mapped_on_reload(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca", "ikinci parca"], [[3.0, 0.0], [0.0, 1.0]])
+    processor._add_chunks(20, ["ucuncu parca"], [[1.0, 1.0]])
+    processor.compact()
+    processor.delete_document(20)
+
+    reloaded = DocumentProcessor(store_path=tmp_path)
+    reloaded._embed_many_uncached = lambda texts: [[1.0, 0.0]]
+
+    assert isinstance(reloaded.index.base, np.memmap)
+    assert reloaded.index.base.dtype == np.float32
+    assert database.get_document_chunk_texts([1, 2, 3]) == {1: "ilk parca", 2: "ikinci parca"}
+    results = reloaded.search_in_documents("query", top_k=5)
+    assert [(r["text"], r["report_id"]) for r in results] == [("ilk parca", 10), ("ikinci parca", 10)]
+    assert results[0]["score"] == pytest.approx(1.0)
+
+
+def test_mutations_are_replayed_from_wal_without_rewriting_snapshot(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+    processor._add_chunks(30, ["ucuncu parca"], [[1.0, 1.0]])
+    processor.delete_documents([20, 30])
+
+    assert not (tmp_path / "manifest.json").exists()
+    with open(tmp_path / "wal.log", "ab") as wal:
+        wal.write(b"VWAL\x07")  # torn tail from a crash mid-append
+
+    reloaded = DocumentProcessor(store_path=tmp_path)
+
+    assert len(reloaded.index) == 1
+    reloaded._add_chunks(40, ["dorduncu parca"], [[0.0, 1.0]])
+    results = DocumentProcessor(store_path=tmp_path).search_in_documents("", top_k=5)
+    assert [(r["text"], r["report_id"]) for r in results] == [("ilk parca", 10), ("dorduncu parca", 40)]
+
+
+def test_compaction_folds_wal_into_snapshot_and_keeps_later_writes(tmp_path, mocker):
+    mocker.patch.object(document_processor, "VECTOR_WAL_COMPACT_BYTES", 1)
+    processor = DocumentProcessor(store_path=tmp_path)
+    mocker.patch.object(processor, "_maybe_compact")
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor.delete_document(10)
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+
+    stage = processor.store.stage_snapshot
+
+    def stage_with_concurrent_upload(*args, **kwargs):
+        processor._add_chunks(30, ["ucuncu parca"], [[1.0, 1.0]])
+        return stage(*args, **kwargs)
+
+    mocker.patch.object(processor.store, "stage_snapshot", side_effect=stage_with_concurrent_upload)
+    assert processor.compact() is True
+
+    manifest = json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))
+    assert manifest["rows"] == 1
+    assert not (tmp_path / "wal.log.compacting").exists()
+    assert isinstance(processor.index.base, np.memmap)
+    reloaded = DocumentProcessor(store_path=tmp_path)
+    assert [r["report_id"] for r in reloaded.search_in_documents("", top_k=5)] == [20, 30]
+
+
+def test_compaction_swaps_snapshots_under_the_store_lock(tmp_path, mocker):
+    import fcntl
+
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor.compact()
+    old_snapshot = json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))["snapshot"]
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+
+    def store_lock_held():
+        with open(tmp_path / "store.lock", "a+b") as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            return False
+
+    held = {}
+    stage, publish = processor.store.stage_snapshot, processor.store.publish_snapshot
+
+    def checked_stage(*args, **kwargs):
+        held["stage"] = store_lock_held()
+        manifest = stage(*args, **kwargs)
+        held["old snapshot kept"] = (tmp_path / old_snapshot).exists()
+        return manifest
+
+    def checked_publish(manifest):
+        held["publish"] = store_lock_held()
+        publish(manifest)
+
+    mocker.patch.object(processor.store, "stage_snapshot", side_effect=checked_stage)
+    mocker.patch.object(processor.store, "publish_snapshot", side_effect=checked_publish)
+    assert processor.compact() is True
+
+    assert held == {"stage": False, "old snapshot kept": True, "publish": True}
+    assert not (tmp_path / old_snapshot).exists()
+
+
+def test_processes_sharing_a_store_see_each_others_writes(tmp_path, mocker):
+    mocker.patch.object(document_processor, "VECTOR_STORE_REFRESH_SECONDS", 0)
+    worker_a = DocumentProcessor(store_path=tmp_path)
+    worker_b = DocumentProcessor(store_path=tmp_path)
+    worker_a._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    worker_b._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+
+    assert [r["report_id"] for r in worker_a.search_in_documents("", top_k=5)] == [10, 20]
+    load = mocker.spy(worker_a.store, "load")
+    assert worker_a.refresh() is False
+
+    worker_b.delete_document(10)
+    worker_b.compact()
+    worker_a._add_chunks(30, ["ucuncu parca"], [[1.0, 1.0]])
+
+    assert load.call_count == 1  # the compaction replaced the snapshot
+    assert [r["report_id"] for r in worker_b.search_in_documents("", top_k=5)] == [20, 30]
+    reloaded = DocumentProcessor(store_path=tmp_path)
+    assert [r["report_id"] for r in reloaded.search_in_documents("", top_k=5)] == [20, 30]
+    live_ids = reloaded.index.chunk_ids[reloaded.index.alive].tolist()
+    assert sorted(database.get_document_chunk_ids()) == sorted(live_ids)
+
+
+def test_catch_up_truncates_torn_tail_left_by_another_process(tmp_path, mocker):
+    mocker.patch.object(document_processor, "VECTOR_STORE_REFRESH_SECONDS", 0)
+    worker_a = DocumentProcessor(store_path=tmp_path)
+    worker_b = DocumentProcessor(store_path=tmp_path)
+    worker_a._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    with open(tmp_path / "wal.log", "ab") as wal:
+        wal.write(b"VWAL\x07")  # worker A died mid-append
+
+    worker_b._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+
+    assert len(worker_b.index) == 2
+    reloaded = DocumentProcessor(store_path=tmp_path)
+    assert [r["report_id"] for r in reloaded.search_in_documents("", top_k=5)] == [10, 20]
+    assert database.get_document_chunk_ids() == [1, 2]
+
+
+def test_unreadable_store_refuses_writes_and_keeps_chunk_rows(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor.compact()
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+    snapshot = json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))["snapshot"]
+    vectors_path = tmp_path / snapshot / "vectors.npy"
+    vectors_path.rename(tmp_path / "vectors.npy.bak")
+
+    broken = DocumentProcessor(store_path=tmp_path)
+    assert broken.search_in_documents("", top_k=5) == []
+    with pytest.raises(RuntimeError, match="could not be loaded"):
+        broken._add_chunks(30, ["ucuncu parca"], [[1.0, 1.0]])
+    assert database.get_document_chunk_ids() == [1, 2]
+
+    (tmp_path / "vectors.npy.bak").rename(vectors_path)
+    broken._add_chunks(30, ["ucuncu parca"], [[1.0, 1.0]])
+    assert [r["report_id"] for r in broken.search_in_documents("", top_k=5)] == [10, 20, 30]
+    assert database.get_document_chunk_ids() == [1, 2, 3]
+
+
+def test_orphan_sweep_only_removes_ids_the_store_never_logged(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+    processor.delete_document(20)
+    processor.compact()
+    # An upload that died between storing its text and logging its vectors.
+    database.add_document_chunks(30, ["yarim kalan"], min_id=3)
+
+    DocumentProcessor(store_path=tmp_path).search_in_documents("", top_k=5)
+    assert database.get_document_chunk_ids() == [1]
+    assert json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))["max_chunk_id"] == 2
+    assert DocumentProcessor(store_path=tmp_path)._add_chunks(40, ["yeni"], [[1.0, 1.0]]) == [3]
+
+
+def test_ivf_mode_builds_persists_and_extends_ann_index(tmp_path, mocker):
+    mocker.patch.object(document_processor, "VECTOR_INDEX_MODE", "ivf")
+    mocker.patch.object(document_processor, "IVF_MIN_ROWS", 100)
+    mocker.patch.object(document_processor, "IVF_NLIST", 8)
+    mocker.patch.object(document_processor, "IVF_NPROBE", 8)
+    mocker.patch.object(DocumentProcessor, "_maybe_build_ann_index")
+    rng = np.random.default_rng(11)
+    vectors = rng.normal(size=(400, 16))
+
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(1, [f"chunk {i}" for i in range(50)], vectors[:50])
+    processor._embed_many_uncached = lambda texts: [vectors[10]]
+    spy = mocker.spy(processor.index, "search_many")
+    processor.search_in_documents("soru", top_k=3)
+    assert spy.call_count == 1  # small stores stay on brute force
+
+    processor._add_chunks(2, [f"chunk {i}" for i in range(50, 300)], vectors[50:300])
+    assert processor.build_ann_index() is True
+    assert (tmp_path / "manifest.json").exists()
+
+    reloaded = DocumentProcessor(store_path=tmp_path)
+    assert reloaded.index.ivf is not None
+    reloaded._add_chunks(3, [f"chunk {i}" for i in range(300, 400)], vectors[300:])
+    assert reloaded.index.ivf.assignments.shape[0] == 400
+    reloaded._embed_many_uncached = lambda texts: [vectors[350]]
+    assert reloaded.search_in_documents("soru", top_k=1)[0]["text"] == "chunk 350"
+    assert reloaded.ann_recall(sample_size=50, top_k=5) == 1.0
+
+
+def test_legacy_metadata_json_is_migrated_to_snapshot(tmp_path):
+    legacy = {
+        "1": {"report_id": 10, "text": "ilk parca", "embedding": [1.0, 0.0]},
+        "2": {"report_id": 20, "text": "ikinci parca", "embedding": [0.0, 1.0]},
+    }
+    (tmp_path / "metadata.json").write_text(json.dumps(legacy), encoding="utf-8")
+
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._embed_many_uncached = lambda texts: [[0.0, 1.0]]
+
+    assert not (tmp_path / "metadata.json").exists()
+    assert (tmp_path / "manifest.json").exists()
+    result = processor.search_in_documents("query", top_k=1)[0]
+    assert (result["text"], result["report_id"]) == ("ikinci parca", 20)
+    # Once the database holds the text, the snapshot is rewritten without it.
+    manifest = json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))
+    assert not (tmp_path / manifest["snapshot"] / "catalog.json").exists()
+    assert database.get_document_chunk_texts([1, 2]) == {1: "ilk parca", 2: "ikinci parca"}
+
+
+def test_embed_many_uses_lm_studio_openai_embeddings_api(tmp_path, mocker):
     mocker.patch.object(document_processor, "LLM_PROVIDER", "lmstudio")
     mock_resp = mocker.Mock()
     mock_resp.raise_for_status = lambda: None
@@ -47,8 +331,8 @@ def test_embed_many_uses_lm_studio_openai_embeddings_api(mocker):
             {"index": 0, "embedding": [1.0, 0.0]},
         ]
     }
-    post = mocker.patch("document_processor.requests.post", return_value=mock_resp)
-    processor = DocumentProcessor()
+    processor = DocumentProcessor(store_path=tmp_path)
+    post = mocker.patch.object(processor.embedding_client.session, "post", return_value=mock_resp)
     out = processor._embed_many(["first", "second"])
     assert out == [[1.0, 0.0], [0.0, 1.0]]
     assert post.call_count == 1
@@ -58,16 +342,549 @@ def test_embed_many_uses_lm_studio_openai_embeddings_api(mocker):
     assert post.call_args.kwargs["json"]["input"] == ["first", "second"]
 
 
-def test_embed_many_uses_ollama_when_llm_provider_ollama(mocker):
+def test_embed_many_uses_ollama_when_llm_provider_ollama(tmp_path, mocker):
     mocker.patch.object(document_processor, "LLM_PROVIDER", "ollama")
     mock_resp = mocker.Mock()
     mock_resp.raise_for_status = lambda: None
     mock_resp.json.return_value = {"embeddings": [[0.5], [0.25]]}
-    post = mocker.patch("document_processor.requests.post", return_value=mock_resp)
-    processor = DocumentProcessor()
+    processor = DocumentProcessor(store_path=tmp_path)
+    post = mocker.patch.object(processor.embedding_client.session, "post", return_value=mock_resp)
     out = processor._embed_many(["x", "y"])
     assert out == [[0.5], [0.25]]
     assert post.call_count == 1
     assert "/api/embed" in post.call_args.args[0]
     assert post.call_args.kwargs["json"]["model"] == OLLAMA_EMBED_MODEL
     assert post.call_args.kwargs["json"]["input"] == ["x", "y"]
+
+
+def test_plan_batches_respects_character_and_item_budgets():
+    texts = ["a" * 40, "b" * 40, "c" * 10, "d" * 100, "e", "f", "g"]
+
+    assert plan_batches(texts, max_chars=90, max_items=2) == [(0, 2), (2, 3), (3, 4), (4, 6), (6, 7)]
+    assert plan_batches([], max_chars=90, max_items=2) == []
+
+
+def test_embedding_client_posts_batches_concurrently_in_order():
+    client = EmbeddingClient(max_in_flight=3, max_batch_chars=10, max_batch_items=2)
+    texts = [f"text-{i}" for i in range(9)]
+    seen = []
+
+    def post_batch(batch):
+        seen.append(len(batch))
+        return [[float(text.split("-")[1])] for text in batch]
+
+    assert client.embed(texts, post_batch) == [[float(i)] for i in range(9)]
+    assert sorted(seen) == [1] * 9
+    client.close()
+
+
+def test_embedding_client_splits_batches_the_server_rejects(mocker):
+    import requests
+
+    client = EmbeddingClient(max_in_flight=2, max_batch_chars=1000, max_batch_items=8)
+    too_large = requests.HTTPError(response=mocker.Mock(status_code=413))
+
+    def post_batch(batch):
+        if len(batch) > 2:
+            raise too_large
+        return [[1.0] for _ in batch]
+
+    assert client.embed(["x" * 10] * 8, post_batch) == [[1.0]] * 8
+    assert client.max_batch_chars == 20
+
+
+def test_embedding_client_only_splits_size_errors_and_recovers_its_budget(mocker):
+    import requests
+
+    client = EmbeddingClient(max_in_flight=1, max_batch_chars=40, max_batch_items=8, recover_after=2)
+    bad_model = requests.HTTPError(response=mocker.Mock(status_code=400, text='{"error": "model not found"}'))
+    post_batch = mocker.Mock(side_effect=bad_model)
+    with pytest.raises(requests.HTTPError):
+        client.embed(["x" * 10] * 4, post_batch)
+    assert post_batch.call_count == 1 and client.max_batch_chars == 40
+
+    too_long = requests.HTTPError(
+        response=mocker.Mock(status_code=400, text="input exceeds the model's context length")
+    )
+    with pytest.raises(requests.HTTPError):
+        client.embed(["x" * 100], mocker.Mock(side_effect=too_long))  # one text can't be split
+
+    sizes = []
+
+    def post_batch(batch):
+        sizes.append(len(batch))
+        if len(batch) > 2 and len(sizes) == 1:
+            raise too_long
+        return [[1.0] for _ in batch]
+
+    assert client.embed(["x" * 10] * 4, post_batch) == [[1.0]] * 4
+    assert sizes == [4, 2, 2] and client.max_batch_chars == 40  # two successes doubled 20 back to 40
+
+
+def test_embed_many_serves_repeated_chunks_from_cache(tmp_path, mocker):
+    mocker.patch.object(document_processor, "LLM_PROVIDER", "lmstudio")
+    uncached = mocker.patch.object(
+        DocumentProcessor, "_embed_many_uncached", side_effect=lambda texts: [[float(len(t)), 1.0] for t in texts]
+    )
+    processor = DocumentProcessor(store_path=tmp_path)
+
+    first = processor._embed_many(["header", "body one", "header"])
+    second = DocumentProcessor(store_path=tmp_path)._embed_many(["header", "body two"])
+
+    assert first == [[6.0, 1.0], [8.0, 1.0], [6.0, 1.0]]
+    assert uncached.call_args_list[0].args == (["header", "body one"],)
+    assert second == [[6.0, 1.0], [8.0, 1.0]]
+    assert uncached.call_args.args == (["body two"],)
+    assert processor.embedding_cache.stats()["hits"] == 0
+
+    mocker.patch.object(document_processor, "LLM_PROVIDER", "ollama")
+    processor._embed_many(["header"])
+    assert uncached.call_args.args == (["header"],)
+
+
+def test_embedding_cache_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    cache.put_many("m", ["a", "b"], [[1.0], [2.0]])
+    assert cache.get_many("m", ["a"]) == [[1.0]]
+    cache.put_many("m", ["c"], [[3.0]])
+
+    assert cache.get_many("m", ["a", "b", "c"]) == [[1.0], None, [3.0]]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["entries"]) == (3, 1, 1, 2)
+
+
+def test_repeated_queries_skip_the_embedding_server(tmp_path, mocker):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    embed = mocker.patch.object(processor, "_embed_many_uncached", return_value=[[1.0, 0.0]])
+    chunk_cache = mocker.spy(processor.embedding_cache, "put_many")
+
+    processor.search_in_documents("Yillik izin nasil alinir?")
+    processor.search_in_documents("  yillik IZIN   nasil alinir?")
+    mocker.patch.object(document_processor, "LLM_PROVIDER", "ollama")
+    processor._embed_query("Yillik izin nasil alinir?")  # searches would now skip vectors of the old model
+
+    assert embed.call_count == 2
+    chunk_cache.assert_not_called()  # queries never reach the on-disk chunk cache
+    stats = processor.cache_stats()["query_cache"]
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+    assert stats["saved_ms"] >= 0
+
+
+def test_query_cache_expires_entries_and_evicts_oldest(mocker):
+    clock = mocker.patch("embedding_cache.time.monotonic", return_value=100.0)
+    cache = QueryEmbeddingCache(max_entries=2, ttl_seconds=60)
+    cache.put("a", [1.0], 5.0)
+    cache.put("b", [2.0], 5.0)
+    assert cache.get("a") == [1.0]
+    cache.put("c", [3.0], 5.0)
+
+    assert cache.get("b") is None
+    clock.return_value = 161.0
+    assert cache.get("a") is None
+    assert cache.stats()["saved_ms"] == 5.0
+
+
+def _reference_chunks(text, size=900, overlap=120):
+    text = " ".join(text.split())
+    chunks, cursor = [], 0
+    while cursor < len(text):
+        end = min(len(text), cursor + size)
+        chunks.append(text[cursor:end].strip())
+        if end >= len(text):
+            break
+        cursor = max(end - overlap, cursor + 1)
+    return [chunk for chunk in chunks if chunk]
+
+
+def test_streamed_chunks_match_chunking_the_whole_text(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    rng = random.Random(3)
+    words = ["vergi", "belediye", "rapor", "  ", "\n", "su", "yol", "bütçe"]
+    pages = [" ".join(rng.choice(words) for _ in range(rng.randint(0, 400))) for _ in range(25)]
+    pages.insert(5, "   ")
+
+    assert list(processor._iter_chunks(iter(pages))) == _reference_chunks(" ".join(pages))
+    assert processor._split_text("kısa metin") == ["kısa metin"]
+
+
+def test_embed_document_stores_batches_and_rolls_back_on_failure(tmp_path, mocker):
+    mocker.patch.object(document_processor, "INGEST_BATCH_CHUNKS", 2)
+    mark = mocker.patch("document_processor.database.mark_report_as_processed")
+    source = tmp_path / "report.pdf"
+    source.write_bytes(b"%PDF-1.4")
+    processor = DocumentProcessor(store_path=tmp_path / "store")
+    pages = ["a" * 900, "b" * 900, "c" * 900, "d" * 900]
+    mocker.patch.object(processor, "_iter_pages", return_value=iter(pages))
+    embed = mocker.patch.object(processor, "_embed_many", side_effect=lambda texts: [[1.0, 0.0] for _ in texts])
+
+    assert processor.embed_document(source, 7) == 5
+    assert embed.call_count == 3
+    assert len(processor.index) == 5
+    mark.assert_called_once_with(7)
+
+    mocker.patch.object(processor, "_iter_pages", return_value=iter(pages))
+    embed.side_effect = [[[1.0, 0.0]] * 2, RuntimeError("embedding server down")]
+    with pytest.raises(RuntimeError):
+        processor.embed_document(source, 7)
+    assert len(processor.index) == 0
+
+
+def test_docx_pages_are_parsed_in_worker_processes(tmp_path, mocker):
+    import docx
+
+    mocker.patch.object(document_processor, "PARSE_WORKERS", 2)
+    path = tmp_path / "report.docx"
+    document = docx.Document()
+    for text in ["Birinci paragraf", "", "Ikinci paragraf"]:
+        document.add_paragraph(text)
+    document.save(path)
+    processor = DocumentProcessor(store_path=tmp_path / "store")
+
+    assert list(processor._iter_chunks(processor._iter_pages(path))) == ["Birinci paragraf Ikinci paragraf"]
+    assert processor._parse_pool is not None
+    processor._reset_parse_pool()
+
+
+def test_extracted_pages_are_cached_for_the_next_embedding(tmp_path, mocker):
+    import docx
+
+    mocker.patch.object(document_processor, "PARSE_WORKERS", 0)
+    path = tmp_path / "report.docx"
+    document = docx.Document()
+    for text in ["Birinci   paragraf", "", "Ikinci paragraf"]:
+        document.add_paragraph(text)
+    document.save(path)
+    processor = DocumentProcessor(store_path=tmp_path / "store")
+    processor._embed_many = lambda texts: [[1.0, 0.0]] * len(texts)
+
+    assert processor.embed_document(path, 7) == 1
+    assert database.has_report_pages(7)
+    assert list(database.iter_report_pages(7)) == ["Birinci paragraf", "Ikinci paragraf"]
+    path.unlink()
+    mocker.patch.object(processor, "_iter_pages", side_effect=AssertionError("parsed again"))
+
+    assert processor.embed_document(path, 7) == 1
+    assert [r["text"] for r in processor.search_in_documents("", report_ids=[7])] == [
+        "Birinci paragraf Ikinci paragraf"
+    ]
+    database.delete_report(7)
+    assert not database.has_report_pages(7)
+    assert list(database.iter_report_pages(7)) == []
+
+
+def test_page_cache_is_written_as_pages_stream_and_trusted_only_when_complete(tmp_path, mocker):
+    mocker.patch.object(document_processor, "PARSE_PAGES_PER_TASK", 2)
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._embed_many = lambda texts: [[1.0, 0.0]] * len(texts)
+
+    def pages():
+        for number in range(5):
+            yield f"sayfa {number}"
+        raise RuntimeError("parser crashed")
+
+    cached = processor._cached_pages(8, pages())
+    assert [next(cached) for _ in range(3)] == ["sayfa 0", "sayfa 1", "sayfa 2"]
+    with database.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM report_pages WHERE report_id = 8").fetchone()[0] == 2
+    with pytest.raises(RuntimeError):
+        list(cached)
+    assert not database.has_report_pages(8)  # four pages were written, but not the whole document
+
+    mocker.patch.object(processor, "_iter_pages", return_value=iter(f"sayfa {n}" for n in range(5)))
+    source = tmp_path / "r8.pdf"
+    source.write_bytes(b"")
+    processor.embed_document(source, 8)
+    assert database.has_report_pages(8)
+    assert list(database.iter_report_pages(8, batch_size=2)) == [f"sayfa {n}" for n in range(5)]
+
+
+def test_store_records_the_embedding_model_and_refuses_mixing(tmp_path, mocker):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(1, ["izin proseduru"], [[1.0, 0.0]])
+    processor.compact()
+    model = document_processor._active_embed_model()
+    assert json.loads((tmp_path / "manifest.json").read_text(encoding="utf-8"))["embed_model"] == model
+
+    mocker.patch.object(document_processor, "LM_STUDIO_EMBED_MODEL", "another-model")
+    reloaded = DocumentProcessor(store_path=tmp_path)
+    embed = mocker.patch.object(reloaded, "_embed_many")
+
+    assert reloaded.store.model == model
+    assert [r["text"] for r in reloaded.search_in_documents("izin", mode="vector")] == ["izin proseduru"]
+    embed.assert_not_called()
+    with pytest.raises(ValueError, match="reembed.py"):
+        reloaded._add_chunks(2, ["yeni"], [[0.0, 1.0]])
+    reloaded.delete_document(1)
+    reloaded._add_chunks(2, ["yeni"], [[0.0, 1.0]])  # an empty store takes the new model
+    assert DocumentProcessor(store_path=tmp_path).store.model == "lmstudio:another-model"
+
+
+def test_pdf_over_the_page_budget_is_rejected(tmp_path, mocker):
+    import pypdf
+
+    mocker.patch.object(document_processor, "PARSE_WORKERS", 0)
+    mocker.patch.object(document_processor, "PARSE_MAX_PAGES", 2)
+    writer = pypdf.PdfWriter()
+    for _ in range(3):
+        writer.add_blank_page(width=200, height=200)
+    path = tmp_path / "long.pdf"
+    with open(path, "wb") as f:
+        writer.write(f)
+    processor = DocumentProcessor(store_path=tmp_path / "store")
+
+    with pytest.raises(ValueError, match="3 pages"):
+        list(processor._iter_pages(path))
+
+
+def test_slow_parse_times_out_and_restarts_the_pool(tmp_path, mocker):
+    import time
+
+    mocker.patch.object(document_processor, "PARSE_WORKERS", 1)
+    mocker.patch.object(document_processor, "PARSE_TIMEOUT_SECONDS", 0.5)
+    processor = DocumentProcessor(store_path=tmp_path)
+
+    with pytest.raises(TimeoutError):
+        processor._parse(time.sleep, 30)
+    assert processor._parse_pool is None
+    mocker.patch.object(document_processor, "PARSE_TIMEOUT_SECONDS", 30)
+    assert processor._parse(abs, -3) == 3
+    processor._reset_parse_pool()
+
+
+def test_parse_timeout_resubmits_other_documents_tasks(tmp_path, mocker):
+    mocker.patch.object(document_processor, "PARSE_WORKERS", 1)
+    mocker.patch.object(document_processor, "PARSE_TIMEOUT_SECONDS", 1)
+    processor = DocumentProcessor(store_path=tmp_path)
+    errors = []
+
+    def stuck():
+        try:
+            processor._parse(time.sleep, 30)
+        except TimeoutError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=stuck)
+    thread.start()
+    time.sleep(0.3)
+    assert processor._parse(abs, -3) == 3  # queued behind the stuck task when its pool was stopped
+    thread.join()
+    assert len(errors) == 1
+    processor._reset_parse_pool()
+
+
+def test_parse_timeout_does_not_count_time_spent_by_the_reader(tmp_path, mocker):
+    import pypdf
+
+    mocker.patch.object(document_processor, "PARSE_WORKERS", 1)
+    mocker.patch.object(document_processor, "PARSE_PAGES_PER_TASK", 1)
+    mocker.patch.object(document_processor, "PARSE_TIMEOUT_SECONDS", 1)
+    writer = pypdf.PdfWriter()
+    for _ in range(4):
+        writer.add_blank_page(width=200, height=200)
+    path = tmp_path / "report.pdf"
+    with open(path, "wb") as f:
+        writer.write(f)
+    processor = DocumentProcessor(store_path=tmp_path / "store")
+
+    pages = []
+    for text in processor._parse_pages(document_parser.extract_pdf_pages, path, 4):
+        time.sleep(0.4)  # e.g. embedding the page's chunks
+        pages.append(text)
+    assert pages == ["", "", "", ""]
+    processor._reset_parse_pool()
+
+
+def test_lexical_search_finds_exact_codes_without_embedding(tmp_path, mocker):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(
+        1, ["Genel bütçe raporu", "Poliçe numarası POL-2024-0042 iptal edildi"], [[1.0, 0.0], [0.0, 1.0]]
+    )
+    processor._add_chunks(2, ["POL-2024-0042 başka raporda"], [[1.0, 1.0]])
+    embed = mocker.patch.object(processor, "_embed_query")
+
+    results = processor.search_in_documents("POL-2024-0042", top_k=5, mode="lexical")
+    assert sorted(r["report_id"] for r in results) == [1, 2]
+    assert processor.search_in_documents("pol-2024-0042", report_ids=[1], mode="lexical")[0]["text"].startswith("Poliçe")
+    embed.assert_not_called()
+
+
+def test_hybrid_search_fuses_rankings_and_survives_embedding_failure(tmp_path, mocker):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(
+        1, ["form A-17 başvuru", "su faturası itiraz", "park cezası"], [[0.0, 1.0], [1.0, 0.0], [0.7, 0.7]]
+    )
+    mocker.patch.object(processor, "_embed_query", return_value=[1.0, 0.0])
+
+    results = processor.search_in_documents("A-17 itiraz", top_k=3, mode="hybrid")
+    # "su faturası itiraz" is first by both rankings; the form code only matches lexically.
+    assert results[0]["text"] == "su faturası itiraz"
+    assert "form A-17 başvuru" in [r["text"] for r in results]
+
+    mocker.patch.object(processor, "_embed_query", side_effect=RuntimeError("backend down"))
+    assert processor.search_in_documents("A-17", mode="hybrid")[0]["text"] == "form A-17 başvuru"
+    with pytest.raises(RuntimeError):
+        processor.search_in_documents("A-17", mode="vector")
+
+
+def test_chunk_text_follows_reports_in_the_database(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(3, ["yol bakım planı"], [[1.0, 0.0]])
+    processor._add_chunks(4, ["park bakım takvimi"], [[0.0, 1.0]])
+    database.add_document_chunks(5, ["bakım kaydı kaldı"])  # text stored, then the upload crashed
+
+    reloaded = DocumentProcessor(store_path=tmp_path)
+    assert sorted(r["report_id"] for r in reloaded.search_in_documents("bakım", mode="lexical")) == [3, 4]
+
+    database.delete_report(3)
+    assert [r["report_id"] for r in reloaded.search_in_documents("bakım", mode="lexical")] == [4]
+    with pytest.raises(ValueError):
+        reloaded._add_chunks(999, ["rapor yok"], [[1.0, 1.0]])
+
+
+def test_quantized_codes_are_persisted_and_checked_against_float32(tmp_path, mocker):
+    mocker.patch.object(document_processor, "VECTOR_QUANTIZATION", "int8")
+    rng = np.random.default_rng(4)
+    vectors = rng.normal(size=(200, 16))
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(1, [f"chunk {i}" for i in range(200)], vectors)
+    processor.compact()
+
+    reloaded = DocumentProcessor(store_path=tmp_path)
+
+    assert reloaded.index.quantization == "int8"
+    assert isinstance(reloaded.index.codes.base_codes, np.memmap)
+    recall = reloaded.quantization_recall(sample_size=30, top_k=5)
+    assert recall["rescored"] == 1.0
+    reloaded._embed_query = lambda query: vectors[42]
+    assert reloaded.search_in_documents("soru", top_k=1)[0]["text"] == "chunk 42"
+
+
+def test_truncated_prefilter_codes_are_persisted(tmp_path, mocker):
+    mocker.patch.object(document_processor, "VECTOR_PREFILTER_DIMS", 8)
+    rng = np.random.default_rng(6)
+    vectors = rng.normal(size=(120, 16))
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(1, [f"chunk {i}" for i in range(120)], vectors)
+    processor.compact()
+
+    reloaded = DocumentProcessor(store_path=tmp_path)
+
+    assert (reloaded.index.quantization, reloaded.index.code_dims) == ("float32", 8)
+    assert reloaded.index.codes.base_codes.shape == (120, 8)
+    assert reloaded.quantization_recall(sample_size=20, top_k=5)["rescored"] == 1.0
+    reloaded._embed_query = lambda query: vectors[7]
+    assert reloaded.search_in_documents("soru", top_k=1)[0]["text"] == "chunk 7"
+
+
+def test_searches_run_against_snapshots_while_chunks_are_added(tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(1, ["ilk"], [[1.0, 0.0, 0.0]])
+    processor._embed_query = lambda query: np.array([1.0, 0.0, 0.0])
+    snapshot = processor.index
+    errors = []
+
+    def write(report_id):
+        try:
+            for number in range(20):
+                processor._add_chunks(report_id, [f"r{report_id}-{number}"], [[0.0, 1.0, number + 1.0]])
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            for _ in range(50):
+                assert processor.search_in_documents("soru", top_k=3)[0]["text"] == "ilk"
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(report_id,)) for report_id in (2, 3)]
+    threads += [threading.Thread(target=read) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(snapshot) == 1
+    assert len(processor.index) == 41
+    assert len(set(processor.index.chunk_ids.tolist())) == 41
+
+
+def test_concurrent_searches_are_scored_in_one_batch(tmp_path, mocker):
+    mocker.patch.object(document_processor, "SEARCH_BATCH_WINDOW_MS", 50)
+    rng = np.random.default_rng(5)
+    vectors = rng.normal(size=(300, 16))
+    processor = DocumentProcessor(store_path=tmp_path)
+    processor._add_chunks(1, [f"chunk {i}" for i in range(300)], vectors)
+    processor._embed_query = lambda query: vectors[int(query)]
+    expected = {i: processor.index.search(vectors[i], top_k=2)[0][0] for i in range(0, 300, 30)}
+    score = processor.index.search_many
+
+    def slow_search_many(*args, **kwargs):
+        time.sleep(0.02)  # long enough for the other searches to queue up behind the first
+        return score(*args, **kwargs)
+
+    search_many = mocker.patch.object(processor.index, "search_many", side_effect=slow_search_many)
+    barrier = threading.Barrier(len(expected))
+    found = {}
+
+    def ask(number):
+        barrier.wait()
+        found[number] = processor.search_in_documents(str(number), top_k=2)
+
+    threads = [threading.Thread(target=ask, args=(number,)) for number in expected]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert {number: hits[0]["text"] for number, hits in found.items()} == {
+        number: f"chunk {chunk_id - 1}" for number, chunk_id in expected.items()
+    }
+    assert all(len(hits) == 2 for hits in found.values())
+    assert search_many.call_count < len(expected)
+    assert processor.search_batcher.stats()["queries"] == len(expected)
+
+
+def test_concurrent_searches_of_different_reports_are_batched(tmp_path, mocker):
+    mocker.patch.object(document_processor, "SEARCH_BATCH_WINDOW_MS", 50)
+    rng = np.random.default_rng(6)
+    vectors = rng.normal(size=(100, 16))
+    processor = DocumentProcessor(store_path=tmp_path)
+    for report_id in range(1, 11):
+        rows = slice((report_id - 1) * 10, report_id * 10)
+        processor._add_chunks(report_id, [f"chunk {i}" for i in range(100)[rows]], vectors[rows])
+    processor._embed_query = lambda query: vectors[int(query)]
+    score = processor.index.search_many
+
+    def slow_search_many(*args, **kwargs):
+        time.sleep(0.02)
+        return score(*args, **kwargs)
+
+    search_many = mocker.patch.object(processor.index, "search_many", side_effect=slow_search_many)
+    # Each query asks about another report than the one its vector came from.
+    asked = {number: (number // 10 + 1) % 10 + 1 for number in range(5, 100, 10)}
+    expected = {
+        number: processor.index.search(vectors[number], top_k=3, report_ids=[report_id])
+        for number, report_id in asked.items()
+    }
+    barrier = threading.Barrier(len(asked))
+    found = {}
+
+    def ask(number):
+        barrier.wait()
+        found[number] = processor.search_in_documents(
+            str(number), top_k=3, report_ids=[asked[number]], mode="vector"
+        )
+
+    threads = [threading.Thread(target=ask, args=(number,)) for number in asked]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert {number: [hit["text"] for hit in hits] for number, hits in found.items()} == {
+        number: [f"chunk {chunk_id - 1}" for chunk_id, _, _ in hits] for number, hits in expected.items()
+    }
+    assert search_many.call_count < len(asked)
@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pytest
+
+import database
+import document_processor
+from document_processor import DocumentProcessor
+from reembed import Reembedder
+
+pytestmark = pytest.mark.usefixtures("chunk_db")
+
+
+def new_model_vectors(texts):
+    """Stand-in for the new embedding model: 3-d vectors, keyed on the text."""
+    return [[1.0, 0.0, 0.0] if "izin" in text else [0.0, 0.0, 1.0] for text in texts]
+
+
+def test_reembed_resumes_and_swaps_in_the_new_model(tmp_path, mocker):
+    processor = DocumentProcessor(store_path=str(tmp_path / "store"))
+    processor._add_chunks(1, ["yillik izin", "hastalik izin raporu"], [[1.0, 0.0], [0.9, 0.1]])
+    processor._add_chunks(2, ["park bakimi"], [[0.0, 1.0]])
+    old_ids = sorted(database.get_document_chunk_ids())
+    mocker.patch.object(document_processor, "LM_STUDIO_EMBED_MODEL", "new-model")
+
+    calls = []
+
+    def embed_failing_on_parks(texts):
+        calls.append(list(texts))
+        if "park bakimi" in texts:
+            raise RuntimeError("embedding server went away")
+        return new_model_vectors(texts)
+
+    processor._embed_many = embed_failing_on_parks
+    with pytest.raises(RuntimeError):
+        Reembedder(processor, workers=1).run()
+    assert processor.store.model != "lmstudio:new-model"  # nothing published yet
+
+    calls.clear()
+    processor._embed_many = lambda texts: calls.append(list(texts)) or new_model_vectors(texts)
+    other_worker = DocumentProcessor(store_path=str(tmp_path / "store"))
+    replace_vectors = processor.replace_vectors
+
+    def upload_then_replace(*args):
+        database.add_document_chunks(3, ["izin formu"])  # stored while the first pass was running
+        return replace_vectors(*args)
+
+    mocker.patch.object(processor, "replace_vectors", side_effect=upload_then_replace)
+    reembedder = Reembedder(processor, workers=2)
+    assert reembedder.run() == 4
+
+    assert sorted(calls) == [["izin formu"], ["park bakimi"]]  # report 1 came from the checkpoint
+    assert not os.path.exists(reembedder.staging.path)
+    assert processor.store.model == "lmstudio:new-model"
+    assert processor.index.dim == 3
+    assert sorted(processor.index.chunk_ids.tolist()) == sorted(old_ids + [old_ids[-1] + 1])
+    processor._embed_query = lambda query: np.array([0.0, 0.0, 1.0])
+    assert processor.search_in_documents("bakim", top_k=1)[0]["text"] == "park bakimi"
+
+    assert other_worker.refresh() is True
+    assert (other_worker.store.model, other_worker.index.dim) == ("lmstudio:new-model", 3)
+
+
+def test_reembed_reads_one_report_at_a_time_and_logs_each_batch(tmp_path, mocker):
+    processor = DocumentProcessor(store_path=str(tmp_path / "store"))
+    processor._add_chunks(1, [f"izin {i}" for i in range(5)], [[1.0, 0.0]] * 5)
+    processor._add_chunks(2, ["park bakimi"], [[0.0, 1.0]])
+    mocker.patch.object(document_processor, "LM_STUDIO_EMBED_MODEL", "new-model")
+    mocker.patch("reembed.INGEST_BATCH_CHUNKS", 2)
+    processor._embed_many = mocker.Mock(side_effect=new_model_vectors)
+    read_chunks = mocker.spy(database, "get_report_chunks")
+
+    reembedder = Reembedder(processor, workers=1)
+    mocker.patch.object(processor, "replace_vectors", side_effect=RuntimeError("stop before publishing"))
+    with pytest.raises(RuntimeError):
+        reembedder.run()
+
+    assert [call.args for call in read_chunks.call_args_list] == [(1,), (2,)]
+    assert [len(call.args[0]) for call in processor._embed_many.call_args_list] == [2, 2, 1, 1]
+    staged, _ = reembedder.staging.load()
+    assert staged.chunk_ids_for_reports([1]) == [1, 2, 3, 4, 5]
+    assert reembedder._staged_chunk_ids() == {1: [1, 2, 3, 4, 5], 2: [6]}
@@ -0,0 +1,69 @@
+import inspect
+import threading
+
+import pytest
+
+from document_processor import DocumentProcessor
+from retrieval_client import RetrievalClient, RetrievalServiceError
+from retrieval_service import make_server
+
+
+pytestmark = pytest.mark.usefixtures("chunk_db")
+
+
+@pytest.fixture(params=["http", "unix"])
+def service(request, tmp_path):
+    processor = DocumentProcessor(store_path=tmp_path / "store")
+    processor._embed_query = lambda query: [1.0, 0.0] if "ilk" in query else [0.0, 1.0]
+    url = f"unix://{tmp_path / 'retrieval.sock'}" if request.param == "unix" else "http://127.0.0.1:0"
+    server = make_server(processor, url)
+    if request.param == "http":
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = RetrievalClient(url, timeout=10)
+    yield processor, client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_client_searches_and_deletes_through_the_service(service):
+    processor, client = service
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+    processor._add_chunks(20, ["ikinci parca"], [[0.0, 1.0]])
+
+    results = client.search_in_documents("ilk soru", top_k=1)
+    assert [(r["text"], r["report_id"]) for r in results] == [("ilk parca", 10)]
+    assert results[0]["score"] == pytest.approx(1.0)
+    assert client.search_in_documents("", top_k=5, report_ids={20}) == [
+        {"text": "ikinci parca", "report_id": 20, "score": None}
+    ]
+
+    client.delete_document(10)
+    assert [r["report_id"] for r in client.search_in_documents("ilk soru", top_k=5)] == [20]
+    assert set(client.cache_stats()) == {"embedding_cache", "query_cache"}
+
+
+def test_client_raises_service_errors_as_local_exceptions(service, tmp_path):
+    processor, client = service
+    processor._add_chunks(10, ["ilk parca"], [[1.0, 0.0]])
+
+    with pytest.raises(ValueError, match="Unknown search mode"):
+        client.search_in_documents("ilk", mode="fuzzy")
+    with pytest.raises(FileNotFoundError):
+        client.embed_document(tmp_path / "missing.pdf", 10)
+    assert client.process_and_embed_document(tmp_path / "missing.pdf", 10) is None
+
+    processor.search_in_documents = lambda **kwargs: 1 / 0
+    with pytest.raises(RetrievalServiceError, match="division by zero"):
+        client.search_in_documents("ilk")
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["search_in_documents", "embed_document", "process_and_embed_document",
+     "delete_document", "delete_documents", "clear", "cache_stats"],
+)
+def test_client_mirrors_document_processor_signatures(name):
+    assert inspect.signature(getattr(RetrievalClient, name)) == inspect.signature(getattr(DocumentProcessor, name))
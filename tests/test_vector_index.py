@@ -0,0 +1,155 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from search_benchmark import benchmark, sample_queries, synthetic_index
+from vector_index import IVFIndex, VectorIndex, recall_at_k, top_k_rows
+
+
+def test_top_k_rows_orders_best_first_and_keeps_row_order_on_ties():
+    scores = np.array([0.1, 0.9, 0.5, 0.9, -0.2], dtype=np.float32)
+    assert top_k_rows(scores, 3).tolist() == [1, 3, 2]
+    assert top_k_rows(scores, 10).tolist() == [1, 3, 2, 0, 4]
+
+
+def test_vector_index_remove_reports_drops_rows():
+    index = VectorIndex()
+    index.add([1, 2, 3], [10, 20, 10], [[1.0, 0.0], [0.0, 2.0], [3.0, 3.0]])
+
+    assert index.remove_reports([10]) == 2
+    assert len(index) == 1
+    chunk_id, report_id, score = index.search([0.0, 1.0], top_k=5)[0]
+    assert (chunk_id, report_id) == (2, 20)
+    assert score == pytest.approx(1.0)
+
+
+def test_vector_index_tracks_report_row_ranges():
+    index = VectorIndex()
+    index.add([1, 2], [10, 10], [[1.0, 0.0], [0.5, 0.5]])
+    index.add([3], [20], [[0.0, 1.0]])
+    index.add([4, 5], [10, 10], [[0.0, 1.0], [1.0, 1.0]])
+
+    assert index.report_ranges == {10: [(0, 2), (3, 5)], 20: [(2, 3)]}
+    assert [hit[0] for hit in index.search([0.0, 1.0], top_k=10, report_ids=[10])] == [4, 2, 5, 1]
+
+    index.remove_reports([20])
+    assert 20 not in index.report_ranges
+    assert index.search([0.0, 1.0], top_k=3, report_ids=[20]) == []
+
+
+def _clustered_vectors(rng, clusters=20, per_cluster=100, dim=32):
+    centers = rng.normal(size=(clusters, dim))
+    return np.concatenate([c + 0.15 * rng.normal(size=(per_cluster, dim)) for c in centers])
+
+
+def test_ivf_search_recall_against_exact_search():
+    rng = np.random.default_rng(3)
+    vectors = _clustered_vectors(rng)
+    index = VectorIndex()
+    index.add(list(range(len(vectors))), [i // 50 for i in range(len(vectors))], vectors)
+    index.ivf = IVFIndex.train(index, nlist=20)
+    queries = vectors[rng.choice(len(vectors), 50, replace=False)] + 0.05 * rng.normal(size=(50, 32))
+
+    assert recall_at_k(index, queries, top_k=10, nprobe=3) >= 0.9
+    assert recall_at_k(index, queries, top_k=10, nprobe=index.ivf.nlist) == 1.0
+
+
+def test_ivf_assignments_follow_added_and_removed_rows():
+    rng = np.random.default_rng(5)
+    vectors = _clustered_vectors(rng, clusters=4, per_cluster=50, dim=8)
+    index = VectorIndex()
+    index.add(list(range(150)), [1] * 150, vectors[:150])
+    index.ivf = IVFIndex.train(index, nlist=4)
+    trained = index.ivf
+
+    index.add(list(range(150, 200)), [2] * 50, vectors[150:])
+    index.remove_reports([1])
+
+    assert trained.assignments.shape[0] == 150
+    assert index.ivf.assignments.shape[0] == 200
+    assert sorted(np.concatenate(index.ivf.lists).tolist()) == list(range(200))
+    hits = index.search(vectors[170], top_k=5, nprobe=4)
+    assert hits[0][0] == 170
+    assert {report_id for _, report_id, _ in hits} == {2}
+
+
+@pytest.mark.parametrize("kind, max_bytes_per_dim", [("float16", 2), ("int8", 1.2)])
+def test_quantized_search_rescored_matches_float32(kind, max_bytes_per_dim):
+    rng = np.random.default_rng(9)
+    vectors = rng.normal(size=(3000, 64))
+    index = VectorIndex()
+    index.add(list(range(2000)), [i // 100 for i in range(2000)], vectors[:2000])
+    index.set_quantization(kind)
+    index.add(list(range(2000, 3000)), [i // 100 for i in range(2000, 3000)], vectors[2000:])
+    queries = vectors[rng.choice(3000, 40, replace=False)] + 0.3 * rng.normal(size=(40, 64))
+
+    assert index.codes.rows == 3000
+    assert index.codes.nbytes <= 3000 * 64 * max_bytes_per_dim
+    assert recall_at_k(index, queries, top_k=10, nprobe=None, rescore=False) >= 0.85
+    assert recall_at_k(index, queries, top_k=10, nprobe=None, rescore=True) >= 0.98
+    hit = index.search(vectors[2500], top_k=1, report_ids=[25])[0]
+    assert hit[0] == 2500 and hit[2] == pytest.approx(1.0, abs=1e-5)
+
+
+@pytest.mark.parametrize("kind", ["none", "int8"])
+def test_search_many_matches_one_search_per_query(kind):
+    rng = np.random.default_rng(3)
+    vectors = rng.normal(size=(500, 16))
+    index = VectorIndex()
+    index.add(list(range(500)), [i // 50 for i in range(500)], vectors)
+    index.set_quantization(kind)
+    index.remove_reports([3])
+    queries = rng.normal(size=(7, 16))
+
+    batched = index.search_many(queries, top_k=5)
+
+    assert len(batched) == 7
+    for query, hits in zip(queries, batched):
+        single = index.search(query, top_k=5)
+        assert [hit[0] for hit in hits] == [hit[0] for hit in single]
+        assert [hit[2] for hit in hits] == pytest.approx([hit[2] for hit in single], abs=1e-5)
+    assert VectorIndex().search_many(queries, top_k=5) == [[]] * 7
+
+
+@pytest.mark.parametrize("kind", ["none", "int8"])
+def test_filtered_search_many_keeps_each_querys_reports(kind):
+    rng = np.random.default_rng(4)
+    vectors = rng.normal(size=(500, 16))
+    index = VectorIndex()
+    index.add(list(range(500)), [i // 50 for i in range(500)], vectors)
+    index.set_quantization(kind)
+    index.remove_reports([3])
+    queries = rng.normal(size=(4, 16))
+    filters = [[1, 2], [3], [2, 7, 9], []]
+
+    batched = index.search_many(queries, top_k=5, report_ids=filters)
+
+    for query, report_ids, hits in zip(queries, filters, batched):
+        single = index.search(query, top_k=5, report_ids=report_ids)
+        assert [hit[0] for hit in hits] == [hit[0] for hit in single]
+        assert {hit[1] for hit in hits} <= set(report_ids)
+        assert [hit[2] for hit in hits] == pytest.approx([hit[2] for hit in single], abs=1e-5)
+    assert batched[1] == [] and batched[3] == []
+
+
+def test_truncated_codes_prefilter_then_rerank_at_full_dimension():
+    index = synthetic_index(rows=4000, dim=256)
+    queries = sample_queries(index, 30)
+
+    index.set_quantization("none", dims=64)
+    assert (index.quantization, index.code_dims) == ("float32", 64)
+    assert index.codes.base_codes.shape == (4000, 64)
+    index.add([4000], [99], queries[:1])
+    assert index.codes.rows == 4001
+    hit = index.search(queries[0], top_k=1, candidates=100)[0]
+    assert hit[0] == 4000 and hit[2] == pytest.approx(1.0, abs=1e-5)
+
+    rows = benchmark(index, queries, top_k=10, settings=[("none", 64, 20), ("none", 64, 300)])
+    assert [row["quantization"] for row in rows] == ["exact", "float32", "float32"]
+    assert rows[0]["recall"] == 1.0
+    assert rows[1]["recall"] <= rows[2]["recall"]
+    assert rows[2]["recall"] >= 0.95
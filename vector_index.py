@@ -0,0 +1,579 @@
+"""In-memory dense vector index used by `document_processor` for retrieval."""
+import copy
+
+import numpy as np
+
+QUANTIZATIONS = ("none", "float16", "int8")
+# Element types of `QuantizedRows` codes; "float32" codes only make sense truncated.
+CODE_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# With quantized codes, this many candidates per requested result are rescored at float32.
+RESCORE_FACTOR = 4
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    """Return `vectors` as a contiguous float32 matrix of unit-length rows.
+
+    Zero rows are left as zeros, so they score 0 against every query.
+    """
+    matrix = np.asarray(vectors, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> np.ndarray:
+    """Row positions of the `k` best scores, best first.
+
+    Uses `argpartition` so only the selected rows are sorted; ties keep row order
+    like the stable sort the pure-Python search used.
+    """
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(n)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order]
+
+
+class VectorIndex:
+    """Pre-normalized float32 rows with parallel chunk id / report id arrays.
+
+    Rows live in two blocks: `base`, usually a read-only memory map of the
+    on-disk snapshot, and `tail`, rows added in this process since it was
+    loaded. Deleted rows are only masked out in `alive`; they disappear from
+    disk the next time a snapshot is written. Cosine similarity against every
+    row is one matrix-vector product per block.
+
+    `report_ranges` maps each report id to the `[start, stop)` row ranges it
+    occupies (a report's chunks are always added together), so a search limited
+    to a few reports only touches their rows.
+
+    With `codes` (a `QuantizedRows`), the first pass scores the compact codes
+    and only the best candidates are rescored against the float32 rows, so the
+    full-precision matrix is read for a handful of rows per query. The codes
+    may also keep just the leading dimensions of each row (Matryoshka-style
+    truncation), which embedding models such as nomic-embed-text-v1.5 and
+    qwen3-embedding are trained to support.
+    """
+
+    def __init__(self, base=None, chunk_ids=None, report_ids=None, ivf=None, codes=None):
+        if base is None:
+            base = np.empty((0, 0), dtype=np.float32)
+        self.base = base
+        self.dim = int(base.shape[1])
+        self.tail = np.empty((0, self.dim), dtype=np.float32)
+        self.chunk_ids = np.array(chunk_ids if chunk_ids is not None else [], dtype=np.int64)
+        self.report_ids = np.array(report_ids if report_ids is not None else [], dtype=np.int64)
+        if self.chunk_ids.shape[0] != base.shape[0] or self.report_ids.shape[0] != base.shape[0]:
+            raise ValueError("chunk_ids and report_ids must have one entry per base row.")
+        self.alive = np.ones(base.shape[0], dtype=bool)
+        self.report_ranges = _row_ranges(self.report_ids)
+        # Optional IVFIndex covering every row; kept in step by `add`.
+        self.ivf = ivf
+        if codes is not None and codes.rows != base.shape[0]:
+            raise ValueError("codes must have one entry per base row.")
+        # Optional QuantizedRows covering every row; kept in step by `add`.
+        self.codes = codes
+
+    @property
+    def quantization(self) -> str:
+        return self.codes.kind if self.codes is not None else "none"
+
+    @property
+    def code_dims(self) -> int | None:
+        """Leading dimensions kept in the codes, or None when they keep every dimension."""
+        return self.codes.dims if self.codes is not None else None
+
+    def set_quantization(self, kind: str, dims: int = None):
+        """Encode every row as `kind` codes ("float16" / "int8"), or drop the codes ("none").
+
+        With `dims`, the codes keep only each row's first `dims` dimensions,
+        re-normalized; "none" then keeps them as float32.
+        """
+        if kind not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {kind}")
+        dims = dims or None
+        if kind == "none" and dims is None:
+            self.codes = None
+            return
+        kind = "float32" if kind == "none" else kind
+        if (kind, dims) != (self.quantization, self.code_dims):
+            self.codes = QuantizedRows.encode(kind, _iter_blocks(self), self.dim, dims)
+
+    def __len__(self):
+        """Number of live (not deleted) rows."""
+        return int(self.alive.sum())
+
+    @property
+    def total_rows(self) -> int:
+        return int(self.chunk_ids.shape[0])
+
+    @classmethod
+    def from_metadata(cls, metadata: dict) -> "VectorIndex":
+        """Build an index from `{chunk_id: {"report_id", "embedding", ...}}` entries."""
+        index = cls()
+        rows = [
+            (chunk_id, meta.get("report_id"), meta["embedding"])
+            for chunk_id, meta in sorted(metadata.items())
+            if meta.get("embedding")
+        ]
+        if rows:
+            chunk_ids, report_ids, vectors = zip(*rows)
+            index.add(chunk_ids, report_ids, vectors)
+        return index
+
+    def add(self, chunk_ids, report_ids, vectors):
+        block = normalize_rows(vectors)
+        if len(chunk_ids) != block.shape[0] or len(report_ids) != block.shape[0]:
+            raise ValueError("chunk_ids, report_ids and vectors must have the same length.")
+        start = self.total_rows
+        if self.total_rows == 0:
+            self.dim = int(block.shape[1])
+            self.base = np.empty((0, self.dim), dtype=np.float32)
+            self.tail = block
+        else:
+            if block.shape[1] != self.dim:
+                raise ValueError(
+                    f"Embedding dimension mismatch: index has {self.dim}, got {block.shape[1]}."
+                )
+            self.tail = np.concatenate([self.tail, block])
+        self.chunk_ids = np.concatenate([self.chunk_ids, np.asarray(chunk_ids, dtype=np.int64)])
+        self.report_ids = np.concatenate([self.report_ids, np.asarray(report_ids, dtype=np.int64)])
+        self.alive = np.concatenate([self.alive, np.ones(block.shape[0], dtype=bool)])
+        ranges = dict(self.report_ranges)
+        for report_id, row_range in _row_ranges(self.report_ids[start:], offset=start).items():
+            ranges[report_id] = ranges.get(report_id, []) + row_range
+        self.report_ranges = ranges
+        if self.ivf is not None:
+            self.ivf = self.ivf.extended(block, start)
+        if self.codes is not None:
+            if start:
+                self.codes = self.codes.extended(block)
+            else:
+                self.codes = QuantizedRows.encode(self.codes.kind, [block], self.dim, self.codes.dims)
+
+    def chunk_ids_for_reports(self, report_ids) -> list[int]:
+        """Chunk ids of the live rows that belong to `report_ids`."""
+        rows = self.alive & np.isin(self.report_ids, np.asarray(list(report_ids), dtype=np.int64))
+        return self.chunk_ids[rows].tolist()
+
+    def remove_reports(self, report_ids) -> int:
+        """Mask out every row belonging to `report_ids`; returns the number of rows removed."""
+        doomed = self.alive & np.isin(self.report_ids, np.asarray(list(report_ids), dtype=np.int64))
+        removed = int(doomed.sum())
+        if removed:
+            self.alive = self.alive & ~doomed
+            dropped = {int(r) for r in report_ids}
+            self.report_ranges = {
+                rid: ranges for rid, ranges in self.report_ranges.items() if rid not in dropped
+            }
+        return removed
+
+    def iter_live_blocks(self, block_rows: int = 65536):
+        """Yield `(vectors, chunk_ids, report_ids)` for live rows, `block_rows` at a time."""
+        base_rows = self.base.shape[0]
+        for matrix, offset in ((self.base, 0), (self.tail, base_rows)):
+            for start in range(0, matrix.shape[0], block_rows):
+                stop = min(matrix.shape[0], start + block_rows)
+                keep = self.alive[offset + start : offset + stop]
+                if not keep.any():
+                    continue
+                yield (
+                    np.asarray(matrix[start:stop])[keep],
+                    self.chunk_ids[offset + start : offset + stop][keep],
+                    self.report_ids[offset + start : offset + stop][keep],
+                )
+
+    def rows_for_reports(self, report_ids) -> np.ndarray:
+        """Live row positions of `report_ids`, found through `report_ranges`."""
+        pieces = [
+            np.arange(start, stop)
+            for report_id in report_ids
+            for start, stop in self.report_ranges.get(int(report_id), [])
+        ]
+        if not pieces:
+            return np.empty(0, dtype=np.int64)
+        rows = np.concatenate(pieces)
+        return rows[self.alive[rows]]
+
+    def take(self, rows: np.ndarray) -> np.ndarray:
+        """Vectors of the given row positions; `rows` must be sorted ascending."""
+        base_rows = self.base.shape[0]
+        in_base = rows[rows < base_rows]
+        in_tail = rows[rows >= base_rows] - base_rows
+        return np.concatenate([np.asarray(self.base[in_base]), self.tail[in_tail]])
+
+    def _block(self, start: int, stop: int) -> np.ndarray:
+        base_rows = self.base.shape[0]
+        if stop <= base_rows:
+            return self.base[start:stop]
+        if start >= base_rows:
+            return self.tail[start - base_rows : stop - base_rows]
+        return np.concatenate([self.base[start:], self.tail[: stop - base_rows]])
+
+    def _scores(self, query: np.ndarray) -> np.ndarray:
+        """Scores of every row; `query` is one vector, or a `(dim, queries)` matrix."""
+        if self.codes is not None:
+            scores = self.codes.scores(query)
+        else:
+            scores = np.concatenate([self.base @ query, self.tail @ query])
+        scores[~self.alive] = -np.inf
+        return scores
+
+    def _score_range(self, query: np.ndarray, start: int, stop: int) -> np.ndarray:
+        if self.codes is not None:
+            return self.codes.scores(query, start, stop)
+        return self._block(start, stop) @ query
+
+    def _score_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        if self.codes is not None:
+            return self.codes.score_rows(query, rows)
+        return self.take(rows) @ query
+
+    def _partition_scores(self, query: np.ndarray, report_ids) -> tuple[np.ndarray, np.ndarray]:
+        """Score only the rows of `report_ids`; returns `(rows, scores)`."""
+        rows, scores = [], []
+        for report_id in report_ids:
+            for start, stop in self.report_ranges.get(int(report_id), []):
+                rows.append(np.arange(start, stop))
+                scores.append(self._score_range(query, start, stop))
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        keep = self.alive[rows]
+        return rows[keep], scores[keep]
+
+    def _ivf_scores(self, query: np.ndarray, nprobe: int) -> tuple[np.ndarray, np.ndarray]:
+        """Score only the rows in the `nprobe` IVF lists closest to `query`."""
+        rows = np.sort(self.ivf.candidate_rows(query, nprobe))
+        rows = rows[self.alive[rows]]
+        return rows, self._score_rows(query, rows)
+
+    def search(
+        self, query_vector, top_k: int = 5, report_ids=None, nprobe=None, rescore=True, candidates=0
+    ) -> list[tuple[int, int, float]]:
+        """Return `(chunk_id, report_id, cosine score)` for the best `top_k` live rows.
+
+        With `report_ids`, only the rows of those reports are scored. With
+        `nprobe` and a trained `ivf`, only the rows of the `nprobe` nearest IVF
+        lists are scored (approximate); otherwise every row is (exact). With
+        `codes`, the best `max(RESCORE_FACTOR * top_k, candidates)` candidates
+        are rescored at float32 unless `rescore` is false.
+        """
+        if len(self) == 0 or top_k <= 0:
+            return []
+        query = normalize_rows(query_vector)[0]
+        if query.shape[0] != self.dim:
+            raise ValueError(
+                f"Query dimension {query.shape[0]} does not match index dimension {self.dim}."
+            )
+        rescoring = self.codes is not None and rescore
+        keep = max(top_k * RESCORE_FACTOR, candidates) if rescoring else top_k
+        if report_ids is not None:
+            candidate_rows, candidate_scores = self._partition_scores(query, report_ids)
+        elif nprobe and self.ivf is not None:
+            candidate_rows, candidate_scores = self._ivf_scores(query, nprobe)
+        else:
+            scores = self._scores(query)
+            rows = top_k_rows(scores, min(keep, len(self)))
+            candidate_rows, candidate_scores = rows, scores[rows]
+        return self._ranked(query, candidate_rows, candidate_scores, top_k, keep if rescoring else 0)
+
+    def search_many(
+        self, query_vectors, top_k: int = 5, report_ids=None, rescore=True, candidates=0
+    ) -> list[list[tuple[int, int, float]]]:
+        """`search` for several queries at once, one result list per query.
+
+        Each block is scored with one matrix-matrix product for all queries
+        instead of one matrix-vector product per query. With `report_ids`, one
+        collection of report ids per query, the rows of all their reports are
+        scored together and each query only ranks the rows of its own.
+        """
+        queries = normalize_rows(query_vectors)
+        if len(self) == 0 or top_k <= 0:
+            return [[] for _ in range(queries.shape[0])]
+        if queries.shape[1] != self.dim:
+            raise ValueError(
+                f"Query dimension {queries.shape[1]} does not match index dimension {self.dim}."
+            )
+        rescoring = self.codes is not None and rescore
+        keep = max(top_k * RESCORE_FACTOR, candidates) if rescoring else top_k
+        if report_ids is not None:
+            return self._search_many_filtered(queries, top_k, report_ids, keep if rescoring else 0)
+        scores = self._scores(np.ascontiguousarray(queries.T))
+        results = []
+        for column, query in enumerate(queries):
+            column_scores = scores[:, column]
+            rows = top_k_rows(column_scores, min(keep, len(self)))
+            results.append(self._ranked(query, rows, column_scores[rows], top_k, keep if rescoring else 0))
+        return results
+
+    def _search_many_filtered(self, queries, top_k, report_ids, rescore_rows):
+        if len(report_ids) != queries.shape[0]:
+            raise ValueError(f"Got {len(report_ids)} report filters for {queries.shape[0]} queries.")
+        own_rows = [self.rows_for_reports(ids) for ids in report_ids]
+        union = np.unique(np.concatenate(own_rows)) if own_rows else np.empty(0, dtype=np.int64)
+        if union.size == 0:
+            return [[] for _ in own_rows]
+        scores = self._score_rows(np.ascontiguousarray(queries.T), union)
+        results = []
+        for column, (query, rows) in enumerate(zip(queries, own_rows)):
+            row_scores = scores[np.searchsorted(union, rows), column]
+            results.append(self._ranked(query, rows, row_scores, top_k, rescore_rows))
+        return results
+
+    def _ranked(self, query, candidate_rows, candidate_scores, top_k, rescore_rows=0):
+        """The best `top_k` candidates as search hits, after rescoring the best `rescore_rows` at float32."""
+        if rescore_rows:
+            picked = top_k_rows(candidate_scores, rescore_rows)
+            candidate_rows = np.sort(candidate_rows[picked])
+            candidate_scores = self.take(candidate_rows) @ query
+        picked = top_k_rows(candidate_scores, top_k)
+        rows, row_scores = candidate_rows[picked], candidate_scores[picked]
+        return [
+            (int(self.chunk_ids[row]), int(self.report_ids[row]), float(score))
+            for row, score in zip(rows, row_scores)
+        ]
+
+
+class QuantizedRows:
+    """Compact codes of a `VectorIndex`'s rows for first-pass scoring.
+
+    "float16" halves the memory of the float32 rows; "int8" stores each row as
+    int8 codes times one float32 scale, a quarter of it. With `dims`, only
+    each row's first `dims` dimensions are kept (re-normalized), and queries
+    are truncated the same way. Like the index, the codes come in a `base`
+    block (usually memory-mapped from the snapshot) and a `tail` of rows added
+    since. Instances are never modified: `extended` returns a new one.
+    """
+
+    def __init__(self, kind, base_codes, base_scales=None, tail_codes=None, tail_scales=None, dims=None):
+        if kind not in CODE_DTYPES:
+            raise ValueError(f"Unknown quantization: {kind}")
+        self.kind = kind
+        self.dims = dims or None
+        self.base_codes = base_codes
+        self.base_scales = base_scales
+        dim = base_codes.shape[1]
+        if tail_codes is None:
+            tail_codes, tail_scales = self.encode_block(kind, np.empty((0, dim), dtype=np.float32), dims)
+        self.tail_codes = tail_codes
+        self.tail_scales = tail_scales
+
+    @staticmethod
+    def encode_block(kind, vectors: np.ndarray, dims=None):
+        """Return `(codes, scales)` for unit rows; `scales` is None except for int8."""
+        if dims and dims < vectors.shape[1]:
+            vectors = normalize_rows(vectors[:, :dims])
+        if kind != "int8":
+            return vectors.astype(CODE_DTYPES[kind]), None
+        scales = np.abs(vectors).max(axis=1, initial=0.0) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    @classmethod
+    def encode(cls, kind, blocks, dim, dims=None) -> "QuantizedRows":
+        """Encode an iterable of float32 row blocks into one base block."""
+        pieces = [cls.encode_block(kind, np.asarray(block, dtype=np.float32), dims) for block in blocks]
+        if not pieces:
+            pieces = [cls.encode_block(kind, np.empty((0, dim), dtype=np.float32), dims)]
+        codes = np.concatenate([codes for codes, _ in pieces])
+        scales = np.concatenate([scales for _, scales in pieces]) if kind == "int8" else None
+        return cls(kind, codes, scales, dims=dims)
+
+    @property
+    def rows(self) -> int:
+        return int(self.base_codes.shape[0] + self.tail_codes.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        parts = (self.base_codes, self.base_scales, self.tail_codes, self.tail_scales)
+        return int(sum(part.nbytes for part in parts if part is not None))
+
+    def extended(self, vectors: np.ndarray) -> "QuantizedRows":
+        codes, scales = self.encode_block(self.kind, vectors, self.dims)
+        extended = copy.copy(self)
+        extended.tail_codes = np.concatenate([self.tail_codes, codes])
+        if scales is not None:
+            extended.tail_scales = np.concatenate([self.tail_scales, scales])
+        return extended
+
+    def scores(self, query: np.ndarray, start: int = 0, stop: int = None, block_rows: int = 65536) -> np.ndarray:
+        """Approximate cosine scores of rows `[start, stop)`, decoded `block_rows` at a time."""
+        query = self._truncated(query)
+        stop = self.rows if stop is None else stop
+        base_rows = self.base_codes.shape[0]
+        pieces = []
+        for codes, scales, offset in (
+            (self.base_codes, self.base_scales, 0),
+            (self.tail_codes, self.tail_scales, base_rows),
+        ):
+            lo = max(start, offset) - offset
+            hi = min(stop, offset + codes.shape[0]) - offset
+            for block_start in range(lo, hi, block_rows):
+                block_stop = min(hi, block_start + block_rows)
+                block_scales = scales[block_start:block_stop] if scales is not None else None
+                pieces.append(_code_scores(codes[block_start:block_stop], block_scales, query))
+        return np.concatenate(pieces) if pieces else np.empty((0,) + query.shape[1:], dtype=np.float32)
+
+    def score_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Approximate cosine scores of the given sorted row positions."""
+        query = self._truncated(query)
+        base_rows = self.base_codes.shape[0]
+        in_base = rows[rows < base_rows]
+        in_tail = rows[rows >= base_rows] - base_rows
+        pieces = []
+        for codes, scales, picked in (
+            (self.base_codes, self.base_scales, in_base),
+            (self.tail_codes, self.tail_scales, in_tail),
+        ):
+            pieces.append(_code_scores(codes[picked], scales[picked] if scales is not None else None, query))
+        return np.concatenate(pieces)
+
+    def _truncated(self, query: np.ndarray) -> np.ndarray:
+        """`query` (a vector or a `(dim, queries)` matrix) cut to the coded dimensions."""
+        if not self.dims or self.dims >= query.shape[0]:
+            return query
+        head = query[: self.dims]
+        norms = np.linalg.norm(head, axis=0)
+        return (head / np.where(norms == 0, 1.0, norms)).astype(np.float32, copy=False)
+
+
+class IVFIndex:
+    """Inverted-file coarse quantizer over the rows of a `VectorIndex`.
+
+    Rows are grouped under their nearest k-means centroid; a query scores the
+    centroids, then only the rows of the `nprobe` best lists. Instances are
+    never modified: `extended` returns a new one, so a `VectorIndex` copy keeps
+    a consistent view.
+    """
+
+    def __init__(self, centroids: np.ndarray, assignments: np.ndarray, trained_rows: int = None):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int32)
+        self.trained_rows = int(trained_rows if trained_rows is not None else self.assignments.shape[0])
+        order = np.argsort(self.assignments, kind="stable")
+        bounds = np.searchsorted(self.assignments[order], np.arange(self.nlist + 1))
+        self.lists = [order[bounds[i] : bounds[i + 1]] for i in range(self.nlist)]
+
+    @property
+    def nlist(self) -> int:
+        return int(self.centroids.shape[0])
+
+    @classmethod
+    def train(cls, index: "VectorIndex", nlist=0, sample_size=65536, iterations=10, seed=0) -> "IVFIndex":
+        """Spherical k-means on a sample of live rows, then assign every row."""
+        rng = np.random.default_rng(seed)
+        live_rows = np.flatnonzero(index.alive)
+        if live_rows.shape[0] == 0:
+            raise ValueError("Cannot train an IVF index on an empty store.")
+        sample_rows = live_rows
+        if live_rows.shape[0] > sample_size:
+            sample_rows = np.sort(rng.choice(live_rows, sample_size, replace=False))
+        sample = index.take(sample_rows)
+        if not nlist:
+            nlist = int(4 * np.sqrt(live_rows.shape[0]))
+        # Roughly 39 training points per centroid, as k-means needs to be stable.
+        nlist = max(1, min(nlist, sample.shape[0] // 39 or 1))
+        centroids = _spherical_kmeans(sample, nlist, iterations, rng)
+        assignments = np.concatenate(
+            [_nearest(block, centroids) for block in _iter_blocks(index)]
+            or [np.empty(0, dtype=np.int32)]
+        )
+        return cls(centroids, assignments, trained_rows=live_rows.shape[0])
+
+    def extended(self, vectors: np.ndarray, start_row: int) -> "IVFIndex":
+        """Return a copy that also covers `vectors`, stored from `start_row` on."""
+        if start_row != self.assignments.shape[0]:
+            raise ValueError("IVF assignments must cover every row in order.")
+        labels = _nearest(vectors, self.centroids)
+        extended = object.__new__(IVFIndex)
+        extended.centroids = self.centroids
+        extended.assignments = np.concatenate([self.assignments, labels])
+        extended.trained_rows = self.trained_rows
+        lists = list(self.lists)
+        for label in np.unique(labels).tolist():
+            new_rows = start_row + np.flatnonzero(labels == label)
+            lists[label] = np.concatenate([lists[label], new_rows])
+        extended.lists = lists
+        return extended
+
+    def candidate_rows(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        probes = top_k_rows(self.centroids @ query, min(nprobe, self.nlist))
+        return np.concatenate([self.lists[p] for p in probes])
+
+
+def recall_at_k(index: VectorIndex, queries, top_k=10, nprobe=8, rescore=True, candidates=0) -> float:
+    """Mean fraction of the exact float32 top-k that the index's search also returns.
+
+    The search under test uses the index's IVF lists (with `nprobe`) and
+    quantized codes (rescoring `candidates` rows unless `rescore` is false)
+    when it has them.
+    """
+    exact_index = copy.copy(index)
+    exact_index.ivf = exact_index.codes = None
+    hits = total = 0
+    for query in np.atleast_2d(np.asarray(queries, dtype=np.float32)):
+        exact = {hit[0] for hit in exact_index.search(query, top_k)}
+        approx = {
+            hit[0] for hit in index.search(query, top_k, nprobe=nprobe, rescore=rescore, candidates=candidates)
+        }
+        hits += len(exact & approx)
+        total += len(exact)
+    return hits / total if total else 1.0
+
+
+def _code_scores(codes, scales, query: np.ndarray) -> np.ndarray:
+    scores = np.asarray(codes, dtype=np.float32) @ query
+    if scales is not None:
+        scores *= scales if scores.ndim == 1 else scales[:, None]
+    return scores
+
+
+def _iter_blocks(index: VectorIndex, block_rows: int = 65536):
+    """Yield every row of `index` (live or not) in row order, `block_rows` at a time."""
+    for matrix in (index.base, index.tail):
+        for start in range(0, matrix.shape[0], block_rows):
+            yield np.asarray(matrix[start : start + block_rows])
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray, block_rows: int = 8192) -> np.ndarray:
+    labels = [
+        np.argmax(vectors[start : start + block_rows] @ centroids.T, axis=1).astype(np.int32)
+        for start in range(0, vectors.shape[0], block_rows)
+    ]
+    return np.concatenate(labels) if labels else np.empty(0, dtype=np.int32)
+
+
+def _spherical_kmeans(sample: np.ndarray, nlist: int, iterations: int, rng) -> np.ndarray:
+    centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _nearest(sample, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+        empty = counts == 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        sums[~empty] = np.add.reduceat(sample[np.argsort(labels, kind="stable")], starts[~empty], axis=0)
+        if empty.any():
+            sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+def _row_ranges(report_ids: np.ndarray, offset: int = 0) -> dict[int, list[tuple[int, int]]]:
+    """Map each report id to the `[start, stop)` runs of consecutive rows it occupies."""
+    ranges: dict[int, list[tuple[int, int]]] = {}
+    if report_ids.shape[0] == 0:
+        return ranges
+    boundaries = np.flatnonzero(np.diff(report_ids)) + 1
+    starts = np.concatenate([[0], boundaries])
+    stops = np.concatenate([boundaries, [report_ids.shape[0]]])
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        ranges.setdefault(int(report_ids[start]), []).append((start + offset, stop + offset))
+    return ranges
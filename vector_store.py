@@ -0,0 +1,543 @@
+"""On-disk layout of the document vector store.
+
+    vector_store/
+        manifest.json          names the current snapshot and the last WAL seq folded into it,
+                               plus the embedding model and dimension of the vectors and
+                               the largest chunk id ever logged
+        snapshot-000003/
+            vectors.npy        float32 matrix of unit-normalized rows, memory-mapped on load
+            ids.npy            int64 (chunk_id, report_id) pair per row
+            catalog.json       only in stores written before chunk text moved to the
+                               `document_chunks` table: text and report id by chunk id
+            ivf_centroids.npy  optional IVF centroids and per-row list assignments
+            ivf_assignments.npy
+            codes.npy          optional float16 / int8 codes for first-pass scoring,
+                               possibly of only the leading dimensions
+            scales.npy         per-row scales of int8 codes
+        wal.log                append-only mutations made since the snapshot
+        store.lock             flock held by the process writing to the store
+        compaction.lock        flock held by the process writing a new snapshot
+
+Every upload or delete appends one fsynced record to `wal.log`; loading
+replays it on top of the snapshot. Compaction rotates the log to
+`wal.log.compacting`, writes a new snapshot to a fresh directory and
+publishes it by atomically replacing `manifest.json`, so readers never see a
+half-written store. Publishing and deleting the older snapshots happen under
+`store.lock`, which loading also holds, so no process is halfway through
+reading a snapshot when it goes; ones that already mapped it keep working.
+Records carry increasing sequence numbers, so replaying a log that was
+already folded into the snapshot is a no-op.
+
+Several processes (e.g. gunicorn workers) can share one store. Writers hold
+`store.lock` while they catch up with the log and append to it, and a reader
+notices other processes' writes with `has_changed()`, which only stats the
+manifest and the log; `catch_up()` then replays just the new log records.
+"""
+import contextlib
+import json
+import logging
+import os
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: the store is then only safe for a single process.
+    fcntl = None
+
+from vector_index import CODE_DTYPES, IVFIndex, QuantizedRows, VectorIndex
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+LEGACY_METADATA_FILE = "metadata.json"
+WAL_FILE = "wal.log"
+COMPACTING_WAL_FILE = "wal.log.compacting"
+LOCK_FILE = "store.lock"
+COMPACTION_LOCK_FILE = "compaction.lock"
+STORE_FORMAT = 1
+
+WAL_MAGIC = b"VWAL"
+# magic, seq, op, payload length, crc32(payload)
+WAL_HEADER = struct.Struct("<4sQBII")
+WAL_OP_ADD = 1
+WAL_OP_TOMBSTONE = 2
+WAL_OP_MODEL = 3
+# report_id, row count, dimension
+_ADD_HEADER = struct.Struct("<qII")
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+class VectorStore:
+    """Reads and writes vector store snapshots under `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.last_seq = 0
+        # Embedding model the stored vectors came from; None for stores that predate the record.
+        self.model = None
+        # Largest chunk id ever logged, deleted or not; a database row above it never got a vector.
+        self.max_chunk_id = 0
+        # What this process has read: the manifest file, and how far into which wal.log.
+        self._manifest_stamp = None
+        self._wal_stamp = (None, 0)
+        os.makedirs(self.path, exist_ok=True)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the store's inter-process write lock (not re-entrant)."""
+        with open(os.path.join(self.path, LOCK_FILE), "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+    @contextlib.contextmanager
+    def compaction_lock(self):
+        """Yield True if this process may compact, False if another one already is."""
+        with open(os.path.join(self.path, COMPACTION_LOCK_FILE), "a+b") as f:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            yield True
+
+    def has_changed(self) -> bool:
+        """Whether another process changed the store since this one last read or wrote it."""
+        return self._stat_manifest() != self._manifest_stamp or self._stat_wal() != self._wal_stamp
+
+    def catch_up(self, index: VectorIndex, catalog: dict) -> bool:
+        """Replay log records appended by other processes onto `index`.
+
+        Returns False, leaving `index` alone, when a compaction or `clear()`
+        replaced the snapshot or the log; the caller must `load()` again.
+        Call with `lock()` held, since a torn log tail is truncated: the next
+        append would otherwise land behind it, where `load()` never reads.
+        """
+        if self._stat_manifest() != self._manifest_stamp:
+            return False
+        inode, offset = self._wal_stamp
+        current_inode, _ = self._stat_wal()
+        if current_inode != inode and inode is not None:
+            return False
+        for seq, op, payload in self._read_wal(self.wal_path, truncate_torn_tail=True, start=offset):
+            offset += WAL_HEADER.size + len(payload)
+            if seq > self.last_seq:
+                self._apply(index, catalog, op, payload)
+                self.last_seq = seq
+        self._wal_stamp = (current_inode, offset)
+        return True
+
+    def _stat_manifest(self):
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _stat_wal(self):
+        try:
+            stat = os.stat(self.wal_path)
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.path, MANIFEST_FILE)
+
+    def read_manifest(self) -> dict | None:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @property
+    def wal_path(self):
+        return os.path.join(self.path, WAL_FILE)
+
+    @property
+    def compacting_wal_path(self):
+        return os.path.join(self.path, COMPACTING_WAL_FILE)
+
+    def wal_size(self) -> int:
+        try:
+            return os.path.getsize(self.wal_path)
+        except OSError:
+            return 0
+
+    def load(self) -> tuple[VectorIndex, dict]:
+        """Return `(index, catalog)`: the snapshot memory-mapped, plus the replayed WAL.
+
+        `catalog` holds chunk text only for stores (or WAL records) written
+        before the text moved to the database; it is empty otherwise. Call with
+        `lock()` held, since a torn log tail is truncated.
+        """
+        manifest = self.read_manifest()
+        if manifest is None and self._migrate_legacy_metadata():
+            manifest = self.read_manifest()
+
+        self._manifest_stamp = self._stat_manifest()
+        self.model = manifest.get("embed_model") if manifest is not None else None
+
+        if manifest is None:
+            index, catalog = VectorIndex(), {}
+            self.last_seq = 0
+            self.max_chunk_id = 0
+        else:
+            snapshot_dir = os.path.join(self.path, manifest["snapshot"])
+            vectors = np.load(os.path.join(snapshot_dir, "vectors.npy"), mmap_mode="r")
+            ids = np.load(os.path.join(snapshot_dir, "ids.npy"))
+            catalog = {}
+            catalog_path = os.path.join(snapshot_dir, "catalog.json")
+            if os.path.exists(catalog_path):
+                with open(catalog_path, "r", encoding="utf-8") as f:
+                    catalog = {int(k): v for k, v in json.load(f).items()}
+            index = VectorIndex(
+                vectors,
+                ids[:, 0],
+                ids[:, 1],
+                ivf=self._load_ivf(snapshot_dir, manifest),
+                codes=self._load_codes(snapshot_dir, manifest),
+            )
+            self.last_seq = int(manifest.get("wal_seq", 0))
+            self.max_chunk_id = int(manifest.get("max_chunk_id") or 0)
+            if len(ids):
+                self.max_chunk_id = max(self.max_chunk_id, int(ids[:, 0].max()))
+
+        snapshot_seq = self.last_seq
+        for path in (self.compacting_wal_path, self.wal_path):
+            for seq, op, payload in self._read_wal(path, truncate_torn_tail=path == self.wal_path):
+                self.last_seq = max(self.last_seq, seq)
+                if seq <= snapshot_seq:
+                    continue
+                self._apply(index, catalog, op, payload)
+        self._wal_stamp = self._stat_wal()
+        return index, catalog
+
+    def append_add(self, report_id, chunk_ids, vectors: np.ndarray, texts=None) -> int:
+        """Durably log new chunks; `vectors` must already be normalized float32 rows.
+
+        `texts` is only written by callers that keep chunk text in the store.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        payload = b"".join(
+            [
+                _ADD_HEADER.pack(int(report_id), vectors.shape[0], vectors.shape[1]),
+                np.asarray(chunk_ids, dtype="<i8").tobytes(),
+                vectors.astype("<f4", copy=False).tobytes(),
+                json.dumps(list(texts), ensure_ascii=False).encode("utf-8") if texts is not None else b"",
+            ]
+        )
+        seq = self._append(WAL_OP_ADD, payload)
+        if len(chunk_ids):
+            self.max_chunk_id = max(self.max_chunk_id, max(int(c) for c in chunk_ids))
+        return seq
+
+    def record_model(self, model: str) -> int:
+        """Durably note that vectors logged from now on come from embedding `model`."""
+        seq = self._append(WAL_OP_MODEL, model.encode("utf-8"))
+        self.model = model
+        return seq
+
+    def append_tombstone(self, report_ids) -> int:
+        """Durably log the deletion of every chunk of `report_ids`."""
+        report_ids = [int(r) for r in report_ids]
+        payload = struct.pack(f"<I{len(report_ids)}q", len(report_ids), *report_ids)
+        return self._append(WAL_OP_TOMBSTONE, payload)
+
+    def rotate_wal(self) -> int:
+        """Move the active log aside for compaction; returns the last seq it contains.
+
+        Callers must hold the same lock that serializes appends.
+        """
+        if not os.path.exists(self.wal_path):
+            return self.last_seq
+        if os.path.exists(self.compacting_wal_path):
+            # Left behind by a compaction that failed or crashed: keep both logs' records.
+            with open(self.wal_path, "rb") as src, open(self.compacting_wal_path, "ab") as dst:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.wal_path)
+        else:
+            os.replace(self.wal_path, self.compacting_wal_path)
+        _fsync_dir(self.path)
+        self._wal_stamp = (None, 0)
+        return self.last_seq
+
+    def finish_compaction(self, manifest: dict):
+        """Publish a snapshot staged from the rotated log's state and drop that log.
+
+        Call with `lock()` held.
+        """
+        self.publish_snapshot(manifest)
+        try:
+            os.remove(self.compacting_wal_path)
+        except FileNotFoundError:
+            pass
+
+    def _append(self, op, payload: bytes) -> int:
+        seq = self.last_seq + 1
+        header = WAL_HEADER.pack(WAL_MAGIC, seq, op, len(payload), zlib.crc32(payload))
+        with open(self.wal_path, "ab") as f:
+            f.write(header + payload)
+            f.flush()
+            os.fsync(f.fileno())
+            stat = os.fstat(f.fileno())
+        self.last_seq = seq
+        self._wal_stamp = (stat.st_ino, stat.st_size)
+        return seq
+
+    def _read_wal(self, path, truncate_torn_tail=False, start=0):
+        """Yield `(seq, op, payload)` records from byte `start`, stopping at the first torn or corrupt one."""
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(start)
+            offset = start
+            while True:
+                header = f.read(WAL_HEADER.size)
+                if not header:
+                    return
+                valid = len(header) == WAL_HEADER.size
+                if valid:
+                    magic, seq, op, length, crc = WAL_HEADER.unpack(header)
+                    payload = f.read(length)
+                    valid = magic == WAL_MAGIC and len(payload) == length and zlib.crc32(payload) == crc
+                if not valid:
+                    logger.warning("Ignoring torn or corrupt WAL tail in %s at byte %s", path, offset)
+                    break
+                offset += WAL_HEADER.size + length
+                yield seq, op, payload
+        if truncate_torn_tail:
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+    def _apply(self, index: VectorIndex, catalog: dict, op, payload: bytes):
+        if op == WAL_OP_ADD:
+            report_id, rows, dim = _ADD_HEADER.unpack_from(payload)
+            cursor = _ADD_HEADER.size
+            chunk_ids = np.frombuffer(payload, dtype="<i8", count=rows, offset=cursor)
+            cursor += rows * 8
+            vectors = np.frombuffer(payload, dtype="<f4", count=rows * dim, offset=cursor)
+            cursor += rows * dim * 4
+            texts = json.loads(payload[cursor:].decode("utf-8")) if len(payload) > cursor else []
+            index.add(chunk_ids, [report_id] * rows, vectors.reshape(rows, dim))
+            if rows:
+                self.max_chunk_id = max(self.max_chunk_id, int(chunk_ids.max()))
+            for chunk_id, text in zip(chunk_ids.tolist(), texts):
+                catalog[chunk_id] = {"report_id": report_id, "text": text}
+        elif op == WAL_OP_TOMBSTONE:
+            (count,) = struct.unpack_from("<I", payload)
+            report_ids = struct.unpack_from(f"<{count}q", payload, 4)
+            for chunk_id in index.chunk_ids_for_reports(report_ids):
+                catalog.pop(chunk_id, None)
+            index.remove_reports(report_ids)
+        elif op == WAL_OP_MODEL:
+            self.model = payload.decode("utf-8")
+        else:
+            raise ValueError(f"Unknown WAL operation {op}.")
+
+    def write_snapshot(self, index: VectorIndex, catalog=None, wal_seq=None):
+        """Persist the live rows of `index` (plus `catalog`, if given) as the new snapshot.
+
+        Call with `lock()` held.
+        """
+        self.publish_snapshot(self.stage_snapshot(index, catalog, wal_seq=wal_seq))
+
+    def stage_snapshot(self, index: VectorIndex, catalog=None, wal_seq=None) -> dict:
+        """Write the live rows of `index` to a new snapshot directory; returns the manifest publishing it.
+
+        Needs no `lock()`, so writers carry on meanwhile, but only one process
+        may stage at a time (see `compaction_lock()`).
+        """
+        manifest = self.read_manifest() or {}
+        generation = int(manifest.get("generation", 0)) + 1
+        name = f"snapshot-{generation:06d}"
+        final_dir = os.path.join(self.path, name)
+        tmp_dir = f"{final_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        rows = len(index)
+        vectors = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, "vectors.npy"), mode="w+", dtype=np.float32, shape=(rows, index.dim)
+        )
+        ids = np.empty((rows, 2), dtype=np.int64)
+        cursor = 0
+        for block, chunk_ids, report_ids in index.iter_live_blocks():
+            stop = cursor + block.shape[0]
+            vectors[cursor:stop] = block
+            ids[cursor:stop, 0] = chunk_ids
+            ids[cursor:stop, 1] = report_ids
+            cursor = stop
+        vectors.flush()
+        del vectors
+        if index.codes is not None:
+            self._write_codes(tmp_dir, index)
+        np.save(os.path.join(tmp_dir, "ids.npy"), ids)
+        ivf = index.ivf
+        if ivf is not None:
+            np.save(os.path.join(tmp_dir, "ivf_centroids.npy"), ivf.centroids)
+            np.save(
+                os.path.join(tmp_dir, "ivf_assignments.npy"),
+                ivf.assignments[: index.total_rows][index.alive],
+            )
+        if catalog:
+            live_ids = set(ids[:, 0].tolist())
+            with open(os.path.join(tmp_dir, "catalog.json"), "w", encoding="utf-8") as f:
+                json.dump(
+                    {k: v for k, v in catalog.items() if k in live_ids},
+                    f,
+                    ensure_ascii=False,
+                )
+        for fname in os.listdir(tmp_dir):
+            with open(os.path.join(tmp_dir, fname), "rb") as f:
+                os.fsync(f.fileno())
+        os.replace(tmp_dir, final_dir)
+        _fsync_dir(self.path)
+
+        return {
+            "format": STORE_FORMAT,
+            "generation": generation,
+            "snapshot": name,
+            "rows": rows,
+            "dim": index.dim,
+            "wal_seq": self.last_seq if wal_seq is None else wal_seq,
+            "ivf_trained_rows": ivf.trained_rows if ivf is not None else None,
+            "quantization": index.quantization,
+            "code_dims": index.code_dims,
+            "embed_model": self.model,
+            "max_chunk_id": max(self.max_chunk_id, int(ids[:, 0].max()) if rows else 0),
+        }
+
+    def publish_snapshot(self, manifest: dict):
+        """Make a staged snapshot the current one and delete the older ones.
+
+        Call with `lock()` held: `load()` holds it too, so no process is
+        between reading the old manifest and opening the old snapshot's files.
+        """
+        _write_json_atomic(self.manifest_path, manifest)
+        self._remove_stale_snapshots(keep=manifest["snapshot"])
+
+    @staticmethod
+    def _load_ivf(snapshot_dir, manifest) -> IVFIndex | None:
+        centroids_path = os.path.join(snapshot_dir, "ivf_centroids.npy")
+        if not os.path.exists(centroids_path):
+            return None
+        return IVFIndex(
+            np.load(centroids_path),
+            np.load(os.path.join(snapshot_dir, "ivf_assignments.npy")),
+            trained_rows=manifest.get("ivf_trained_rows"),
+        )
+
+    @staticmethod
+    def _write_codes(snapshot_dir, index: VectorIndex):
+        """Re-encode the live rows; codes depend only on the vectors, so this matches the index."""
+        kind, dims = index.codes.kind, index.codes.dims
+        rows = len(index)
+        codes = np.lib.format.open_memmap(
+            os.path.join(snapshot_dir, "codes.npy"),
+            mode="w+",
+            dtype=CODE_DTYPES[kind],
+            shape=(rows, min(dims or index.dim, index.dim)),
+        )
+        scales = np.empty(rows, dtype=np.float32)
+        cursor = 0
+        for block, _, _ in index.iter_live_blocks():
+            block_codes, block_scales = QuantizedRows.encode_block(kind, block, dims)
+            stop = cursor + block.shape[0]
+            codes[cursor:stop] = block_codes
+            if block_scales is not None:
+                scales[cursor:stop] = block_scales
+            cursor = stop
+        codes.flush()
+        del codes
+        if kind == "int8":
+            np.save(os.path.join(snapshot_dir, "scales.npy"), scales)
+
+    @staticmethod
+    def _load_codes(snapshot_dir, manifest) -> QuantizedRows | None:
+        codes_path = os.path.join(snapshot_dir, "codes.npy")
+        kind = manifest.get("quantization", "none")
+        if kind == "none" or not os.path.exists(codes_path):
+            return None
+        scales = None
+        if kind == "int8":
+            scales = np.load(os.path.join(snapshot_dir, "scales.npy"), mmap_mode="r")
+        return QuantizedRows(kind, np.load(codes_path, mmap_mode="r"), scales, dims=manifest.get("code_dims"))
+
+    def clear(self):
+        """Delete every file and snapshot in the store directory except the lock files."""
+        self.last_seq = 0
+        self.model = None
+        self.max_chunk_id = 0
+        self._manifest_stamp, self._wal_stamp = None, (None, 0)
+        for fname in os.listdir(self.path):
+            if fname in (LOCK_FILE, COMPACTION_LOCK_FILE):
+                continue
+            full_path = os.path.join(self.path, fname)
+            if os.path.isdir(full_path):
+                shutil.rmtree(full_path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(full_path)
+                except OSError:
+                    pass
+
+    def _remove_stale_snapshots(self, keep):
+        for fname in os.listdir(self.path):
+            if fname.startswith("snapshot-") and fname != keep:
+                shutil.rmtree(os.path.join(self.path, fname), ignore_errors=True)
+
+    def _migrate_legacy_metadata(self) -> bool:
+        """Convert a pre-snapshot `metadata.json` (embeddings inlined) into a snapshot."""
+        legacy_path = os.path.join(self.path, LEGACY_METADATA_FILE)
+        if not os.path.exists(legacy_path):
+            return False
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                metadata = {int(k): v for k, v in json.load(f).items()}
+        except Exception as e:
+            logger.warning("Could not load legacy metadata: %s", e)
+            return False
+        index = VectorIndex.from_metadata(metadata)
+        catalog = {
+            chunk_id: {"report_id": meta.get("report_id"), "text": meta.get("text", "")}
+            for chunk_id, meta in metadata.items()
+        }
+        self.write_snapshot(index, catalog)
+        os.replace(legacy_path, f"{legacy_path}.migrated")
+        logger.info("Migrated %s chunks from %s", len(index), LEGACY_METADATA_FILE)
+        return True